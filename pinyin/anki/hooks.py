@@ -10,10 +10,13 @@ import sqlalchemy
 import weakref
 
 import pinyin.anki.keys
+import pinyin.background
+import pinyin.batch
+import pinyin.db
 import pinyin.factproxy
 from pinyin.logger import log
 import pinyin.media
-import pinyin.transformations
+import pinyin.metrics
 import pinyin.utils
 
 import utils
@@ -36,6 +39,10 @@ class FocusHook(Hook):
         
         # The fact editor Anki currently has open: used for the code determining when a field has changed
         self.knownfactedit = None
+        
+        # Updates are made on a background thread, waiting until the user has stopped moving between fields
+        self.dispatcher = pinyin.background.BackgroundDispatcher(self.processupdates)
+        self.timer = None
     
     def sessionExistsFor(self, field):
         # If there is no current deck, DO NOT ask about the field name or
@@ -94,15 +101,72 @@ class FocusHook(Hook):
         factproxy = pinyin.factproxy.FactProxy(self.config.candidateFieldNamesByKey, fact)
         
         # Find which kind of field we have just moved off
-        updater = None
         for key, updateablefieldname in factproxy.fieldnames.items():
-            if fieldname == updateablefieldname:
-                updater = self.buildupdater(key)
+            if fieldname == updateablefieldname and key in self.updaterbuilders:
+                self.dispatcher.submit(fact.id, self.updaterequest(fact, factproxy, key, fieldvalue))
                 break
-
-        # Update the card, ignoring any errors
-        if updater:
-            pinyin.utils.suppressexceptions(lambda: updater.updatefact(factproxy, fieldvalue))
+    
+    # Updating can involve slow dictionary lookups or trips to the network, so it happens on the background
+    # thread. Only a snapshot of the fact and of the deck media go over there: the fact and deck belong to the UI.
+    def updaterequest(self, fact, factproxy, key, fieldvalue):
+        snapshot = dict([(snapshotkey, factproxy[snapshotkey]) for snapshotkey in factproxy])
+        return (fact, snapshot, self.mediamanager.alreadyimportedsnapshot(), key, fieldvalue)
+    
+    # Runs on the background thread, with all the updates to a fact since it was last processed
+    def processupdates(self, factid, requests):
+        fact, snapshot, alreadyimported = requests[-1][0:3]
+        notifier = pinyin.background.BackgroundNotifier(self.dispatcher, self.notifier)
+        mediamanager = pinyin.background.DeferredMediaManager(self.mediamanager, alreadyimported)
+        
+        # Replay the updates in order. Each of them only changed the one field since the fact was
+        # last updated, so we start from the most recent snapshot.
+        working = snapshot.copy()
+        for _, _, _, key, fieldvalue in requests:
+            updater = self.updaterbuilders[key](notifier, mediamanager, self.config)
+            pinyin.utils.suppressexceptions(lambda: updater.updatefact(working, fieldvalue))
+        
+        changes = dict([(key, value) for key, value in working.items() if snapshot.get(key) != value])
+        if len(changes) == 0 and len(mediamanager.imports) == 0:
+            return None
+        
+        updates = [(key, fieldvalue) for _, _, _, key, fieldvalue in requests]
+        return lambda: self.applyupdates(fact, snapshot, changes, mediamanager.imports, updates)
+    
+    # Runs on the UI thread once the background thread is done with a fact
+    def applyupdates(self, fact, snapshot, changes, imports, updates):
+        if self.mw.deck is None or self.mw.deck.s is None:
+            log.info("Discarding the background update of fact %s, as the deck has been closed", fact.id)
+            return
+        
+        # If the user changed the fact while we were busy, our results are stale. We can't just throw them
+        # away, as the updates the user has asked for since then only redo their own fields. Instead, do
+        # these updates again on the fact as it is now, before the later ones.
+        factproxy = pinyin.factproxy.FactProxy(self.config.candidateFieldNamesByKey, fact)
+        if [key for key in snapshot if factproxy[key] != snapshot[key]]:
+            log.info("Redoing the background update of fact %s, as it has changed in the meantime", fact.id)
+            requests = []
+            for key, fieldvalue in updates:
+                # The user may have changed the field again since, so use the value it has now
+                if fieldvalue is not None:
+                    fieldvalue = pinyin.factproxy.unmarkgeneratedfield(factproxy[key])
+                
+                requests.append(self.updaterequest(fact, factproxy, key, fieldvalue))
+            
+            self.dispatcher.resubmit(fact.id, requests)
+            return
+        
+        imported = zip(imports, self.mediamanager.importmany(imports))
+        for key, value in changes.items():
+            factproxy[key] = pinyin.media.replacesounds(value, imported)
+        
+        fact.setModified(textChanged=True)
+        self.mw.deck.setModified()
+        
+        # Show the new field values if the fact is still being edited
+        if self.knownfactedit is not None and self.knownfactedit.fact is fact:
+            self.knownfactedit.loadFields(font=False)
+            for _, fieldwidget in self.knownfactedit.fields.values():
+                fieldwidget.document().setModified(False)
     
     def install(self):
         from anki.hooks import addHook, removeHook
@@ -122,6 +186,15 @@ class FocusHook(Hook):
         # Unconditionally add our new hooks to Anki
         addHook('makeField', self.makeField)
         addHook('fact.focusLost', self.onFocusLost)
+        
+        # The background thread needs its own database connection
+        pinyin.db.usethreadlocalconnections()
+        self.dispatcher.start()
+        
+        # Poll for finished updates: only the UI thread may touch the facts
+        self.timer = QtCore.QTimer(self.mw)
+        self.mw.connect(self.timer, QtCore.SIGNAL('timeout()'), self.dispatcher.applyresults)
+        self.timer.start(100)
 
 class FieldShrinkingHook(Hook):
     def adjustFieldHeight(self, widget, field):
@@ -151,9 +224,7 @@ class ColorShortcutKeysHook(FactEditorShortcutKeysHook):
     def setColor(self, editor, i, sandhify):
         log.info("Got color change event for color %d, sandhify %s", i, sandhify)
         
-        color = (self.config.tonecolors + self.config.extraquickaccesscolors)[i - 1]
-        if sandhify:
-            color = pinyin.transformations.sandhifycolor(color)
+        color = self.config.palette.color(i - 1, sandhify)
         
         focusededit = editor.focusedEdit()
         
@@ -277,21 +348,46 @@ class MassFillHook(ToolMenuHook):
         field = self.__class__.field
         log.info("User triggered missing information fill for %s" % field)
         
-        for fact in utils.suitableFacts(self.config.modelTag, self.mw.deck):
-            # Need a fact proxy because the updater works on dictionary-like objects
-            factproxy = pinyin.factproxy.FactProxy(self.config.candidateFieldNamesByKey, fact)
-            if field not in factproxy:
-                continue
-            
-            self.buildupdater(field).updatefact(factproxy, None, **self.__class__.updatefactkwargs)
+        # Need fact proxies because the updater works on dictionary-like objects
+        factproxies = [pinyin.factproxy.FactProxy(self.config.candidateFieldNamesByKey, fact) for fact in utils.suitableFacts(self.config.modelTag, self.mw.deck)]
+        
+        progressdialog = QtGui.QProgressDialog("Updating your cards...", "Cancel", 0, len(factproxies), self.mw)
+        progressdialog.setWindowModality(QtCore.Qt.WindowModal)
+        progressdialog.setMinimumDuration(500)
+        
+        def progress(done, total):
+            progressdialog.setValue(done)
+        
+        def cancelled():
+            # Keep the dialog responsive while we work
+            QtGui.QApplication.processEvents()
+            return progressdialog.wasCanceled()
+        
+        def commit(chunk):
+            for factproxy in chunk:
+                # NB: very important to mark the fact as modified (see #105) because otherwise
+                # the HTML etc won't be regenerated by Anki, so users may not e.g. get working
+                # sounds that have just been filled in by the updater.
+                factproxy.fact.setModified(textChanged=True)
             
-            # NB: very important to mark the fact as modified (see #105) because otherwise
-            # the HTML etc won't be regenerated by Anki, so users may not e.g. get working
-            # sounds that have just been filled in by the updater.
-            fact.setModified(textChanged=True)
+            # Write each chunk back to the database in one go
+            self.mw.deck.s.flush()
+        
+        if pinyin.batch.canupdateinparallel():
+            # Use all the cores we have, as this can take a long time for a big deck
+            batchupdater = pinyin.batch.ParallelBatchUpdater(field, self.mediamanager, self.config)
+        else:
+            batchupdater = pinyin.batch.BatchUpdater(self.buildupdater(field))
+        
+        batchupdater.updatefacts(factproxies, progress=progress, cancelled=cancelled, commit=commit, **self.__class__.updatefactkwargs)
+        progressdialog.setValue(len(factproxies))
         
         # For good measure, mark the deck as modified as well (see #105)
         self.mw.deck.setModified()
+        
+        if progressdialog.wasCanceled():
+            self.notifier.info("The update was cancelled part of the way through: only some of your cards were updated.")
+            return
     
         # DEBUG consider future feature to add missing measure words cards after doing so (not now)
         self.notifier.info(self.__class__.notification)
@@ -314,6 +410,15 @@ class ReformatReadingsHook(MassFillHook):
     
     notification = "All readings have been successfully reformatted."
 
+class PerformanceStatisticsHook(ToolMenuHook):
+    menutext = 'Performance statistics'
+    menutooltip = 'Show how much time the Pinyin Toolkit has spent filling in each field during this session.'
+    
+    def triggered(self):
+        log.info("User asked for performance statistics")
+        pinyin.metrics.registry.dumptolog()
+        self.notifier.info("<pre>" + pinyin.metrics.registry.report() + "</pre>")
+
 class TagRemovingHook(Hook):
     def filterHtml(self, html, _card):
         return pinyin.factproxy.unmarkhtmlgeneratedfields(html)
@@ -339,6 +444,7 @@ hookbuilders = [
     PreferencesHook,
     MissingInformationHook,
     ReformatReadingsHook,
+    PerformanceStatisticsHook,
     # Card display hooks
     TagRemovingHook
   ]
\ No newline at end of file
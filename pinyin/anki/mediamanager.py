@@ -9,6 +9,9 @@ import pinyin.utils
 class AnkiMediaManager(object):
     def __init__(self, mw):
         self.mw = mw
+        self.registry = None
+        self.deckmediakey = None
+        self.deckmediafilenames = set()
     
     def mediadir(self):
         # Create the plugin media directory, or later code that tries to
@@ -18,25 +21,68 @@ class AnkiMediaManager(object):
         return themediadir
 
     def discovermediapacks(self):
-        packs = []
+        return self.mediapackregistry().discovermediapacks()
+    
+    def refreshmediapacks(self):
+        self.mediapackregistry().refresh()
+    
+    def mediapackregistry(self):
+        # NB: always go through mediadir so that the directory gets recreated if the user deletes it
         themediadir = self.mediadir()
-        for packname in os.listdir(themediadir):
-            # Skip the download cache directory
-            if packname.lower() == "downloads":
-                continue
-            
-            # Only try and process directories as packs:
-            packpath = os.path.join(themediadir, packname)
-            if os.path.isdir(packpath):
-                log.info("Considering %s as a media pack", packname)
-                packs.append(pinyin.media.MediaPack.frompath(packpath))
-            else:
-                log.info("Ignoring the file %s in the media directory", packname)
+        if self.registry is None:
+            self.registry = pinyin.media.MediaPackRegistry(themediadir)
         
-        return packs
+        return self.registry
     
     def importtocurrentdeck(self, file):
-        return self.mw.deck.addMedia(file)
+        return self.importmany([file])[0]
+    
+    def importmany(self, files):
+        # Only hand each file to the deck once, and not at all if the deck already has it
+        deckmedia = self.deckmedia()
+        filenames = {}
+        for file in files:
+            if file in filenames:
+                continue
+            
+            filename = anki.media.mediaFilename(file)
+            if os.path.normcase(filename) not in deckmedia:
+                filename = self.mw.deck.addMedia(file)
+                
+                # Record the new file in the deck media set without listing the directory again
+                deckmedia.add(os.path.normcase(filename))
+            
+            filenames[file] = filename
+        
+        # We can bring the modification time up to date, since the only changes were our own
+        self.deckmediakey = self.deckmediadirkey()
+        
+        return [filenames[file] for file in files]
 
     def alreadyimported(self, file):
-        return os.path.exists(os.path.join(self.mw.deck.mediaDir(create=False), anki.media.mediaFilename(file)))
+        return os.path.normcase(anki.media.mediaFilename(file)) in self.deckmedia()
+    
+    # A version of alreadyimported that can be used from other threads, as it doesn't need to ask
+    # the deck where its media is. It answers according to the deck media as they are now.
+    def alreadyimportedsnapshot(self):
+        deckmedia = self.deckmedia()
+        return lambda file: os.path.normcase(anki.media.mediaFilename(file)) in deckmedia
+    
+    # The set of (normalized) filenames in the media directory of the current deck. This
+    # is only reread when the deck or the modification time of its media directory changes.
+    def deckmedia(self):
+        key = self.deckmediadirkey()
+        if key != self.deckmediakey:
+            mediadir, _mtime = key
+            log.info("Reading the contents of the deck media directory %s", mediadir)
+            self.deckmediafilenames = set([os.path.normcase(filename) for filename in (mediadir and os.listdir(mediadir)) or []])
+            self.deckmediakey = key
+        
+        return self.deckmediafilenames
+    
+    def deckmediadirkey(self):
+        mediadir = self.mw.deck.mediaDir(create=False)
+        if mediadir is None or not os.path.isdir(mediadir):
+            return (None, None)
+        else:
+            return (mediadir, os.path.getmtime(mediadir))
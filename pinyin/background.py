@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import Queue
+import sys
+import threading
+import time
+
+from logger import log
+import utils
+
+
+"""
+Runs work on a background thread so that the UI stays responsive, then hands the results
+back to be dealt with on the UI thread.
+
+Requests are submitted under a key (e.g. the fact they concern). We wait until no more requests
+have arrived for a key for the debounce delay, and then process all of its requests together by
+calling process(key, requests) on the background thread. That returns either None or a function
+that is queued up to be called on the UI thread: the UI must arrange to call applyresults
+regularly, e.g. from a timer.
+"""
+class BackgroundDispatcher(object):
+    def __init__(self, process, delay=0.3, clock=time.time):
+        self.process = process
+        self.delay = delay
+        self.clock = clock
+        
+        # Maps each key to the time it becomes due and the list of requests for it
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.results = Queue.Queue()
+        self.thread = None
+        self.stopping = False
+    
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="Pinyin Toolkit background updates")
+        # Don't keep the application alive just for us
+        self.thread.setDaemon(True)
+        self.thread.start()
+    
+    def stop(self):
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            self.condition.notify()
+        finally:
+            self.condition.release()
+    
+    def submit(self, key, request):
+        self.enqueue(key, lambda requests: requests + [request])
+    
+    # Puts requests that have already been processed back to be done again, ahead of anything
+    # submitted for the key since, as that should be applied on top of them
+    def resubmit(self, key, requests):
+        self.enqueue(key, lambda pendingrequests: requests + pendingrequests)
+    
+    def enqueue(self, key, addto):
+        self.condition.acquire()
+        try:
+            # Coalesce with anything not yet processed for this key, and push the deadline back
+            _, requests = self.pending.get(key, (None, []))
+            self.pending[key] = (self.clock() + self.delay, addto(requests))
+            self.condition.notify()
+        finally:
+            self.condition.release()
+    
+    def post(self, action):
+        self.results.put(action)
+    
+    def applyresults(self):
+        while True:
+            try:
+                action = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            
+            utils.suppressexceptions(action)
+    
+    # Takes the key whose requests have been waiting longest without being added to, if it is due
+    def takedue(self):
+        if len(self.pending) == 0:
+            return None, None, None
+        
+        due, key = min([(due, key) for key, (due, _) in self.pending.items()])
+        wait = due - self.clock()
+        if wait > 0:
+            return None, None, wait
+        
+        _, requests = self.pending.pop(key)
+        return key, requests, None
+    
+    def run(self):
+        while True:
+            self.condition.acquire()
+            try:
+                while True:
+                    if self.stopping:
+                        return
+                    
+                    key, requests, wait = self.takedue()
+                    if requests is not None:
+                        break
+                    
+                    self.condition.wait(wait)
+            finally:
+                self.condition.release()
+            
+            self.processnow(key, requests)
+    
+    def processnow(self, key, requests):
+        log.info("Processing %d coalesced background requests for %r", len(requests), key)
+        try:
+            action = self.process(key, requests)
+        except:
+            # NB: don't use suppressexceptions, as letting the exception through would kill the thread
+            log.exception("Background processing of %r failed", key)
+            return
+        
+        if action is not None:
+            self.post(action)
+
+"""
+Notifier for use on the background thread, which passes the notifications on to be shown
+from the UI thread instead.
+"""
+class BackgroundNotifier(object):
+    def __init__(self, dispatcher, notifier):
+        self.dispatcher = dispatcher
+        self.notifier = notifier
+    
+    def info(self, what):
+        self.dispatcher.post(lambda: self.notifier.info(what))
+    
+    def infoOnce(self, what):
+        self.dispatcher.post(lambda: self.notifier.infoOnce(what))
+    
+    def exception(self, text, exception_info=None):
+        # Must grab the exception now, as it won't be current by the time the UI gets to it
+        exception_info = exception_info or sys.exc_info()
+        self.dispatcher.post(lambda: self.notifier.exception(text, exception_info))
+
+"""
+Media manager for use on the background thread. It finds media using the real media manager,
+but only records what should be imported, as only the UI thread may touch the deck. The sounds
+are referred to by their path until then: see media.replacesounds. For the same reason, what
+has already been imported is decided by alreadyimported, which should come from calling the
+alreadyimportedsnapshot method of the real media manager on the UI thread.
+"""
+class DeferredMediaManager(object):
+    def __init__(self, mediamanager, alreadyimported):
+        self.mediamanager = mediamanager
+        self.deckalreadyimported = alreadyimported
+        self.imports = []
+    
+    def mediadir(self):
+        return self.mediamanager.mediadir()
+    
+    def discovermediapacks(self):
+        return self.mediamanager.discovermediapacks()
+    
+    def importtocurrentdeck(self, path):
+        return self.importmany([path])[0]
+    
+    def importmany(self, paths):
+        self.imports.extend([path for path in paths if path not in self.imports])
+        return paths
+    
+    def alreadyimported(self, path):
+        return path in self.imports or self.deckalreadyimported(path)
+    
+    def alreadyimportedsnapshot(self):
+        return self.alreadyimported
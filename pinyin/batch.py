@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+
+try:
+    import multiprocessing
+except ImportError:
+    # Only available from Python 2.6: we just update the facts in this process instead
+    multiprocessing = None
+
+import config
+import db
+from factproxy import isblankfield, unmarkgeneratedfield
+from logger import log
+import media
+import mocks
+import updater
+import utils
+
+
+"""
+Regenerates the fields of many facts in one go, e.g. the whole deck after a change to the
+configuration. The facts are processed in chunks:
+ 1) The distinct expressions in the chunk are looked up in the dictionary together, so facts
+    sharing an expression only cost one lookup
+ 2) Each fact is run through the FieldUpdater as if the user had just tabbed away from the field
+ 3) The chunk is handed to the commit function, which should write it back in a single transaction
+
+Progress is reported after every chunk, and we check for cancellation between facts. Facts
+updated before cancellation are still committed.
+"""
+class BatchUpdater(object):
+    def __init__(self, fieldupdater, chunksize=200):
+        self.fieldupdater = fieldupdater
+        self.chunksize = chunksize
+    
+    field = property(lambda self: self.fieldupdater.field)
+    graphbasedupdater = property(lambda self: self.fieldupdater.graphbasedupdater)
+    
+    """
+    Update all the facts that have the field of the FieldUpdater, returning the number of facts
+    updated. The optional arguments are:
+     * progress:  called with the number of facts done so far and the total
+     * cancelled: returns True if we should stop as soon as possible
+     * commit:    called with each list of updated facts
+    Any other keyword arguments are passed on to the FieldUpdater.
+    """
+    def updatefacts(self, facts, progress=None, cancelled=None, commit=None, **kwargs):
+        facts = [fact for fact in facts if self.field in fact]
+        progress = progress or (lambda done, total: None)
+        cancelled = cancelled or (lambda: False)
+        commit = commit or (lambda chunk: None)
+        
+        log.info("Batch updating the %s field of %d facts", self.field, len(facts))
+        progress(0, len(facts))
+        
+        done = 0
+        for chunk in chunks(facts, self.chunksize):
+            self.prefetch(chunk)
+            
+            updated = []
+            for fact in chunk:
+                if cancelled():
+                    break
+                
+                utils.suppressexceptions(lambda: self.fieldupdater.updatefact(fact, None, **kwargs))
+                updated.append(fact)
+            
+            commit(updated)
+            done += len(updated)
+            progress(done, len(facts))
+            
+            if len(updated) < len(chunk):
+                log.info("Batch update cancelled after %d of %d facts", done, len(facts))
+                break
+        
+        return done
+    
+    def prefetch(self, chunk):
+        # Nothing in the facts is changing, so the only fields that will be computed are the blank ones
+        fields = set()
+        for fact in chunk:
+            fields.update([field for field in fact if isblankfield(fact[field])])
+        
+        expressions = set()
+        for fact in chunk:
+            if "expression" in fact and not isblankfield(fact["expression"]):
+                expressions.add(unmarkgeneratedfield(fact["expression"]))
+        
+        self.graphbasedupdater.prefetch(sorted(expressions), fields)
+
+def chunks(things, size):
+    return [things[i:i + size] for i in range(0, len(things), size)]
+
+
+# The workers are forked from the process that wants the update, which we can only do where there is fork
+def canupdateinparallel():
+    return multiprocessing is not None and sys.platform != "win32"
+
+"""
+Regenerates facts without Anki, sharding them across a pool of worker processes so that we
+can use more than one core. Each worker loads the dictionaries once and gets its own read-only
+connection to the database.
+
+The workers can't touch the deck, so they send back a dictionary of the changed fields for each
+fact, along with the media files that should be imported for them. The parent process imports
+the media, applies the changes to the facts and hands each chunk to the commit function. The
+arguments of updatefacts are as for BatchUpdater, but the facts just have to behave like
+dictionaries from field key to value (e.g. a FactProxy).
+"""
+class ParallelBatchUpdater(object):
+    def __init__(self, field, mediamanager, config, processes=None, chunksize=200):
+        self.field = field
+        self.mediamanager = mediamanager
+        self.config = config
+        self.processes = processes
+        self.chunksize = chunksize
+    
+    def updatefacts(self, facts, progress=None, cancelled=None, commit=None, **kwargs):
+        facts = [fact for fact in facts if self.field in fact]
+        progress = progress or (lambda done, total: None)
+        cancelled = cancelled or (lambda: False)
+        commit = commit or (lambda chunk: None)
+        
+        log.info("Batch updating the %s field of %d facts in parallel", self.field, len(facts))
+        progress(0, len(facts))
+        
+        # Send plain dictionaries over to the workers, remembering where each one came from
+        snapshots = [(i, dict([(key, facts[i][key]) for key in facts[i]])) for i in range(0, len(facts))]
+        work = chunks(snapshots, self.chunksize)
+        initargs = (self.field, self.config.settings, self.mediamanager.mediadir(), self.alreadyimported())
+        
+        if multiprocessing is None or self.processes == 1:
+            initworker(*initargs)
+            pool, results = None, (updatechunk(chunk, kwargs) for chunk in work)
+        else:
+            pool = multiprocessing.Pool(self.processes, initworker, initargs)
+            results = pool.imap_unordered(updatechunkstar, [(chunk, kwargs) for chunk in work])
+        
+        done = 0
+        try:
+            for changes, imports in results:
+                self.apply(facts, changes, imports)
+                commit([facts[i] for i, _ in changes])
+                done += len(changes)
+                progress(done, len(facts))
+                
+                if cancelled():
+                    log.info("Parallel batch update cancelled after %d of %d facts", done, len(facts))
+                    break
+        finally:
+            if pool is not None:
+                pool.terminate()
+        
+        return done
+    
+    def alreadyimported(self):
+        # The workers can't ask the deck which pack files it already has, so we work it out for them
+        deckalreadyimported = self.mediamanager.alreadyimportedsnapshot()
+        alreadyimported = set()
+        for mediapack in self.mediamanager.discovermediapacks():
+            for filename in mediapack.media.values():
+                path = os.path.join(mediapack.packpath, filename)
+                if deckalreadyimported(path):
+                    alreadyimported.add(path)
+        
+        return alreadyimported
+    
+    def apply(self, facts, changes, imports):
+        # The workers refer to the media by its path in the pack: swap that for the name in the deck
+        imported = zip(imports, self.mediamanager.importmany(imports))
+        for i, fields in changes:
+            for key, value in fields.items():
+                facts[i][key] = media.replacesounds(value, imported)
+
+"""
+Stands in for the media manager in the worker processes: it finds media in the packs as
+usual, but only records what should be imported, for the parent process to deal with.
+"""
+class HeadlessMediaManager(object):
+    def __init__(self, mediadir, alreadyimported):
+        self.registry = media.MediaPackRegistry(mediadir)
+        self._mediadir = mediadir
+        self._alreadyimported = alreadyimported
+        self.imports = []
+    
+    def mediadir(self):
+        return self._mediadir
+    
+    def discovermediapacks(self):
+        return self.registry.discovermediapacks()
+    
+    def refreshmediapacks(self):
+        self.registry.refresh()
+    
+    def importtocurrentdeck(self, path):
+        return self.importmany([path])[0]
+    
+    def importmany(self, paths):
+        self.imports.extend([path for path in paths if path not in self.imports])
+        return paths
+    
+    def alreadyimported(self, path):
+        return path in self._alreadyimported or path in self.imports
+    
+    def alreadyimportedsnapshot(self):
+        return self.alreadyimported
+
+def fieldupdaterfor(field, *args):
+    if field == "expression":
+        return updater.FieldUpdaterFromExpression(*args)
+    else:
+        return updater.FieldUpdater(field, *args)
+
+# The state of a worker process, set up once by initworker
+worker = {}
+
+def initworker(field, settings, mediadir, alreadyimported):
+    # Only reconnect if we are really in a worker: the parent should keep its connection
+    if multiprocessing is not None and multiprocessing.current_process().name != "MainProcess":
+        db.reconnect(readonly=True)
+    
+    worker["mediamanager"] = HeadlessMediaManager(mediadir, alreadyimported)
+    worker["batchupdater"] = BatchUpdater(fieldupdaterfor(field, mocks.NullNotifier(), worker["mediamanager"], config.Config(settings)))
+
+def updatechunk(chunk, kwargs):
+    mediamanager = worker["mediamanager"]
+    mediamanager.imports = []
+    
+    originals = [fact for _, fact in chunk]
+    facts = [fact.copy() for fact in originals]
+    worker["batchupdater"].updatefacts(facts, **kwargs)
+    
+    changes = []
+    for (i, _), original, fact in zip(chunk, originals, facts):
+        changes.append((i, dict([(key, value) for key, value in fact.items() if original.get(key) != value])))
+    
+    return changes, mediamanager.imports
+
+# NB: imap only passes a single argument, and the function must be defined at the top level so it can be pickled
+def updatechunkstar(args):
+    return updatechunk(*args)
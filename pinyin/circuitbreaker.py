@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from logger import log
+
+
+def runinbackground(action):
+    thread = threading.Thread(target=action, name="Pinyin Toolkit circuit breaker probe")
+    # Don't keep the application alive just for us
+    thread.setDaemon(True)
+    thread.start()
+
+"""
+Keeps track of whether an online service seems to be working, so that we don't keep making the
+user wait for requests that are going to fail. The breaker starts closed, and requests are
+allowed. After failurethreshold failures in a row it opens, and requests are refused for
+opentime seconds. After that it is half-open: requests are still refused, but we call probe
+on a background thread to find out if the service is back. If the probe returns True the
+breaker closes again, and otherwise it stays open for another opentime seconds.
+
+Callers should check allowrequest before using the service, and report how they got on with
+success or failure. None of these ever wait for the probe.
+"""
+class CircuitBreaker(object):
+    def __init__(self, name, probe, failurethreshold=3, opentime=5 * 60, clock=time.time, runinbackground=runinbackground):
+        self.name = name
+        self.probe = probe
+        self.failurethreshold = failurethreshold
+        self.opentime = opentime
+        self.clock = clock
+        self.runinbackground = runinbackground
+        
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.openedat = None
+        
+        # For the metrics
+        self.timesopened = 0
+        self.probes = 0
+    
+    def allowrequest(self):
+        self.lock.acquire()
+        try:
+            if self.state == "open" and self.clock() - self.openedat >= self.opentime:
+                log.info("Probing %s in the background to see if it is working again", self.name)
+                self.state = "half-open"
+                self.probes += 1
+                probing = True
+            else:
+                probing = False
+            
+            allowed = self.state == "closed"
+        finally:
+            self.lock.release()
+        
+        # NB: start the probe without the lock held, in case it runs straight away
+        if probing:
+            self.runinbackground(self.runprobe)
+        
+        return allowed
+    
+    def success(self):
+        self.lock.acquire()
+        try:
+            if self.state != "closed":
+                log.info("%s is working again", self.name)
+            
+            self.state = "closed"
+            self.failures = 0
+        finally:
+            self.lock.release()
+    
+    def failure(self):
+        self.lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == "half-open" or (self.state == "closed" and self.failures >= self.failurethreshold):
+                log.info("%s has failed %d times in a row, so not using it for %d seconds", self.name, self.failures, self.opentime)
+                self.state = "open"
+                self.openedat = self.clock()
+                self.timesopened += 1
+        finally:
+            self.lock.release()
+    
+    def runprobe(self):
+        try:
+            working = self.probe()
+        except:
+            # NB: don't use suppressexceptions, as letting the exception through would kill the thread
+            log.exception("Probing %s failed", self.name)
+            working = False
+        
+        if working:
+            self.success()
+        else:
+            self.failure()
+    
+    def describe(self):
+        return "%s (%d failures in a row, opened %d times, %d probes)" % (self.state, self.failures, self.timesopened, self.probes)
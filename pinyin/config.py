@@ -4,6 +4,7 @@
 import copy
 
 import dictionaryonline
+import transformations
 import utils
 from logger import log
 
@@ -264,10 +265,6 @@ class Config(object):
         
         log.info("Initialized configuration with settings %s", settings)
         self.settings = settings
-        
-        # /Transient/ flag recording whether Google translate appears to be up. To begin
-        # with, we aren't sure
-        self.__googletranslateworking = None
     
     #
     # The pickle protocol (http://docs.python.org/library/pickle.html#pickle.Pickler)
@@ -287,7 +284,7 @@ class Config(object):
         # NB: we want to ensure that:
         # 1) Allow reading of the settings dictionary itself
         # 2) Look up the name on the class for consistency
-        # 3) Reading of transient data like __googletranslateworking goes to the instance
+        # 3) Reading of transient data like cachedpalette goes to the instance
         if "settings" in self.__dict__ and name in self.__dict__["settings"]:
             return self.__dict__["settings"][name]
         else:
@@ -312,6 +309,18 @@ class Config(object):
     meaningnumberingstrings = property(lambda self: meaningnumberingstringss[self.meaningnumbering])
     meaningseperatorstring = property(lambda self: meaningseperatorstrings.get(self.meaningseperator) or self.custommeaningseperator)
     
+    def getpalette(self):
+        # The palette is transient, and we rebuild it whenever the colors it was built from change
+        colors = tuple(self.tonecolors + self.extraquickaccesscolors)
+        palette = self.__dict__.get("cachedpalette")
+        if palette is None or palette.colors != colors:
+            palette = transformations.ColorPalette(colors)
+            object.__setattr__(self, "cachedpalette", palette)
+        
+        return palette
+    
+    palette = property(getpalette)
+    
     def meaningnumber(self, n):
         if self.meaningnumberingstrings is None:
             return ""
@@ -357,16 +366,12 @@ class Config(object):
         if not self.fallbackongoogletranslate:
             return False
 
-        # Determine the status of Google Translate if we haven't already done so.
-        # TODO: should try every 5 minutes or something rather than giving up on first failure.
-        if self.__googletranslateworking == None:
-            # Test internet connectivity by performing a gTrans call.
-            # If this call fails then translations are disabled until Anki is restarted.
-            # This prevents a several second delay from occuring when changing a field with no internet
-            self.__googletranslateworking = dictionaryonline.gCheck(self.dictlanguage)
-            log.info("Google Translate has tested internet access and reports status %s", self.__googletranslateworking)
-
-        # Only use it if it appears to be working
-        return self.__googletranslateworking
+        # Only use it if it appears to be working. If it has been failing then we leave it alone for a few
+        # minutes, rather than making the user wait every time they change a field, and then check in the
+        # background whether it is back. That check never holds up this call.
+        return dictionaryonline.breaker.allowrequest()
 
     shouldusegoogletranslate = property(getshouldusegoogletranslate)
+    
+    # Whether Google seems to be working, without the side effects of asking the breaker if we can use it
+    googletranslatestate = property(lambda self: dictionaryonline.breaker.state)
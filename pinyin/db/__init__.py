@@ -1,5 +1,8 @@
+import threading
+
 import cjklib.dbconnector
 import sqlalchemy
+import sqlalchemy.interfaces
 
 import pinyin.utils
 from pinyin.logger import log
@@ -8,3 +11,77 @@ from pinyin.logger import log
 dbpath = pinyin.utils.toolkitdir("pinyin", "db", "cjklib.db")
 
 database = pinyin.utils.Thunk(lambda: cjklib.dbconnector.getDBConnector({ "url" : sqlalchemy.engine.url.URL("sqlite", database=dbpath) }))
+
+"""
+Gives a process forked from one that was already using the database a connection of its own,
+since SQLite connections must not be shared between processes. If readonly is set, the new
+connections (including any made later on for other threads) refuse to make any changes.
+"""
+def reconnect(readonly=False):
+    connector = database()
+    
+    # NB: don't close the inherited connection, as that can release the locks of the parent
+    # process. Just keep hold of it so it never gets garbage collected, and use a fresh pool.
+    connector.inheritedconnection = connector.connection
+    connector.engine.pool = connector.engine.pool.recreate()
+    if readonly:
+        connector.engine.pool.add_listener(ReadOnlyListener())
+    
+    connector.connection = connector.engine.connect()
+
+"""
+Makes every connection the pool opens read-only. The sqlite3 module in Python 2 can't open
+a database with flags or a URI, and PRAGMA query_only is silently ignored by SQLite before
+3.8, so we install an authorizer instead, which SQLite has always had.
+"""
+class ReadOnlyListener(sqlalchemy.interfaces.PoolListener):
+    def connect(self, dbapiconnection, connectionrecord):
+        dbapiconnection.set_authorizer(readonlyauthorizer)
+
+# The action codes from sqlite3.h, which the sqlite3 module doesn't all have names for
+SQLITE_OK, SQLITE_DENY = 0, 1
+SQLITE_PRAGMA = 19
+readonlyactions = [
+    20, # SQLITE_READ
+    21, # SQLITE_SELECT
+    22, # SQLITE_TRANSACTION
+    31, # SQLITE_FUNCTION
+    33  # SQLITE_RECURSIVE
+  ]
+
+# The pragmas that just tell us about the schema, which SQLAlchemy needs for reflection
+readonlypragmas = ["table_info", "index_list", "index_info", "foreign_key_list", "database_list"]
+
+def readonlyauthorizer(action, arg1, arg2, dbname, source):
+    if action in readonlyactions or (action == SQLITE_PRAGMA and arg1.lower() in readonlypragmas):
+        return SQLITE_OK
+    else:
+        return SQLITE_DENY
+
+
+"""
+Stands in for the connection of the database connector, giving each thread a connection of its
+own from the engine, since SQLite connections can't be used from more than one thread. The
+thread that first made the connector keeps using the original connection.
+"""
+class ThreadLocalConnection(object):
+    def __init__(self, engine, connection):
+        self.engine = engine
+        self.local = threading.local()
+        self.local.connection = connection
+    
+    def __getattr__(self, name):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            log.info("Connecting to the database from the thread %s", threading.currentThread().getName())
+            connection = self.local.connection = self.engine.connect()
+        
+        return getattr(connection, name)
+
+"""
+Lets threads other than the one that made the connection use the database.
+"""
+def usethreadlocalconnections():
+    connector = database()
+    if not isinstance(connector.connection, ThreadLocalConnection):
+        connector.connection = ThreadLocalConnection(connector.engine, connector.connection)
@@ -7,7 +7,7 @@ import re
 
 import sqlalchemy
 
-from db import database
+from db import database, dbpath
 from logger import log
 from model import *
 import meanings
@@ -133,6 +133,12 @@ class PinyinDictionary(object):
         
         return inner
     
+    # Changes whenever the data that loadall would load does, such as when the user edits their dictionary
+    @classmethod
+    def version(cls):
+        filenames = [toolkitdir("pinyin", "dictionaries", dictname) for dictname in ['dict-userdict.txt', 'pinyin_toolkit_sydict.u8']] + [dbpath]
+        return tuple([os.path.exists(filename) and os.path.getmtime(filename) or None for filename in filenames])
+    
     def __init__(self, maxlenssources):
         maxlens, self.__sources = unzip(maxlenssources)
         self.__maxcharacterlen = max(maxlens)
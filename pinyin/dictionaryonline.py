@@ -1,16 +1,38 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import threading
 import urllib2
 import re
 
+try:
+    import json
+except ImportError:
+    # Only available from Python 2.6: we can parse everything ourselves, just more slowly
+    json = None
+
 from model import *
 from logger import log
+import circuitbreaker
+import httpclient
+import metrics
+import translationcache
 import utils
 
 # This module will takes a phrase and passes it to online services for translation
 # For now this modle provides support for google translate. In the future more dictionaries may be added.
 
+# Where we send translation requests, and the client we send them with. Keeping the connection
+# alive between requests saves a round trip (or several) for each one.
+translateurl = "http://translate.google.com/translate_a/t"
+client = httpclient.HTTPClient(timeout=10, maxresponsesize=256 * 1024)
+
+# Translations we have already done, which are remembered between sessions
+cache = utils.Thunk(lambda: translationcache.TranslationCache(utils.toolkitdir("pinyin", "db", "translations.db")))
+
+# Whether Google seems to be working. If not, we only try it every so often, with gCheck in the background
+breaker = circuitbreaker.CircuitBreaker("Google Translate", lambda: gCheck())
+metrics.registry.gauge("google translate", lambda: breaker.describe())
 
 # Translate the parsed text from Chinese into target language using google translate:
 def gTrans(query, destlanguage='en', prompterror=True):
@@ -27,27 +49,36 @@ def gTrans(query, destlanguage='en', prompterror=True):
 
     try:
         # Return the meanings (or lack of them) directly
-        return lookup(query, destlanguage)
+        return cachedlookup(query, destlanguage)
     except urllib2.URLError, e:
         # The only 'meaning' should be an error telling the user that there was some problem
         log.exception("Error while trying to obtain Google response")
         if prompterror:
-            return [[Word(Text('<span style="color:gray">[Internet Error]</span>'))]]
+            return errormeanings("Internet Error")
         else:
             return None
     except ValueError, e:
         # Not an internet problem
         log.exception("Error while interpreting translation response from Google")
         if prompterror:
-            return [[Word(Text('<span style="color:gray">[Error In Google Translate Response]</span>'))]]
+            return errormeanings("Error In Google Translate Response")
         else:
             return None
 
+# The only 'meaning' we give when something went wrong, telling the user what the problem was
+def errormeanings(message):
+    return [[Word(Text('<span style="color:gray">[%s]</span>' % message))]]
+
+# Whether some meanings returned by gTrans are just telling the user about an error
+def iserrormeanings(meanings):
+    return meanings in [errormeanings(message) for message in ["Internet Error", "Error In Google Translate Response"]]
+
 # This function will send a sample query to Google Translate and return true or false depending on success
-# It is used to determine connectivity for the Anki session (and thus whether Pinyin Toolkit should use online services or not)
+# It is used to find out if Google is working again after the breaker has stopped us using it
 def gCheck(destlanguage='en'):
     try:
-        lookup(u"好", destlanguage)
+        # NB: the breaker takes care of counting how the probe went
+        lookup(u"好", destlanguage, reporttobreaker=False)
         return True
     except urllib2.URLError:
         return False
@@ -55,29 +86,143 @@ def gCheck(destlanguage='en'):
         # Arguably could return True here, because it's not that the website is offline
         return False
 
+# Like lookup, but only goes online for things we haven't translated recently. Failures aren't cached, but
+# translations that just didn't find anything are. NB: gCheck must not use this, as it is testing the network!
+def cachedlookup(query, destlanguage):
+    found, meanings = cache.get(query, destlanguage)
+    if not found:
+        if not breaker.allowrequest():
+            # Don't make the user wait for something that is going to fail
+            raise urllib2.URLError("Google Translate doesn't seem to be working at the moment")
+        
+        meanings = cacheresult(query, destlanguage, lookup(query, destlanguage))
+    
+    return meanings and [[Word(Text(meaning))] for meaning in meanings] or None
+
+def cacheresult(query, destlanguage, result):
+    meanings = result and [flatten(meaning) for meaning in result] or None
+    cache.put(query, destlanguage, meanings)
+    return meanings
+
+"""
+Collects translation requests, e.g. from regenerating a whole deck, and sends them to Google
+together when flushed, so that they take a handful of requests rather than one per expression.
+Requests for the same thing are coalesced, and anything we have translated recently is skipped.
+The translations go into the cache, which is where gTrans will find them.
+"""
+class TranslationQueue(object):
+    def __init__(self, maxbatchsize=20, maxbatchlength=1500):
+        self.maxbatchsize = maxbatchsize
+        # The total length of the escaped queries in each request, so the URL doesn't get too long
+        self.maxbatchlength = maxbatchlength
+        
+        # Maps each destination language to the queries waiting to be translated into it
+        self.pending = {}
+        self.lock = threading.Lock()
+    
+    def request(self, query, destlanguage):
+        # NB: normalise the query in the same way as gTrans, or it won't find the translation
+        query = utils.striphtml(query)
+        if query.strip() == u"":
+            return
+        
+        self.lock.acquire()
+        try:
+            queries = self.pending.setdefault(destlanguage, [])
+            if query not in queries:
+                queries.append(query)
+        finally:
+            self.lock.release()
+    
+    def flush(self):
+        self.lock.acquire()
+        try:
+            pending, self.pending = self.pending, {}
+        finally:
+            self.lock.release()
+        
+        for destlanguage, queries in sorted(pending.items()):
+            queries = [query for query in queries if not cache.get(query, destlanguage)[0]]
+            for batch in self.batches(queries):
+                if not breaker.allowrequest():
+                    log.info("Not translating the remaining queries, as Google Translate doesn't seem to be working")
+                    return
+                
+                log.info("Translating a batch of %d queries into %s", len(batch), destlanguage)
+                try:
+                    results = len(batch) == 1 and [lookup(batch[0], destlanguage)] or lookupmany(batch, destlanguage)
+                except urllib2.URLError, e:
+                    # No point trying the rest if we can't get through: gTrans will report the problem
+                    log.exception("Error while trying to obtain Google response for a batch")
+                    return
+                except ValueError, e:
+                    # Leave these to be translated one at a time
+                    log.exception("Error while interpreting batched translation response from Google")
+                    continue
+                
+                for query, result in zip(batch, results):
+                    cacheresult(query, destlanguage, result)
+    
+    def batches(self, queries):
+        batches, batch, length = [], [], 0
+        for query in queries:
+            querylength = len(utils.urlescape(query))
+            if len(batch) > 0 and (len(batch) >= self.maxbatchsize or length + querylength > self.maxbatchlength):
+                batches.append(batch)
+                batch, length = [], 0
+            
+            batch.append(query)
+            length += querylength
+        
+        if len(batch) > 0:
+            batches.append(batch)
+        
+        return batches
+
+# The queue for the batch regeneration of the deck
+queue = TranslationQueue()
+
 # The lookup function is based on code from the Chinese Example Sentence Plugin by <aaron@lamelion.com>
-def lookup(query, destlanguage):
+def lookup(query, destlanguage, reporttobreaker=True):
     # Set up URL
-    url = "http://translate.google.com/translate_a/t?client=t&text=%s&sl=%s&tl=%s" % (utils.urlescape(query), 'zh-CN', destlanguage)
-    con = urllib2.Request(url, headers={'User-Agent':'Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11'}, origin_req_host='http://translate.google.com')
+    url = "%s?client=t&text=%s&sl=%s&tl=%s" % (translateurl, utils.urlescape(query), 'zh-CN', destlanguage)
     
-    # Open the connection
     log.info("Issuing Google query for %s to %s", query, url)
-    req = urllib2.urlopen(con)
+    return interpretresult(query, request(url, reporttobreaker))
+
+# Like lookup, but translates several queries with one request. Each query gets its own q parameter, and
+# Google sends back a list with a result for each of them, in the same order.
+def lookupmany(queries, destlanguage):
+    url = "%s?client=t&sl=%s&tl=%s&%s" % (translateurl, 'zh-CN', destlanguage, "&".join(["q=" + utils.urlescape(query) for query in queries]))
+    
+    log.info("Issuing batched Google query for %d queries to %s", len(queries), url)
+    results = request(url)
+    if not isinstance(results, list) or len(results) != len(queries):
+        raise ValueError("Expected a list of %d results from Google Translate but got %s" % (len(queries), repr(results)))
+    
+    return [interpretresult(query, result) for query, result in zip(queries, results)]
+
+def request(url, reporttobreaker=True):
+    # Issue the request, getting the result literal back in one go. NB: only network problems count against Google
+    try:
+        literal = client.get(url, headers={'User-Agent':'Mozilla/5.0 (X11; U; Linux i686) Gecko/20071127 Firefox/2.0.0.11'}).decode('utf-8')
+    except urllib2.URLError:
+        if reporttobreaker:
+            breaker.failure()
+        raise
+    
+    if reporttobreaker:
+        breaker.success()
     
-    # Build the result literal from the request
-    literal = u""
-    for line in req:
-        literal += line.decode('utf-8')
-        
     # Parse the response:
     try:
         log.info("Parsing response %r from Google", literal)
-        result = parsegoogleresponse(literal)
+        return parsegoogleresponse(literal)
     except ValueError, e:
         # Give the exception a more precise error message for debugging
         raise ValueError("Error while parsing translation response from Google: %s" % str(e))
-    
+
+def interpretresult(query, result):
     # What sort of result did we get?
     if isinstance(result, basestring):
         if result == query:
@@ -131,119 +276,138 @@ def lookup(query, destlanguage):
         # Haven't seen any other case in the wild
         raise ValueError("Couldn't deal with the correctly-parsed response %s from Google" % str(result))
 
+"""
+Parses the kinds of strings we get back from Google Translate. They are almost JSON, but Google
+is sloppy: lists can have missing items (as in [1,,2], which we read as [1,None,2]), lists and
+dictionaries can have trailing commas, dictionary keys can be numbers and strings can contain
+\\x escapes. We can deal with:
+ * String literals (with escaping) of the form "foo\\tbar", possibly containing Unicode
+ * Numeric literals (integers may come back as ints or longs, which compare equal)
+ * true, false and null
+ * List literals
+ * Dictionary literals
+
+Responses that are strictly JSON are handed to the json module where we have it (Python 2.6 and
+later), as that is quicker still. Anything else goes through a single pass over the tokens: we
+keep a stack of the lists and dictionaries we are inside, and never slice or copy the response,
+so parsing takes time linear in its length.
+"""
 def parsegoogleresponse(response):
-    # This code is basically a hand-rolled (and rather specialised) LL parser
-    # for the kinds of strings we get back from Google Translate. We can deal with:
-    #  * String literals (with escaping) of the form "foo\tbar", possibly containing Unicode
-    #  * Numeric literals (returned as longs)
-    #  * List literals
-    #  * Dictionary literals
-    
-    itemseperatorregex = re.compile('\\s*,')
-    listendregex = re.compile('\\s*\\]')
-    kvpseperatorregex = re.compile('\\s*:')
-    dictendregex = re.compile('\\s*\\}')
-    
-    def literaltoken(match, what):
-        return match, what
-    
-    def stringtoken(match, what):
-        # Remove escape characters from the captured string with eval - nasty!
-        string = eval(u'u"%s"' % match.group(1))
-        return string, what
-    
-    def numbertoken(match, what):
-        return long(match.group(0)), what
+    if json is not None:
+        try:
+            return json.loads(response)
+        except ValueError:
+            # Not strict JSON, so it needs the more forgiving treatment
+            pass
     
-    def listtoken(match, what):
-        thelist = []
-        while True:
-            # Process this list item
-            item, what = expraction(what)
-            thelist.append(item)
-            
-            # End of item - must be followed by a comma or closing bracket
-            whataftercomma = makemunchaction(itemseperatorregex)(what)
-            if whataftercomma is None:
-                # End of list: continue after the closing bracket
-                return thelist, unfailing("the end of a list", makemunchaction(listendregex))(what)
+    # What we expect next, and the containers we are inside along with what we expected in them
+    state, container, key, stack = googletop, None, None, []
+    position = 0
+    for match in googletokenregex.finditer(response):
+        if match.start() != position:
+            break
+        
+        position = match.end()
+        string, punctuation, number, keyword = match.groups()
+        if state == googleend:
+            raise ValueError("Unexpected trailing characters %s" % repr(response[match.start():]))
+        elif string is not None:
+            if u"\\" in string:
+                string = googleescaperegex.sub(unescape, string)
+            value = unicode(string)
+        elif number is not None:
+            if u"." in number or u"e" in number or u"E" in number:
+                value = float(number)
             else:
-                # Comma: expect another item, so continue after the comma
-                what = whataftercomma
-    
-    def dicttoken(match, what):
-        thedict = {}
-        while True:
-            # Process this dict key/value pair
-            key, what = expraction(what)
-            _, what = unfailing("a dictionary key-value pair seperator", makeparseaction(kvpseperatorregex, literaltoken))(what)
-            value, what = expraction(what)
-            thedict[key] = value
+                value = long(number)
+        elif keyword is not None:
+            value = googlekeywords[keyword]
+        elif punctuation == u'[' or punctuation == u'{':
+            # NB: lists and dictionaries can't be dictionary keys, as they aren't hashable
+            if state != googleitem and state != googlevalue and state != googletop:
+                raise googleerror(response, match.start(), state)
             
-            # End of item - must be followed by a comma or closing bracket
-            whataftercomma = makemunchaction(itemseperatorregex)(what)
-            if whataftercomma is None:
-                # End of dict: continue after the closing brace
-                return thedict, unfailing("the end of a dictionary", makemunchaction(dictendregex))(what)
+            stack.append((state, container, key))
+            if punctuation == u'[':
+                state, container = googleitem, []
             else:
-                # Comma: expect another item, so continue after the comma
-                what = whataftercomma
-    
-    # Utility to consume from the string using the regex and return the new string if successful
-    makemunchaction = lambda regex: makeparseaction(regex, lambda match, what: what)
-
-    def makeparseaction(regex, processor):
-        def inner(what):
-            match = regex.match(what)
-        
-            # Run processor if the regular expression matches
-            if match:
-                return processor(match, what[match.end():])
+                state, container = googlekey, {}
+            continue
+        elif punctuation == u']' or punctuation == u'}':
+            # We also get here after a trailing comma
+            if (punctuation == u']' and state != googleitem and state != googleafteritem) or \
+               (punctuation == u'}' and state != googlekey and state != googleaftervalue):
+                raise googleerror(response, match.start(), state)
+            
+            value = container
+            state, container, key = stack.pop()
+        elif punctuation == u',':
+            if state == googleitem:
+                # A comma straight after the bracket or another comma is a missing item
+                container.append(None)
+            elif state == googleafteritem:
+                state = googleitem
+            elif state == googleaftervalue:
+                state = googlekey
             else:
-                return None
+                raise googleerror(response, match.start(), state)
+            continue
+        else:
+            if state != googlecolon:
+                raise googleerror(response, match.start(), state)
+            
+            state = googlevalue
+            continue
         
-        return inner
+        # We have a complete value, so put it where it belongs
+        if state == googleitem:
+            container.append(value)
+            state = googleafteritem
+        elif state == googlekey:
+            key = value
+            state = googlecolon
+        elif state == googlevalue:
+            container[key] = value
+            state = googleaftervalue
+        elif state == googletop:
+            result = value
+            state = googleend
+        else:
+            raise googleerror(response, match.start(), state)
     
-    def makechoiceaction(actions):
-        def inner(what):
-            # Match processors from top to bottom
-            for action in actions:
-                result = action(what)
-                if result:
-                    return result
+    if response[position:].strip() != u"":
+        raise ValueError("Couldn't parse %s at position %d when expecting a token" % (repr(response[position:position + 20]), position))
+    elif state != googleend:
+        raise googleerror(response, len(response), state)
+    
+    return result
 
-            return None
-        
-        return inner
+# Each token is a string literal, a bit of punctuation, a number or a keyword, after any whitespace.
+# NB: the string alternative is unrolled so that it can't backtrack exponentially on an unterminated string
+googletokenregex = re.compile(r'\s*(?:"([^\\"]*(?:\\.[^\\"]*)*)"|([\[\]{},:])|(-?[0-9]+(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?)|(true|false|null))', re.DOTALL)
+googleescaperegex = re.compile(r'\\(u[0-9a-fA-F]{4}|x[0-9a-fA-F]{2}|.)', re.DOTALL)
+googleescapes = { u'"' : u'"', u"\\" : u"\\", u"/" : u"/", u"b" : u"\b", u"f" : u"\f", u"n" : u"\n", u"r" : u"\r", u"t" : u"\t" }
+googlekeywords = { u"true" : True, u"false" : False, u"null" : None }
 
-    def unfailing(text, action):
-        def inner(what):
-            result = action(what)
-            if result is None:
-                raise ValueError("Couldn't parse %s when expecting %s" % (repr(what), text))
-            else:
-                return result
-            
-        return inner
-
-    # Action table keyed off regular expressions.  Matched top to bottom against
-    # the current string, with the corresponding token handler fired if the regex
-    # can deal with it.
-    stringaction = makeparseaction(re.compile('"((?:[^\\\\"]|\\\\.)*)"'), stringtoken)
-    intaction = makeparseaction(re.compile('-?[0-9]+'), numbertoken)
-    listaction = makeparseaction(re.compile('\\['), listtoken)
-    dictaction = makeparseaction(re.compile('\\{'), dicttoken)
-    
-    # Parse loop using the action table
-    whitespacetoken = lambda match, what: expraction(what)
-    expraction = unfailing("an expression", makechoiceaction([stringaction, intaction, listaction, dictaction, makeparseaction(re.compile('\\s+'), whitespacetoken)]))
-    
-    # Use the constructed action table to parse the supplied string
-    value, rest = expraction(response)
-    if len(rest) != 0:
-        raise ValueError("Unexpected trailing characters %s" % repr(rest))
+# The states of the parser, i.e. what it expects next
+googletop, googleitem, googleafteritem, googlekey, googlecolon, googlevalue, googleaftervalue, googleend = range(0, 8)
+googleexpecting = ["an expression", "a list item or the end of a list", "the end of a list", "a dictionary key or the end of a dictionary",
+                   "a dictionary key-value pair seperator", "a dictionary value", "the end of a dictionary", "the end of the response"]
+
+def googleerror(response, position, state):
+    if position >= len(response):
+        return ValueError("Couldn't parse the end of the response when expecting %s" % googleexpecting[state])
+    else:
+        return ValueError("Couldn't parse %s at position %d when expecting %s" % (repr(response[position:position + 20]), position, googleexpecting[state]))
+
+def unescape(match):
+    escape = match.group(1)
+    if escape[0] in u"ux" and len(escape) > 1:
+        return unichr(int(escape[1:], 16))
+    elif escape in googleescapes:
+        return googleescapes[escape]
     else:
-        return value
+        raise ValueError("Unknown escape sequence \\%s in a string from Google" % escape)
 
 
 ################################################################################
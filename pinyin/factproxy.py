@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import re
+
 from pinyin.logger import log
 
 """
@@ -71,26 +73,38 @@ def chooseField(candidateFieldNames, targetkeys):
 prefixgeneratedmarker = u'<a name="pinyin-toolkit"></a>'
 postfixgeneratedmarker = u'<a name="pinyin-toolkit"></a>\u200d' # Need some trailing character to prevent QWebKit normalising the empty <a> away. See http://en.wikipedia.org/wiki/Space_(punctuation)
 
+# The prefix marker may also carry a stamp identifying the inputs and configuration the field was generated
+# from, e.g. <a name="pinyin-toolkit-1a2b3c4d"></a>, so we can tell when regenerating it would be pointless.
+# It is kept in the name so that the marker has exactly the same shape as it did without a stamp.
+stampedgeneratedmarker = u'<a name="pinyin-toolkit-%s"></a>'
+prefixgeneratedmarkerregex = re.compile(u'<a name="pinyin-toolkit(?:-([0-9a-f]+))?"></a>')
+
 def isblankfield(value):
     return len(value.strip()) == 0
 
 def isgeneratedfield(key, value):
-    return key == "weblinks" or value.startswith(prefixgeneratedmarker) or value.endswith(postfixgeneratedmarker)
+    return key == "weblinks" or prefixgeneratedmarkerregex.match(value) is not None or value.endswith(postfixgeneratedmarker)
 
 def unmarkgeneratedfield(value):
     # NB: do NOT lstrip regardless of startswith, because lstrip even removes characters
     # if we have a partial match of the string - I had a bug where I was stripping leading
     # angle brackets out of fields containing HTML! Furthermore, lstrip attempts to strip
     # the string it is given SEVERAL times.
-    if value.startswith(prefixgeneratedmarker):
-        return value[len(prefixgeneratedmarker):]
+    match = prefixgeneratedmarkerregex.match(value)
+    if match is not None:
+        return value[match.end():]
     elif value.endswith(postfixgeneratedmarker):
         return value[:-len(postfixgeneratedmarker)]
     else:
         return value
 
-def markgeneratedfield(value):
-    return prefixgeneratedmarker + value
+def markgeneratedfield(value, stamp=None):
+    return (stamp and (stampedgeneratedmarker % stamp) or prefixgeneratedmarker) + value
+
+# The stamp recorded in the marker of a generated field, or None if it doesn't have one
+def generatedfieldstamp(value):
+    match = prefixgeneratedmarkerregex.match(value)
+    return match and match.group(1) or None
 
 def unmarkhtmlgeneratedfields(html):
-    return html.replace(prefixgeneratedmarker, "")
+    return prefixgeneratedmarkerregex.sub(u"", html)
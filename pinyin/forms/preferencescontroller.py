@@ -209,6 +209,7 @@ class PreferencesController(object):
     
     def installMandarinSounds(self):
         pinyin.media.downloadAndInstallMandarinSounds(self.notifier, self.mediamanager, self.model)
+        self.mediamanager.refreshmediapacks()
         self.updateAudioPacksList()
     
     def openAudioPackDirectory(self):
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import httplib
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+
+from logger import log
+
+
+"""
+A minimal HTTP client for the online services, which keeps connections to each server alive
+between requests rather than paying for a new connection (and TCP slow start) every time.
+
+Failures are reported in the same way as urllib2: network problems raise a URLError, and
+responses with an unsuccessful status raise an HTTPError. Responses longer than the size limit
+raise a ValueError rather than being read into memory. If the user has set up a proxy, we go
+through urllib2 instead, as that is what knows how to deal with it.
+"""
+class HTTPClient(object):
+    def __init__(self, timeout=10, maxresponsesize=1024 * 1024, maxidle=60, clock=time.time):
+        self.timeout = timeout
+        self.maxresponsesize = maxresponsesize
+        self.maxidle = maxidle
+        self.clock = clock
+        
+        # Maps each (host, port) to a list of (connection, time it was last used) for the idle connections
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.connectionsopened = 0
+    
+    def get(self, url, headers={}):
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if scheme != "http" or urllib.getproxies().get("http"):
+            return self.geturllib2(url, headers)
+        
+        host, port = urllib.splitport(netloc)
+        server = (host, int(port or httplib.HTTP_PORT))
+        selector = path + (query and "?" + query or "")
+        
+        connection, reused = self.checkout(server)
+        try:
+            try:
+                response = self.request(connection, selector, headers)
+            except (socket.error, httplib.HTTPException), e:
+                connection.close()
+                if not reused:
+                    raise
+                
+                # The server may have timed out the kept-alive connection while it was idle: try a fresh one
+                log.info("Kept-alive connection to %s:%d failed (%s), so reconnecting", server[0], server[1], e)
+                connection, reused = self.connect(server), False
+                response = self.request(connection, selector, headers)
+            
+            body = self.read(connection, response)
+        except (socket.error, httplib.HTTPException), e:
+            connection.close()
+            raise urllib2.URLError(e)
+        
+        if response.will_close:
+            connection.close()
+        else:
+            self.checkin(server, connection)
+        
+        if response.status != 200:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.msg, None)
+        
+        return body
+    
+    def request(self, connection, selector, headers):
+        connection.request("GET", selector, headers=headers)
+        return connection.getresponse()
+    
+    def read(self, connection, response):
+        # Read one byte more than we are prepared to accept, so we can tell if the response is too big
+        body = response.read(self.maxresponsesize + 1)
+        if len(body) > self.maxresponsesize:
+            # We can't reuse the connection without reading the rest of the response
+            connection.close()
+            raise ValueError("The response was larger than the limit of %d bytes" % self.maxresponsesize)
+        
+        return body
+    
+    def geturllib2(self, url, headers):
+        request = urllib2.Request(url, headers=headers)
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except TypeError:
+            # Python 2.5 and earlier don't support the timeout argument
+            response = urllib2.urlopen(request)
+        
+        try:
+            body = response.read(self.maxresponsesize + 1)
+        finally:
+            response.close()
+        
+        if len(body) > self.maxresponsesize:
+            raise ValueError("The response was larger than the limit of %d bytes" % self.maxresponsesize)
+        
+        return body
+    
+    def checkout(self, server):
+        now = self.clock()
+        self.lock.acquire()
+        try:
+            connections = self.idle.get(server, [])
+            while len(connections) > 0:
+                connection, lastused = connections.pop()
+                if now - lastused <= self.maxidle:
+                    return connection, True
+                
+                connection.close()
+        finally:
+            self.lock.release()
+        
+        return self.connect(server), False
+    
+    def checkin(self, server, connection):
+        self.lock.acquire()
+        try:
+            self.idle.setdefault(server, []).append((connection, self.clock()))
+        finally:
+            self.lock.release()
+    
+    def connect(self, server):
+        log.info("Opening a new connection to %s:%d", server[0], server[1])
+        self.connectionsopened += 1
+        try:
+            return httplib.HTTPConnection(server[0], server[1], timeout=self.timeout)
+        except TypeError:
+            # Python 2.5 and earlier don't support the timeout argument
+            return httplib.HTTPConnection(server[0], server[1])
+    
+    def close(self):
+        self.lock.acquire()
+        try:
+            for connections in self.idle.values():
+                for connection, _ in connections:
+                    connection.close()
+            
+            self.idle = {}
+        finally:
+            self.lock.release()
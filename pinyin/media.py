@@ -101,6 +101,9 @@ class MediaPack(object):
         
         # Normalize capitalisation for ease of lookup
         self.media = dict([(name.lower(), filename) for name, filename in media.items()])
+        
+        # Syllable indexes, built on demand for each list of audio extensions
+        self.syllableindexes = {}
     
     def __str__(self):
         return self.name
@@ -140,6 +143,62 @@ class MediaPack(object):
         # No suitable media existed!
         return None
     
+    """
+    Finds the media for a syllable of pinyin with the given spoken tone, or None if the pack
+    doesn't have any. We look in order for:
+     * The numeric form, such as ma3
+     * If the tone is 5, the bare syllable (ma) or the 4th tone (ma4) to deal with lack of 'xx5's
+     * Otherwise, versions where ü is written as v or u: (nv3, nu:3), as is typical in filenames
+    Within each of those we prefer audio extensions that come earlier in the list.
+    """
+    def mediaforsyllable(self, word, spoken, audioextensions):
+        return self.syllableindex(audioextensions).get((word.lower(), spoken))
+    
+    def syllableindex(self, audioextensions):
+        key = tuple(audioextensions)
+        if key not in self.syllableindexes:
+            self.syllableindexes[key] = self.buildsyllableindex(audioextensions)
+        
+        return self.syllableindexes[key]
+    
+    def buildsyllableindex(self, audioextensions):
+        # Work backwards from each file to the syllables that might use it, ranking each candidate
+        # by the position of the name in the order of preference above and then by its extension
+        candidates = {}
+        def consider(word, spoken, rank, filename):
+            if (word, spoken) not in candidates or rank < candidates[(word, spoken)][0]:
+                candidates[(word, spoken)] = (rank, filename)
+        
+        for extensionrank, extension in enumerate(audioextensions):
+            extension = extension.lower()
+            for name, filename in self.media.items():
+                if isinstance(name, str):
+                    # Byte string names can only ever be found by syllables if they are plain ASCII
+                    try:
+                        name = unicode(name)
+                    except UnicodeDecodeError:
+                        continue
+                
+                if not name.endswith(extension):
+                    continue
+                
+                base = name[:-len(extension)]
+                if not base[-1:].isdigit():
+                    consider(base, 5, (1, extensionrank), filename)
+                    continue
+                
+                word, spoken = base[:-1], int(base[-1])
+                consider(word, spoken, (0, extensionrank), filename)
+                if spoken == 4:
+                    consider(word, 5, (2, extensionrank), filename)
+                
+                if spoken != 5:
+                    for substitutionrank, substitution in [(1, u"v"), (2, u"u:")]:
+                        if substitution in word and u"ü" not in word:
+                            consider(word.replace(substitution, u"ü"), spoken, (substitutionrank, extensionrank), filename)
+        
+        return dict([(key, filename) for key, (_rank, filename) in candidates.items()])
+    
     @classmethod
     def frompath(cls, packpath):
         media = {}
@@ -149,6 +208,76 @@ class MediaPack(object):
         log.info("Discovered %d media files in the pack at %s", len(media), packpath)
         return MediaPack(packpath, media)
 
+"""
+Keeps track of the media packs installed in a media directory. Parsing a pack means listing every
+file in it, which is slow for big packs, so parsed packs are kept around and a pack is only rescanned
+when the modification time of its directory changes (i.e. a file was added, removed or renamed).
+The listing of the media directory itself is cached in the same way.
+
+Use refresh to throw everything away, e.g. after installing a new pack.
+"""
+class MediaPackRegistry(object):
+    def __init__(self, mediadir):
+        self.mediadir = mediadir
+        self.refresh()
+    
+    def refresh(self):
+        log.info("Forgetting all known media packs in %s", self.mediadir)
+        self.packpaths = None
+        self.packpathsmtime = None
+        self.packs = {}
+    
+    def discovermediapacks(self):
+        return [self.mediapack(packpath) for packpath in self.discoverpackpaths()]
+    
+    def discoverpackpaths(self):
+        mtime = os.path.getmtime(self.mediadir)
+        if self.packpaths is not None and mtime == self.packpathsmtime:
+            return self.packpaths
+        
+        packpaths = []
+        for packname in os.listdir(self.mediadir):
+            # Skip the download cache directory
+            if packname.lower() == "downloads":
+                continue
+            
+            # Only try and process directories as packs:
+            packpath = os.path.join(self.mediadir, packname)
+            if os.path.isdir(packpath):
+                log.info("Considering %s as a media pack", packname)
+                packpaths.append(packpath)
+            else:
+                log.info("Ignoring the file %s in the media directory", packname)
+        
+        # Forget about any packs that have since been removed
+        for packpath in self.packs.keys():
+            if packpath not in packpaths:
+                del self.packs[packpath]
+        
+        self.packpaths, self.packpathsmtime = packpaths, mtime
+        return packpaths
+    
+    def mediapack(self, packpath):
+        mtime = os.path.getmtime(packpath)
+        if packpath in self.packs:
+            packmtime, pack = self.packs[packpath]
+            if packmtime == mtime:
+                return pack
+            
+            log.info("The media pack at %s has changed since it was last scanned", packpath)
+        
+        pack = MediaPack.frompath(packpath)
+        self.packs[packpath] = (mtime, pack)
+        return pack
+
+# Media managers that can't import into the deck straight away refer to sounds by their path in the pack
+# instead. Once the files have been imported, use this to swap those paths for the names in the deck.
+def replacesounds(value, imported):
+    for path, filename in imported:
+        value = value.replace(u"[sound:%s]" % path, u"[sound:%s]" % filename)
+    
+    return value
+
 # Use to discover files in the media directory that are not referenced in the media
 # database. If this is true, the user has just copied them in - and we consider
 # such things "legacy" sounds that should be replaced with a true media pack.
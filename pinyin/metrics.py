@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from logger import log
+
+
+"""
+Timing statistics for one kind of operation. The call and failure counts and the total time
+are exact, but we only keep the most recent samples around for computing percentiles, so
+that the memory use doesn't grow over a long session. Calls can be recorded from any thread.
+"""
+class Metric(object):
+    def __init__(self, maxsamples=1000):
+        self.maxsamples = maxsamples
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.calls = 0
+            self.failures = 0
+            self.totaltime = 0.0
+            self.maxtime = 0.0
+            
+            # A ring buffer of the most recent call durations
+            self.samples = []
+            self.nextsample = 0
+        finally:
+            self.lock.release()
+    
+    def record(self, seconds, failed=False):
+        self.lock.acquire()
+        try:
+            self.calls += 1
+            self.failures += failed and 1 or 0
+            self.totaltime += seconds
+            self.maxtime = max(self.maxtime, seconds)
+            
+            if len(self.samples) < self.maxsamples:
+                self.samples.append(seconds)
+            else:
+                self.samples[self.nextsample] = seconds
+                self.nextsample = (self.nextsample + 1) % self.maxsamples
+        finally:
+            self.lock.release()
+    
+    def percentile(self, percent):
+        self.lock.acquire()
+        try:
+            ordered = sorted(self.samples)
+        finally:
+            self.lock.release()
+        
+        if len(ordered) == 0:
+            return None
+        
+        # Nearest rank method
+        rank = max(1, int(round(percent / 100.0 * len(ordered))))
+        return ordered[min(rank, len(ordered)) - 1]
+
+"""
+Collects Metrics by name for the whole session, e.g. the time spent in each updater function.
+Use timed to wrap a function so that every call is recorded against some names. Anything else
+worth reporting, like whether an online service is working, can be registered as a gauge: a
+function describing its current state.
+
+Only exceptions count as failures: plenty of functions return None when they have nothing to say.
+"""
+class MetricsRegistry(object):
+    def __init__(self):
+        # NB: the updaters are timed on the background thread as well as the UI thread
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.gauges = {}
+    
+    def clear(self):
+        # NB: reset the existing metrics rather than forgetting them, as timed functions hold on to them
+        for _, metric in self.sorteditems(self.metrics):
+            metric.reset()
+    
+    def metric(self, name):
+        self.lock.acquire()
+        try:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = Metric()
+            
+            return metric
+        finally:
+            self.lock.release()
+    
+    def gauge(self, name, describe):
+        self.lock.acquire()
+        try:
+            self.gauges[name] = describe
+        finally:
+            self.lock.release()
+    
+    # A sorted copy of the items of one of the dictionaries, so the caller can go over it without the lock
+    def sorteditems(self, dictionary):
+        self.lock.acquire()
+        try:
+            return sorted(dictionary.items())
+        finally:
+            self.lock.release()
+    
+    def timed(self, names, function):
+        # Look the metrics up now rather than on every call
+        metrics = [self.metric(name) for name in names]
+        
+        def go(*args):
+            started, failed = time.time(), True
+            try:
+                result = function(*args)
+                failed = False
+                return result
+            finally:
+                elapsed = time.time() - started
+                for metric in metrics:
+                    metric.record(elapsed, failed)
+        
+        go.__name__ = function.__name__
+        return go
+    
+    def report(self):
+        lines = ["%-40s %7s %7s %9s %9s %9s %9s" % ("", "calls", "failed", "total ms", "median ms", "90% ms", "max ms")]
+        for name, metric in self.sorteditems(self.metrics):
+            if metric.calls == 0:
+                continue
+            
+            lines.append("%-40s %7d %7d %9.1f %9.1f %9.1f %9.1f" % (name, metric.calls, metric.failures, metric.totaltime * 1000,
+                                                                    metric.percentile(50) * 1000, metric.percentile(90) * 1000, metric.maxtime * 1000))
+        
+        for name, describe in self.sorteditems(self.gauges):
+            lines.append("%-40s %s" % (name, describe()))
+        
+        return "\n".join(lines)
+    
+    def dumptolog(self):
+        log.info("Performance statistics for this session:\n%s", self.report())
+
+# The registry for the whole session
+registry = MetricsRegistry()
@@ -44,8 +44,17 @@ class MockMediaManager(object):
     def discovermediapacks(self):
         return self._mediapacks
     
+    def refreshmediapacks(self):
+        pass
+    
     def importtocurrentdeck(self, filename):
         return filename
     
+    def importmany(self, filenames):
+        return [self.importtocurrentdeck(filename) for filename in filenames]
+    
     def alreadyimported(self, path):
-        return path in self._alreadyimported
\ No newline at end of file
+        return path in self._alreadyimported
+    
+    def alreadyimportedsnapshot(self):
+        return self.alreadyimported
\ No newline at end of file
@@ -160,7 +160,7 @@ class Pinyin(object):
             return self.word + str(getattr(self.toneinfo, tone))
     
     def tonifiedformat(self):
-        return PinyinTonifier().tonify(self.numericformat(hideneutraltone=False))
+        return tonifier.tonifysyllable(self.word, self.toneinfo.written)
 
     """
     Constructs a Pinyin object from text representing a single character and numeric tone mark
@@ -171,6 +171,23 @@ class Pinyin(object):
     """
     @classmethod
     def parse(cls, text, forcenumeric=False):
+        pinyin = cls.tryparse(text, forcenumeric=forcenumeric)
+        if pinyin is None:
+            log.info("Couldn't parse %s as pinyin", text)
+            raise ValueError(u"The proposed pinyin '%s' doesn't look like pinyin after all" % text)
+        
+        return pinyin
+    
+    """
+    As parse, but returns None rather than raising an exception if the text isn't pinyin.
+    This is the version to use when most of the input is expected to be English, since
+    building and throwing an exception for every word is expensive.
+    
+    >>> print Pinyin.tryparse("hello")
+    None
+    """
+    @classmethod
+    def tryparse(cls, text, forcenumeric=False):
         # Normalise u: and v: into umlauted version:
         # NB: might think about doing lower() here, as some dictionary words have upper case (e.g. proper names)
         text = substituteForUUmlaut(text)
@@ -178,7 +195,7 @@ class Pinyin(object):
         # Length check (yes, you can get 7 character pinyin, such as zhuang1.
         # If the u had an umlaut then it would be 8 'characters' to Python)
         if len(text) < 2 or len(text) > 8:
-            raise ValueError(u"The text '%s' was not the right length to be Pinyin - should be in the range 2 to 7 characters" % text)
+            return None
         
         # Does it look like we have a non-tonified string?
         if text[-1].isdigit():
@@ -187,7 +204,7 @@ class Pinyin(object):
             word = text[:-1]
         elif forcenumeric:
             # Whoops. Should have been numeric but wasn't!
-            raise ValueError(u"No tone mark present on purportely-numeric pinyin '%s'" % text)
+            return None
         else:
             # Seperate combining marks (NFD = Normal Form Decomposed) so it
             # is easy to spot the combining marks
@@ -199,7 +216,7 @@ class Pinyin(object):
                 if tonecombiningmark != "" and tonecombiningmark in text:
                     # Two marks on the same string is an error
                     if toneinfo != None:
-                        raise ValueError(u"Too many combining tone marks on the input pinyin '%s'" % text)
+                        return None
                     
                     # Record the corresponding tone and remove the combining mark
                     toneinfo = ToneInfo(written=n+1)
@@ -214,8 +231,7 @@ class Pinyin(object):
         
         # Sanity check to catch English/French/whatever that doesn't look like pinyin
         if word.lower() not in cls.validpinyin():
-            log.info("Couldn't find %s in the valid pinyin list", word)
-            raise ValueError(u"The proposed pinyin '%s' doesn't look like pinyin after all" % text)
+            return None
         
         # We now have a word and tone info, whichever route we took
         return Pinyin(word, toneinfo)
@@ -280,47 +296,182 @@ def tokenizespaceseperatedtext(text):
 def tokenizeone(possible_token, forcenumeric=False):
     # Sometimes the pinyin field in CEDICT contains english (e.g. in the pinyin for 'T shirt')
     # so we better handle that by returning it as a Text token.
-    try:
-        return Pinyin.parse(possible_token, forcenumeric=forcenumeric)
-    except ValueError:
-        return Text(possible_token)
+    return Pinyin.tryparse(possible_token, forcenumeric=forcenumeric) or Text(possible_token)
 
-def tokenizeonewitherhua(possible_token, forcenumeric=False):
-    # The intention here is that if we fail to parse something as pinyin
-    # which has an 'r' suffix, then we'll try again without it:
+"""
+Finite automaton recognising the pinyin syllable inventory, used to split run-on
+pinyin such as "ni3hao3" or "xiexie" into its component syllables.
+"""
+class PinyinSegmenter(object):
+    def __init__(self, syllables):
+        # The automaton is a trie over the (lower case, ü-normalised) syllables: state 0 is
+        # the start state, and a state is accepting if a whole syllable ends there
+        self.transitions = [{}]
+        self.accepting = [False]
+        for syllable in syllables:
+            state = 0
+            for char in syllable:
+                nextstate = self.transitions[state].get(char)
+                if nextstate is None:
+                    nextstate = len(self.transitions)
+                    self.transitions[state][char] = nextstate
+                    self.transitions.append({})
+                    self.accepting.append(False)
+                
+                state = nextstate
+            
+            self.accepting[state] = True
+        
+        # The decomposition of each character we have seen so far, as it is relatively costly
+        self.unitcache = {}
     
-    # TODO: be much smarter about parsing erhua. They can appear *inside* the pinyin too!
+    """
+    Splits the text into a list of Pinyin tokens, or returns None if that can't be done.
+    We prefer segmentations using the fewest syllables, so "xian" is one syllable, not two.
     
-    # First attempt: parse as vanilla pinyin
-    try:
-        return [Pinyin.parse(possible_token, forcenumeric=forcenumeric)]
-    except ValueError:
-        pass
+    >>> segmenter().segment(u"nihao3", False)
+    [Pinyin(u'ni', ToneInfo(written=5, spoken=5)), Pinyin(u'hao', ToneInfo(written=3, spoken=3))]
+    """
+    def segment(self, text, forcenumeric):
+        # Numeric pinyin must contain a tone number somewhere, and it's cheap to rule out English early
+        if forcenumeric and not re.search(u"[0-9]", text):
+            return None
+        
+        chars, marks, digits = self.units(substituteForUUmlaut(text))
+        n = len(chars)
+        
+        # best[i] holds (syllable count, start of the last syllable, last syllable Pinyin) for
+        # the best way we have found of segmenting the first i units. Each position is only
+        # scanned once, and the scan is bounded by the longest syllable, so this is linear.
+        best = [None] * (n + 1)
+        best[0] = (0, None, None)
+        for i in range(0, n):
+            if best[i] is None or digits[i] is not None:
+                continue
+            
+            state, tone = 0, None
+            for j in range(i, n):
+                if digits[j] is not None or marks[j] == -1:
+                    break
+                
+                state = self.transitions[state].get(chars[j].lower())
+                if state is None:
+                    break
+                
+                if marks[j] is not None:
+                    if tone is not None:
+                        # Two combining tone marks in one syllable
+                        break
+                    tone = marks[j]
+                
+                if not self.accepting[state]:
+                    continue
+                
+                # If a tone number follows the syllable then we must consume it
+                end, word = j + 1, u"".join(chars[i:j + 1])
+                if end < n and digits[end] is not None:
+                    if tone is not None:
+                        continue
+                    end, syllabletone, explicit, numeric = end + 1, digits[end], True, True
+                else:
+                    syllabletone, explicit, numeric = tone or 5, tone is not None, False
+                
+                previouslength = i != 0 and i - best[i][1] or 0
+                if not self.allowed(word, syllabletone, explicit, numeric, previouslength, i == 0 and end == n, forcenumeric):
+                    continue
+                
+                if best[end] is None or best[i][0] + 1 < best[end][0]:
+                    best[end] = (best[i][0] + 1, i, Pinyin(word, syllabletone))
+        
+        if best[n] is None or n == 0:
+            return None
+        
+        # Walk the back pointers to recover the syllables
+        syllables, i = [], n
+        while i != 0:
+            _, i, syllable = best[i]
+            syllables.append(syllable)
+        
+        syllables.reverse()
+        
+        # Plenty of English words (like "time" or "banana") can be spelt as toneless pinyin syllables, so we
+        # only split a run into several syllables if it has a tone somewhere. Whether it does doesn't depend
+        # on how we split it up, so we can check that here rather than while segmenting.
+        toned = [mark for mark in marks if mark is not None] or [digit for digit in digits if digit is not None]
+        if not toned and len([syllable for syllable in syllables if not syllable.iser]) > 1:
+            return None
+        
+        return syllables
+    
+    def units(self, text):
+        # Break the text into base characters with the tone marks (if any) stripped off, and
+        # note down the tone mark (-1 if there were several) or tone number at each position
+        chars, marks, digits = [], [], []
+        for char in text:
+            unit = self.unitcache.get(char)
+            if unit is None:
+                unit = self.unitcache[char] = self.unit(char)
+            
+            chars.append(unit[0])
+            marks.append(unit[1])
+            digits.append(unit[2])
+        
+        return chars, marks, digits
+    
+    def unit(self, char):
+        if char in u"0123456789":
+            return (char, None, int(char))
+        
+        decomposed = unicodedata.normalize('NFD', char)
+        tones = [n + 1 for n, tonecombiningmark in enumerate(tonecombiningmarks) if tonecombiningmark != "" and tonecombiningmark in decomposed]
+        for tonecombiningmark in tonecombiningmarks:
+            if tonecombiningmark != "":
+                decomposed = decomposed.replace(tonecombiningmark, "")
+        
+        if len(tones) == 0:
+            mark = None
+        elif len(tones) == 1:
+            mark = tones[0]
+        else:
+            mark = -1
         
-    if possible_token.lower().endswith("r"):
-        # We might be able to parse as erhua
-        try:
-            return [Pinyin.parse(possible_token[:-1], forcenumeric=forcenumeric),
-                    Pinyin(possible_token[-1], 5)]
-        except ValueError:
-            pass
+        return (unicodedata.normalize('NFC', decomposed), mark, None)
     
-    # Nope, we're just going to have to fail :(
-    return [Text(possible_token)]
+    def allowed(self, word, tone, explicit, numeric, previouslength, iswhole, forcenumeric):
+        # A lone syllable must be at least as long as Pinyin.parse demands
+        if iswhole and len(word) + (numeric and 1 or 0) < 2:
+            return False
+        
+        if word.lower() == u"r":
+            # Only allow the erhua suffix if it is attached to something that would be pinyin by itself,
+            # so that e.g. "Mr" stays as text
+            return tone == 5 and previouslength >= 2
+        
+        if forcenumeric and not numeric:
+            return False
+        
+        # Syllables beginning with a vowel need an apostrophe to be split off from the one before
+        # (as in Xi'an). Without a tone to show us where the boundary is, we also don't accept them
+        # to start a run-on group, or English like "one" turns into "o ne".
+        if not iswhole and not explicit and word[0].lower() in u"aoe":
+            return False
+        
+        return True
+
+segmenter = utils.Thunk(lambda: PinyinSegmenter(Pinyin.validpinyin()))
 
 def tokenizetext(text, forcenumeric):
-    # To recognise pinyin amongst the rest of the text, for now just look for maximal
-    # sequences of alphanumeric characters as defined by Unicode. This should catch
-    # the pinyin, its tone marks, tone numbers (if any) and allow umlauts.
+    # To recognise pinyin amongst the rest of the text, look for maximal sequences of
+    # alphanumeric characters as defined by Unicode. This should catch the pinyin, its tone
+    # marks, tone numbers (if any) and allow umlauts. Each such run is then split into syllables
+    # by the segmenter, which also takes care of erhua and run-on pinyin like "ni3hao3".
     tokens = []
     for recognised, match in utils.regexparse(re.compile(u"(\w|:)+", re.UNICODE), text):
         if recognised:
-            tokens.extend(tokenizeonewitherhua(match.group(0), forcenumeric=forcenumeric))
+            tokens.extend(segmenter().segment(match.group(0), forcenumeric) or [Text(match.group(0))])
         else:
             tokens.append(Text(match))
     
-    # TODO: could be much smarter about segmentation here. For example, we could use the
-    # pinyin regex to split up run on groups of pinyin-like characters.
     return tokens
 
 """
@@ -540,6 +691,18 @@ class FormatReadingForDisplayVisitor(TokenVisitor):
         self.insidequotes = False
     
     def visitText(self, text):
+        return maybeSpace(self.needsspacebeforetext(text)) + [text]
+    
+    def visitPinyin(self, pinyin):
+        return maybeSpace(self.needsspacebeforepinyin(pinyin.iser)) + [pinyin]
+    
+    def visitTonedCharacter(self, tonedcharacter):
+        # Treat characters like normal text
+        return self.visitText(tonedcharacter)
+    
+    # The spacing decisions are exposed seperately from the visitor methods so that other
+    # representations of the reading (see tokenbuffer) can share them
+    def needsspacebeforetext(self, text):
         # Functions for computing intermediate results to do with quoting
         isambiguousopenquote, isambiguousclosequote = (lambda insidequotes, c: not insidequotes and utils.isambiguousquotechar(c), lambda insidequotes, c: insidequotes and utils.isambiguousquotechar(c))
         togglequotes = lambda extratext: self.insidequotes ^ (len(filter(utils.isambiguousquotechar, extratext)) % 2 == 1)
@@ -562,19 +725,15 @@ class FormatReadingForDisplayVisitor(TokenVisitor):
         self.haveprecedingpinyin = False
         self.insidequotes = togglequotes(text)
         
-        return maybeSpace(needleadingspace) + [text]
+        return needleadingspace
     
-    def visitPinyin(self, pinyin):
+    def needsspacebeforepinyin(self, iser):
         # Being an erhua better not be significant for spacing purposes if we directly follow text, rather than pinyin
-        needleadingspace = not self.haveprecedingspace and not (pinyin.iser and self.haveprecedingpinyin)
+        needleadingspace = not self.haveprecedingspace and not (iser and self.haveprecedingpinyin)
         self.haveprecedingspace = False
         self.haveprecedingpinyin = True
         
-        return maybeSpace(needleadingspace) + [pinyin]
-    
-    def visitTonedCharacter(self, tonedcharacter):
-        # Treat characters like normal text
-        return self.visitText(tonedcharacter)
+        return needleadingspace
 
 """
 Attempts to invert formatreadingfordisplay. For use when recovering
@@ -672,18 +831,33 @@ class PinyinTonifier(object):
     # The pinyin tone mark placement rules come from http://www.pinyin.info/rules/where.html
     
     # map (final) constanant+tone to tone+constanant
-    constTone2ToneConst = {
-        u'([nNrR])([1234])'  : ur'\g<2>\g<1>',
-        u'([nN][gG])([1234])': ur'\g<2>\g<1>'
-    }
+    constTone2ToneConst = [
+        (re.compile(u'([nNrR])([1234])'),  ur'\g<2>\g<1>'),
+        (re.compile(u'([nN][gG])([1234])'), ur'\g<2>\g<1>')
+    ]
 
     #
     # map vowel+vowel+tone to vowel+tone+vowel
-    vowelVowelTone2VowelToneVowel = {
-        u'([aA])([iIoO])([1234])' : ur'\g<1>\g<3>\g<2>',
-        u'([eE])([iI])([1234])'   : ur'\g<1>\g<3>\g<2>',
-        u'([oO])([uU])([1234])'   : ur'\g<1>\g<3>\g<2>'
-    }
+    vowelVowelTone2VowelToneVowel = [
+        (re.compile(u'([aA])([iIoO])([1234])'), ur'\g<1>\g<3>\g<2>'),
+        (re.compile(u'([eE])([iI])([1234])'),   ur'\g<1>\g<3>\g<2>'),
+        (re.compile(u'([oO])([uU])([1234])'),   ur'\g<1>\g<3>\g<2>')
+    ]
+    
+    # Table mapping (syllable, tone) to the tonified syllable for every syllable we know about, in both
+    # lower case and capitalized forms (CEDICT capitalizes proper names). NB: delay-loaded for the same
+    # reason as Pinyin.validpinyin
+    tonifiedsyllables = utils.Thunk(lambda: PinyinTonifier.buildtonifiedsyllables(Pinyin.validpinyin()))
+    
+    @classmethod
+    def buildtonifiedsyllables(cls, syllables):
+        table = {}
+        for syllable in syllables:
+            for variant in set([syllable, syllable.capitalize()]):
+                for tone in range(1, 6):
+                    table[(variant, tone)] = cls().tonify(variant + unicode(tone))
+        
+        return table
 
     """
     Convert pinyin text with tone numbers to pinyin with diacritical marks
@@ -700,13 +874,13 @@ class PinyinTonifier(object):
         assert type(line)==unicode
         
         # First transform: commute tone numbers over finals containing only constants
-        for (x,y) in self.constTone2ToneConst.items():
-            line = re.sub(x, y, line)
+        for (x,y) in self.constTone2ToneConst:
+            line = x.sub(y, line)
 
         # Second transform: for runs of two vowels with a following tone mark, move
         # the tone mark so it occurs directly afterwards the first vowel
-        for (x,y) in self.vowelVowelTone2VowelToneVowel.items():
-            line = re.sub(x, y, line)
+        for (x,y) in self.vowelVowelTone2VowelToneVowel:
+            line = x.sub(y, line)
 
         # Third transform: map tones to the Unicode equivalent
         for (x,y) in enumerate(tonecombiningmarks):
@@ -715,3 +889,34 @@ class PinyinTonifier(object):
         # Turn combining marks into real characters - saves us doing this in all the test (Python
         # unicode string comparison does not appear to normalise!! Very bad!)
         return unicodedata.normalize('NFC', line)
+
+    """
+    Tonify a single syllable with a numeric tone, consulting the precomputed table and
+    only falling back on the rules above if we don't recognise the syllable.
+    
+    >>> PinyinTonifier().tonifysyllable(u"xiao", 3)
+    u"xiǎo"
+    """
+    def tonifysyllable(self, word, tone):
+        tonified = self.tonifiedsyllables().get((word, tone))
+        if tonified is None:
+            tonified = self.tonify(unicode(word) + unicode(tone))
+        
+        return tonified
+
+    """
+    Tonify a whole sequence of (syllable, tone) pairs in one go, such as those making up a reading.
+    """
+    def tonify_many(self, syllablestones):
+        table, tonified = self.tonifiedsyllables(), []
+        for word, tone in syllablestones:
+            result = table.get((word, tone))
+            if result is None:
+                result = self.tonify(unicode(word) + unicode(tone))
+            
+            tonified.append(result)
+        
+        return tonified
+
+# Shared instance: the tonifier is stateless, so there is no need to build one per token
+tonifier = PinyinTonifier()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlalchemy
+
+from db import database
+from logger import log
+import utils
+
+
+# The CharacterVariant types for the variants we convert to
+varianttypes = { "simp" : "S", "trad" : "T" }
+
+"""
+Converts expressions between simplified and traditional characters without going online.
+
+Most characters have just one variant of the other kind, so we map them one at a time. Some
+simplified characters stand for several traditional ones, though (发 is 發 in 发现 but 髮 in 头发),
+and a few traditional characters have several simplified forms. For those characters we use the
+variant that turns up most often in the dictionary headwords, and keep a table of the phrases
+that this gets wrong. When converting, the longest phrase in that table wins.
+
+The variants are (character, variant, type) rows as in the CharacterVariant table, where the type
+is S for a simplified variant and T for a traditional one. The phrases are (simplified,
+traditional) pairs, such as the dictionary headwords.
+"""
+class SimpTradConverter(object):
+    def __init__(self, variants, phrases):
+        # Maps each character to the list of its variants of each kind
+        candidates = { "simp" : {}, "trad" : {} }
+        for character, variant, varianttype in variants:
+            for charmode, thisvarianttype in varianttypes.items():
+                if varianttype == thisvarianttype:
+                    candidates[charmode].setdefault(character, []).append(variant)
+        
+        phrases = [(simp, trad) for simp, trad in phrases if len(simp) == len(trad)]
+        self.characters = {}
+        self.phrases = {}
+        self.maxphraselength = {}
+        for charmode in ["simp", "trad"]:
+            self.characters[charmode] = choosevariants(candidates[charmode], [charmode == "simp" and (trad, simp) or (simp, trad) for simp, trad in phrases])
+            self.phrases[charmode] = {}
+            self.maxphraselength[charmode] = 1
+        
+        # Maps each (mode, multi-character phrase) to what it converts to, or None if the phrases disagree
+        targets = {}
+        for simp, trad in phrases:
+            if len(simp) < 2:
+                continue
+            
+            for charmode, source, target in [("simp", trad, simp), ("trad", simp, trad)]:
+                if targets.setdefault((charmode, source), target) != target:
+                    # The dictionary can't make its mind up, so we can't do better than the characters
+                    targets[(charmode, source)] = None
+        
+        # Only the phrases that the character map gets wrong need to be remembered
+        for (charmode, source), target in targets.items():
+            if target is not None and self.convertcharacters(source, charmode) != target:
+                self.phrases[charmode][source] = target
+                self.maxphraselength[charmode] = max(self.maxphraselength[charmode], len(source))
+        
+        # The characters that start an overridden phrase, so we don't look for phrases everywhere
+        self.phrasestarts = dict([(charmode, set([source[0] for source in self.phrases[charmode]])) for charmode in ["simp", "trad"]])
+        log.info("Simplified/traditional conversion knows %d simplified and %d traditional overrides", len(self.phrases["simp"]), len(self.phrases["trad"]))
+    
+    def simptrad(self, expression):
+        return { "simp" : self.convert(expression, "simp"), "trad" : self.convert(expression, "trad") }
+    
+    def convert(self, expression, charmode):
+        characters, phrases, phrasestarts = self.characters[charmode], self.phrases[charmode], self.phrasestarts[charmode]
+        
+        result = []
+        i = 0
+        while i < len(expression):
+            if expression[i] in phrasestarts:
+                for length in range(min(self.maxphraselength[charmode], len(expression) - i), 1, -1):
+                    phrase = phrases.get(expression[i:i + length])
+                    if phrase is not None:
+                        result.append(phrase)
+                        i += length
+                        break
+                else:
+                    result.append(characters.get(expression[i], expression[i]))
+                    i += 1
+            else:
+                result.append(characters.get(expression[i], expression[i]))
+                i += 1
+        
+        return u"".join(result)
+    
+    def convertcharacters(self, expression, charmode):
+        characters = self.characters[charmode]
+        return u"".join([characters.get(character, character) for character in expression])
+
+def choosevariants(candidates, phrases):
+    # Count how often each variant is used for each character in the phrases, as (source, target) pairs
+    usage = {}
+    for source, target in phrases:
+        for sourcecharacter, targetcharacter in zip(source, target):
+            if len(candidates.get(sourcecharacter, [])) > 1:
+                usage[(sourcecharacter, targetcharacter)] = usage.get((sourcecharacter, targetcharacter), 0) + 1
+    
+    # Prefer the variant used most, then the character itself (e.g. 台 is a traditional character as well as a simplified one)
+    chosen = {}
+    for character, variants in candidates.items():
+        chosen[character] = max([(usage.get((character, variant), 0), variant == character, -ord(variant[0]), variant) for variant in variants])[-1]
+    
+    return chosen
+
+"""
+Loads the converter from the variant data in the database, with the phrases from CEDICT. If the
+database doesn't have the variant data (e.g. it was built by an old version of the toolkit),
+returns None, and we have to convert online instead.
+"""
+def databaseconverter():
+    log.info("Loading simplified/traditional variants from the database")
+    try:
+        varianttable = sqlalchemy.Table("CharacterVariant", database.metadata, autoload=True)
+        dicttable = sqlalchemy.Table("CEDICT", database.metadata, autoload=True)
+    except sqlalchemy.exc.NoSuchTableError, e:
+        log.warn("The database has no %s table, so simplified/traditional conversion will have to go online", e)
+        return None
+    
+    variants = database.selectRows(sqlalchemy.select([varianttable.c.ChineseCharacter, varianttable.c.Variant, varianttable.c.Type],
+                                                     varianttable.c.Type.in_(varianttypes.values())))
+    phrases = database.selectRows(sqlalchemy.select([dicttable.c.HeadwordSimplified, dicttable.c.HeadwordTraditional]))
+    return SimpTradConverter(variants, phrases)
+
+# The converter for the session, loaded when we first need it
+converter = utils.Thunk(databaseconverter)
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from testutils import *
+
+from pinyin.background import *
+from pinyin.media import replacesounds
+from pinyin.mocks import *
+
+
+class TestBackgroundDispatcher(object):
+    def setup(self):
+        self.now = 100.0
+        self.processed = []
+        self.dispatcher = BackgroundDispatcher(self.process, delay=0.5, clock=lambda: self.now)
+    
+    def process(self, key, requests):
+        self.processed.append((key, requests))
+        return lambda: self.processed.append(("applied", key))
+    
+    def testNothingPending(self):
+        assert_equal(self.dispatcher.takedue(), (None, None, None))
+    
+    def testWaitsForDelay(self):
+        self.dispatcher.submit(1, "a")
+        self.now += 0.25
+        assert_equal(self.dispatcher.takedue(), (None, None, 0.25))
+        
+        self.now += 0.25
+        assert_equal(self.dispatcher.takedue(), (1, ["a"], None))
+        assert_equal(self.dispatcher.takedue(), (None, None, None))
+    
+    def testCoalescesRequestsAndPushesDeadlineBack(self):
+        self.dispatcher.submit(1, "a")
+        self.now += 0.4
+        self.dispatcher.submit(1, "b")
+        self.now += 0.4
+        assert_equal(self.dispatcher.takedue()[1], None)
+        
+        self.now += 0.1
+        assert_equal(self.dispatcher.takedue(), (1, ["a", "b"], None))
+    
+    def testResubmittedRequestsGoFirst(self):
+        self.dispatcher.submit(1, "c")
+        self.now += 0.4
+        self.dispatcher.resubmit(1, ["a", "b"])
+        self.now += 0.4
+        assert_equal(self.dispatcher.takedue()[1], None)
+        
+        self.now += 0.1
+        assert_equal(self.dispatcher.takedue(), (1, ["a", "b", "c"], None))
+    
+    def testKeysAreSeparate(self):
+        self.dispatcher.submit(1, "a")
+        self.now += 0.1
+        self.dispatcher.submit(2, "b")
+        self.now += 0.6
+        assert_equal(self.dispatcher.takedue()[0:2], (1, ["a"]))
+        assert_equal(self.dispatcher.takedue()[0:2], (2, ["b"]))
+    
+    def testResultsOnlyAppliedWhenAsked(self):
+        self.dispatcher.processnow(1, ["a"])
+        assert_equal(self.processed, [(1, ["a"])])
+        
+        self.dispatcher.applyresults()
+        assert_equal(self.processed, [(1, ["a"]), ("applied", 1)])
+    
+    def testNoResult(self):
+        self.dispatcher.process = lambda key, requests: None
+        self.dispatcher.processnow(1, ["a"])
+        assert_true(self.dispatcher.results.empty())
+    
+    def testFailedProcessingIsLogged(self):
+        self.dispatcher.process = lambda key, requests: 1 / 0
+        self.dispatcher.processnow(1, ["a"])
+        assert_true(self.dispatcher.results.empty())
+    
+    def testBackgroundThread(self):
+        finished = threading.Event()
+        def process(key, requests):
+            finished.set()
+            return lambda: self.processed.append((key, requests, threading.currentThread().getName()))
+        
+        dispatcher = BackgroundDispatcher(process, delay=0.01)
+        dispatcher.start()
+        try:
+            dispatcher.submit(1, "a")
+            dispatcher.submit(1, "b")
+            finished.wait(5)
+        finally:
+            dispatcher.stop()
+        
+        dispatcher.thread.join(5)
+        assert_false(dispatcher.thread.isAlive())
+        
+        dispatcher.applyresults()
+        assert_equal(self.processed, [(1, ["a", "b"], threading.currentThread().getName())])
+
+class TestBackgroundNotifier(object):
+    def testNotificationsDeferredToUI(self):
+        dispatcher, notifier = BackgroundDispatcher(None), MockNotifier()
+        backgroundnotifier = BackgroundNotifier(dispatcher, notifier)
+        backgroundnotifier.info("Hello")
+        backgroundnotifier.infoOnce("World")
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            backgroundnotifier.exception("Oops")
+        
+        assert_equal(notifier.infos, [])
+        dispatcher.applyresults()
+        assert_equal(notifier.infos, ["Hello", "World"])
+        assert_equal(notifier.exceptions[0][0], "Oops")
+        assert_equal(notifier.exceptions[0][1][0], ZeroDivisionError)
+
+class TestDeferredMediaManager(object):
+    def testImportsDeferred(self):
+        mockmediamanager = MockMediaManager([], alreadyimported=["a.mp3"])
+        mediamanager = DeferredMediaManager(mockmediamanager, mockmediamanager.alreadyimportedsnapshot())
+        assert_equal(mediamanager.importmany(["b.mp3", "c.mp3"]), ["b.mp3", "c.mp3"])
+        assert_equal(mediamanager.importtocurrentdeck("b.mp3"), "b.mp3")
+        assert_equal(mediamanager.imports, ["b.mp3", "c.mp3"])
+        assert_true(mediamanager.alreadyimported("a.mp3"))
+        assert_true(mediamanager.alreadyimported("c.mp3"))
+        assert_false(mediamanager.alreadyimported("d.mp3"))
+        assert_true(mediamanager.alreadyimportedsnapshot()("c.mp3"))
+    
+    def testReplaceSounds(self):
+        assert_equal(replacesounds(u"[sound:Pack/ma1.mp3][sound:Pack/hao3.mp3]", [("Pack/ma1.mp3", "ma1.mp3")]), u"[sound:ma1.mp3][sound:Pack/hao3.mp3]")
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from testutils import *
+
+from pinyin.circuitbreaker import CircuitBreaker
+import pinyin.config
+from pinyin.batch import *
+import pinyin.batch
+import pinyin.dictionaryonline
+from pinyin.factproxy import markgeneratedfield
+from pinyin.media import MediaPack
+from pinyin.mocks import *
+from pinyin.tests.fakegoogle import FakeGoogleServer
+from pinyin.translationcache import TranslationCache
+import pinyin.utils
+from pinyin.updatergraph import GraphBasedUpdater
+
+
+class TestBatchUpdater(object):
+    def testUpdatesFactsWithField(self):
+        fieldupdater = MockFieldUpdater()
+        facts = [{ "expression" : u"书" }, { "reading" : u"shu1" }, { "expression" : u"好" }]
+        
+        assert_equal(BatchUpdater(fieldupdater).updatefacts(facts, alwaysreformat=True), 2)
+        assert_equal(fieldupdater.updated, [(u"书", True), (u"好", True)])
+    
+    def testChunksAndProgress(self):
+        commits, progresses = [], []
+        facts = [{ "expression" : unicode(i) } for i in range(0, 5)]
+        
+        BatchUpdater(MockFieldUpdater(), chunksize=2).updatefacts(facts, progress=lambda done, total: progresses.append((done, total)),
+                                                                  commit=lambda chunk: commits.append([fact["expression"] for fact in chunk]))
+        assert_equal(commits, [[u"0", u"1"], [u"2", u"3"], [u"4"]])
+        assert_equal(progresses, [(0, 5), (2, 5), (4, 5), (5, 5)])
+    
+    def testCancellation(self):
+        fieldupdater, commits = MockFieldUpdater(), []
+        facts = [{ "expression" : unicode(i) } for i in range(0, 5)]
+        
+        done = BatchUpdater(fieldupdater, chunksize=2).updatefacts(facts, cancelled=lambda: len(fieldupdater.updated) >= 3,
+                                                                    commit=lambda chunk: commits.append(len(chunk)))
+        assert_equal(done, 3)
+        assert_equal(commits, [2, 1])
+    
+    def testPrefetchesDistinctExpressionsForBlankFields(self):
+        fieldupdater = MockFieldUpdater()
+        facts = [
+            { "expression" : u"书", "reading" : u"" },
+            { "expression" : markgeneratedfield(u"书"), "meaning" : markgeneratedfield(u"book") },
+            { "expression" : u" ", "color" : u"" },
+            { "expression" : u"好" }
+          ]
+        
+        BatchUpdater(fieldupdater).updatefacts(facts)
+        assert_equal(fieldupdater.graphbasedupdater.prefetched, [([u"书", u"好"], set(["expression", "reading", "color"]))])
+    
+    def testPrefetchOnlyLooksUpWhatBlankFieldsNeed(self):
+        lookups = []
+        gbu = GraphBasedUpdater(MockNotifier(), MockMediaManager([]), pinyin.config.Config({ "dictlanguage" : "en" }))
+        gbu.updaters = [
+            ("dictreading", lambda expression: lookups.append(("dictreading", expression)), ("expression",)),
+            ("dictmws", lambda expression: lookups.append(("dictmws", expression)), ("expression",)),
+            ("reading", lambda dictreading: None, ("dictreading",)),
+            ("weblinks", lambda expression: lookups.append(("weblinks", expression)), ("expression",))
+          ]
+        
+        gbu.prefetch([u"书", u"好"], set(["reading", "weblinks"]))
+        assert_equal(lookups, [("dictreading", u"书"), ("dictreading", u"好")])
+
+class TestParallelBatchUpdater(object):
+    def testInProcess(self):
+        self.assertMatchesBatchUpdater(1)
+    
+    def testWorkerProcesses(self):
+        self.assertMatchesBatchUpdater(2)
+    
+    def testHeadlessMediaManager(self):
+        mediamanager = HeadlessMediaManager("dummy_dir", set(["a.mp3"]))
+        assert_equal(mediamanager.importmany(["b.mp3", "c.mp3"]), ["b.mp3", "c.mp3"])
+        assert_equal(mediamanager.importtocurrentdeck("b.mp3"), "b.mp3")
+        assert_equal(mediamanager.imports, ["b.mp3", "c.mp3"])
+        assert_true(mediamanager.alreadyimported("a.mp3"))
+        assert_true(mediamanager.alreadyimported("c.mp3"))
+        assert_false(mediamanager.alreadyimported("d.mp3"))
+        assert_true(mediamanager.alreadyimportedsnapshot()("c.mp3"))
+    
+    def assertMatchesBatchUpdater(self, processes):
+        def do(mediadir):
+            packpath = os.path.join(mediadir, "Pack")
+            os.mkdir(packpath)
+            for name in ["ma1.mp3", "hao3.mp3"]:
+                pinyin.utils.touch(os.path.join(packpath, name))
+            
+            theconfig = pinyin.config.Config({ "dictlanguage" : "en", "audioextensions" : [".mp3"] })
+            makefacts = lambda: [{ "reading" : reading, "audio" : u"" } for reading in [u"ma1", u"hao3 ma1", u"hen3"] * 3] + [{ "expression" : u"书" }]
+            
+            # What we get by updating the facts in this process
+            expected = makefacts()
+            mediamanager = MockMediaManager([MediaPack.frompath(packpath)], mediadir=mediadir)
+            BatchUpdater(pinyin.batch.fieldupdaterfor("reading", MockNotifier(), mediamanager, theconfig)).updatefacts(expected)
+            
+            commits, progresses = [], []
+            actual = makefacts()
+            done = ParallelBatchUpdater("reading", mediamanager, theconfig, processes=processes, chunksize=4).updatefacts(actual,
+                      progress=lambda done, total: progresses.append(done), commit=lambda chunk: commits.append(len(chunk)))
+            
+            assert_equal(actual, expected)
+            assert_equal(done, 9)
+            assert_equal(sorted(commits), [1, 4, 4])
+            assert_equal(progresses[0], 0)
+            assert_equal(progresses[-1], 9)
+        
+        pinyin.utils.withtempdir(do)
+
+class MockFieldUpdater(object):
+    field = "expression"
+    
+    def __init__(self):
+        self.graphbasedupdater = MockGraphBasedUpdater()
+        self.updated = []
+    
+    def updatefact(self, fact, value, alwaysreformat=False):
+        assert value is None
+        self.updated.append((fact["expression"], alwaysreformat))
+
+class MockGraphBasedUpdater(object):
+    def __init__(self):
+        self.prefetched = []
+    
+    def prefetch(self, expressions, fields):
+        self.prefetched.append((expressions, fields))
+
+class TestBatchTranslation(object):
+    def setup(self):
+        self.server = FakeGoogleServer({ (u"测验一", "en") : u"Test one", (u"测验二", "en") : u"Test two" }).start()
+        self.oldtranslateurl = pinyin.dictionaryonline.translateurl
+        pinyin.dictionaryonline.translateurl = self.server.url
+        self.oldcache = pinyin.dictionaryonline.cache
+        pinyin.dictionaryonline.cache = TranslationCache(":memory:")
+        self.oldbreaker = pinyin.dictionaryonline.breaker
+        pinyin.dictionaryonline.breaker = CircuitBreaker("Fake Google", pinyin.dictionaryonline.gCheck)
+    
+    def teardown(self):
+        pinyin.dictionaryonline.breaker = self.oldbreaker
+        pinyin.dictionaryonline.cache.close()
+        pinyin.dictionaryonline.cache = self.oldcache
+        pinyin.dictionaryonline.translateurl = self.oldtranslateurl
+        pinyin.dictionaryonline.client.close()
+        self.server.stop()
+    
+    def testPrefetchTranslatesTogether(self):
+        gbu = GraphBasedUpdater(MockNotifier(), MockMediaManager([]), pinyin.config.Config({ "dictlanguage" : "en", "fallbackongoogletranslate" : True }))
+        gbu.prefetch([u"测验一", u"测验二"], set(["meaning"]))
+        
+        # One request for all the translations
+        assert_equal(self.server.requests, [((u"测验一", u"测验二"), "en")])
+        
+        facts = [{ "expression" : expression, "meaning" : u"" } for expression in [u"测验一", u"测验二"]]
+        BatchUpdater(pinyin.batch.fieldupdaterfor("expression", MockNotifier(), MockMediaManager([]), gbu.config)).updatefacts(facts)
+        assert_equal(len(self.server.requests), 1)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks for the hot paths of the toolkit. These are not run as part of the
+test suite: run "python -m pinyin.tests.benchmarks" to get timings.
+"""
+
+import timeit
+
+import pinyin.dictionaryonline
+from pinyin.factproxy import markgeneratedfield
+from pinyin.httpclient import HTTPClient
+from pinyin.model import *
+from pinyin.simptrad import SimpTradConverter
+import pinyin.tests.simptrad
+from pinyin.transformations import tonesandhi, tonesandhimany
+from pinyin.tests.fakegoogle import FakeGoogleServer
+from pinyin.updatergraph import filledgraphforupdaters
+
+
+# Representative CEDICT-style meanings: mostly English, with the odd bit of embedded pinyin
+englishheavydefinitions = [
+    u"to be fond of; to like; to enjoy; to be keen on; to love",
+    u"variant of 儿 [er2]; used as a suffix in some place names",
+    u"(Tw) T-shirt; see also T恤衫 [T xu4 shan1]",
+    u"classifier for books, periodicals, files etc; volume of a book",
+    u"the day after tomorrow; see also 后天 [hou4 tian1]",
+    u"to get one's hair cut; haircut"
+]
+
+englishheavyreadings = [u"T xu4 shan1", u"A A zhi4", u"K ge1", u"U pan2", u"B chao1"]
+
+def benchmarktokenizedefinitions():
+    for definition in englishheavydefinitions:
+        tokenize(definition, forcenumeric=True)
+
+def benchmarktokenizereadings():
+    for reading in englishheavyreadings:
+        tokenizespaceseperatedtext(reading)
+
+def benchmarktryparseenglish():
+    for word in u" ".join(englishheavydefinitions).split():
+        Pinyin.tryparse(word, forcenumeric=True)
+
+def benchmarkparseenglish():
+    for word in u" ".join(englishheavydefinitions).split():
+        try:
+            Pinyin.parse(word, forcenumeric=True)
+        except ValueError:
+            pass
+
+sandhireadings = [
+    [Word(Pinyin(u"ni", 3), Pinyin(u"hao", 3))],
+    [Word(Pinyin(u"bao", 3), Pinyin(u"guan", 3)), Word(Text(u" ")), Word(Pinyin(u"hao", 3))],
+    [Word(Pinyin(u"wo", 3)), Word(Pinyin(u"ye", 3)), Word(Pinyin(u"hen", 3)), Word(Pinyin(u"xiang", 3)), Word(Pinyin(u"mai", 3)), Word(Text(u"!"))],
+    [Word(Text(u"to be fond of")), Word(Pinyin(u"xi", 3), Pinyin(u"huan", 5))]
+]
+
+def benchmarktonesandhi():
+    for reading in sandhireadings:
+        tonesandhi(reading)
+
+def benchmarktonesandhimany():
+    tonesandhimany(sandhireadings)
+
+# The shape of the GraphBasedUpdater updaters, with trivial functions so that we only time the graph itself
+graphupdaters = [(field, lambda *inputs: u"new", usings) for field, usings in [
+    ("simptrad", ("expression",)), ("trad", ("simptrad",)), ("simp", ("simptrad",)),
+    ("expression", ("simp",)), ("expression", ("trad",)),
+    ("dictmeaningsandsource", ("expression",)), ("dictmeanings", ("dictmeaningsandsource",)),
+    ("dictmeaningssource", ("dictmeaningsandsource",)), ("dictmws", ("expression",)),
+    ("mergeddictmeaningsmws", ("dictmeanings", "dictmws", "mwfieldinfact")),
+    ("mergeddictmeanings", ("mergeddictmeaningsmws",)), ("mergeddictmws", ("mergeddictmeaningsmws",)),
+    ("meaning", ("expression", "mergeddictmeanings", "dictmeaningssource")),
+    ("mw", ("mergeddictmws",)), ("mwaudio", ("dictmws", "dictreading")),
+    ("dictreading", ("expression",)), ("reading", ("dictreading",)), ("dictreading", ("reading",)),
+    ("color", ("expression", "dictreading")), ("audio", ("dictreading",)), ("weblinks", ("expression",))
+  ]]
+
+graphfact = { "expression" : u"书", "reading" : markgeneratedfield(u"shū"), "meaning" : u"", "audio" : u"", "color" : u"", "mw" : u"" }
+
+def benchmarkfilledgraph():
+    graph = filledgraphforupdaters(graphupdaters, graphfact, { "expression" : u"书本", "mwfieldinfact" : True })
+    for _, thunk in graph.values():
+        thunk()
+
+# Converting an expression used to take two round trips to Google
+simptradconverter = SimpTradConverter(pinyin.tests.simptrad.variants, pinyin.tests.simptrad.phrases)
+
+def benchmarksimptrad():
+    simptradconverter.simptrad(u"我的头发干净了，你发现了吗？")
+
+# A response to a batched lookup, with a long list of definitions for each query. Like the real thing it has
+# sparse lists and trailing commas, so it isn't JSON: json.loads gives up on it and our own parser does the work
+googleresult = u'[[["Well","\\u597d","","H\\u01ceo"]],[%s],"zh-CN",,[["Well",[5],1,0,1000,0,1,0]],0.84,,[["zh-CN"],,[0.84]],]' % \
+                 u",".join([u'["verb",["like","love","to be \\"fond\\" of",],[["like",["\\u559c\\u6b22",],,0.5],],%d,]' % i for i in range(0, 20)])
+googleresponse = u"[%s]" % u",".join([googleresult] * 20)
+
+def benchmarkparsegoogleresponse():
+    pinyin.dictionaryonline.parsegoogleresponse(googleresponse)
+
+# Compare with benchmarkparsegoogleresponse to see what trying json.loads first costs us
+def benchmarkparsegoogleresponsewithoutjson():
+    oldjson = pinyin.dictionaryonline.json
+    try:
+        pinyin.dictionaryonline.json = None
+        pinyin.dictionaryonline.parsegoogleresponse(googleresponse)
+    finally:
+        pinyin.dictionaryonline.json = oldjson
+
+# Online lookups go to a stand-in for Google on this machine, so we time our end rather than the network
+fakegoogle = []
+
+def fakegooglelookup(client, lookup=lambda: pinyin.dictionaryonline.lookup(u"你好", "en")):
+    if len(fakegoogle) == 0:
+        fakegoogle.append(FakeGoogleServer({ (u"你好", "en") : u"Hello" }).start())
+        pinyin.dictionaryonline.translateurl = fakegoogle[0].url
+    
+    oldclient = pinyin.dictionaryonline.client
+    try:
+        pinyin.dictionaryonline.client = client
+        lookup()
+    finally:
+        pinyin.dictionaryonline.client = oldclient
+
+def benchmarklookup():
+    fakegooglelookup(pinyin.dictionaryonline.client)
+
+def benchmarklookupwithoutkeepalive():
+    client = HTTPClient()
+    fakegooglelookup(client)
+    client.close()
+
+# Compare with 20 times benchmarklookup
+def benchmarklookupmanytwenty():
+    fakegooglelookup(pinyin.dictionaryonline.client, lambda: pinyin.dictionaryonline.lookupmany([u"你好"] * 20, "en"))
+
+def runbenchmarks(number=1000):
+    # Warm up the lazily-loaded syllable data so we don't time the database access
+    Pinyin.validpinyin()
+    segmenter()
+    
+    for name, benchmark in sorted(globals().items()):
+        if name.startswith("benchmark") and callable(benchmark):
+            seconds = timeit.Timer(benchmark).timeit(number=number)
+            print "%-32s %8.2f us per call" % (name, seconds * 1000000.0 / number)
+    
+    for server in fakegoogle:
+        server.stop()
+
+if __name__ == "__main__":
+    runbenchmarks()
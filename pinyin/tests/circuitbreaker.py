@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from pinyin.circuitbreaker import *
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.probes = []
+        self.working = False
+        self.breaker = CircuitBreaker("Dummy service", lambda: self.working, failurethreshold=2, opentime=60,
+                                      clock=lambda: self.now, runinbackground=self.probes.append)
+    
+    def testStartsClosed(self):
+        self.assertEquals(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allowrequest())
+    
+    def testOpensAfterFailuresInARow(self):
+        self.breaker.failure()
+        self.breaker.success()
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allowrequest())
+        
+        self.breaker.failure()
+        self.assertEquals(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allowrequest())
+    
+    def testStaysOpenWithoutProbing(self):
+        self.trip()
+        self.now = 59.0
+        self.assertFalse(self.breaker.allowrequest())
+        self.assertEquals(self.probes, [])
+    
+    def testProbesOnceInBackgroundWhenHalfOpen(self):
+        self.trip()
+        self.now = 60.0
+        self.assertFalse(self.breaker.allowrequest())
+        self.assertFalse(self.breaker.allowrequest())
+        self.assertEquals(self.breaker.state, "half-open")
+        self.assertEquals(len(self.probes), 1)
+    
+    def testClosesIfProbeSucceeds(self):
+        self.trip()
+        self.now = 60.0
+        self.breaker.allowrequest()
+        
+        self.working = True
+        self.probes[0]()
+        self.assertEquals(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allowrequest())
+        
+        # The failure count starts again
+        self.breaker.failure()
+        self.assertTrue(self.breaker.allowrequest())
+    
+    def testReopensIfProbeFails(self):
+        self.trip()
+        self.now = 60.0
+        self.breaker.allowrequest()
+        self.probes[0]()
+        
+        self.assertEquals(self.breaker.state, "open")
+        self.now = 119.0
+        self.assertFalse(self.breaker.allowrequest())
+        self.now = 120.0
+        self.assertFalse(self.breaker.allowrequest())
+        self.assertEquals(len(self.probes), 2)
+    
+    def testReopensIfProbeRaises(self):
+        def explode():
+            raise ValueError("Boom")
+        
+        self.breaker.probe = explode
+        self.trip()
+        self.now = 60.0
+        self.breaker.allowrequest()
+        self.probes[0]()
+        self.assertEquals(self.breaker.state, "open")
+    
+    def testDescribe(self):
+        self.trip()
+        self.assertEquals(self.breaker.describe(), "open (2 failures in a row, opened 1 times, 0 probes)")
+    
+    def testProbesOnRealThread(self):
+        probed = []
+        breaker = CircuitBreaker("Dummy service", lambda: probed.append(True) or True, failurethreshold=1, opentime=0)
+        breaker.failure()
+        breaker.allowrequest()
+        
+        for i in range(0, 1000):
+            if breaker.state == "closed":
+                break
+            time.sleep(0.01)
+        
+        self.assertEquals(probed, [True])
+        self.assertEquals(breaker.state, "closed")
+    
+    def trip(self):
+        self.breaker.failure()
+        self.breaker.failure()
@@ -2,7 +2,9 @@
 
 import unittest
 
+from pinyin.circuitbreaker import CircuitBreaker
 from pinyin.config import *
+import pinyin.dictionaryonline
 
 
 class ConfigTest(unittest.TestCase):
@@ -26,6 +28,26 @@ class ConfigTest(unittest.TestCase):
     def testNonExistentFieldNamesDiscarded(self):
         self.assertRaises(KeyError, lambda: Config({ "candidateFieldNamesByKey" : { "silly" : ["Fish"] } }).candidateFieldNamesByKey["silly"])
     
+    def testPalette(self):
+        config = Config({ "tonecolors" : ["#ff0000", "#ffaa00", "#00aa00", "#0000ff", "#545454"], "extraquickaccesscolors" : ["#000000", "#ffffff", "#00aa00"] })
+        self.assertEquals(config.palette.color(2), "#00aa00")
+        self.assertEquals(config.palette.color(2, True), "#66cc66")
+        self.assertEquals(config.palette.color(7, True), "#66cc66")
+        self.assertTrue(config.palette is config.palette)
+    
+    def testPaletteFollowsColorChanges(self):
+        config = Config({ "tonecolors" : ["#ff0000", "#ffaa00", "#00aa00", "#0000ff", "#545454"] })
+        palette = config.palette
+        config.tonecolors[0] = "#123456"
+        self.assertFalse(palette is config.palette)
+        self.assertEquals(config.palette.color(0), "#123456")
+    
+    def testPickleDoesntIncludePalette(self):
+        import pickle
+        config = Config({})
+        config.palette
+        self.assertEquals(pickle.loads(pickle.dumps(config)).__dict__.keys(), ["settings"])
+    
     def testPositionalListLengthNotChanged(self):
         config = Config({ "tonecolors" : ["hi"] })
         self.assertEquals(config.tonecolors[0], "hi")
@@ -140,3 +162,32 @@ class ConfigTest(unittest.TestCase):
         
     def testShouldUseGoogleTranslateShouldUse(self):
         self.assertTrue(Config({ "fallbackongoogletranslate" : True }).shouldusegoogletranslate)
+    
+    def testShouldUseGoogleTranslateNotWhenFailing(self):
+        oldbreaker = pinyin.dictionaryonline.breaker
+        try:
+            probes = []
+            pinyin.dictionaryonline.breaker = CircuitBreaker("Google Translate", lambda: True, failurethreshold=1, opentime=0, runinbackground=probes.append)
+            pinyin.dictionaryonline.breaker.failure()
+            
+            # We don't wait for the check that Google is back
+            self.assertFalse(Config({ "fallbackongoogletranslate" : True }).shouldusegoogletranslate)
+            self.assertEquals(len(probes), 1)
+            
+            probes[0]()
+            self.assertTrue(Config({ "fallbackongoogletranslate" : True }).shouldusegoogletranslate)
+        finally:
+            pinyin.dictionaryonline.breaker = oldbreaker
+    
+    def testGoogleTranslateStateDoesntProbe(self):
+        oldbreaker = pinyin.dictionaryonline.breaker
+        try:
+            probes = []
+            pinyin.dictionaryonline.breaker = CircuitBreaker("Google Translate", lambda: True, failurethreshold=1, opentime=0, runinbackground=probes.append)
+            pinyin.dictionaryonline.breaker.failure()
+            
+            self.assertEquals(Config({ "fallbackongoogletranslate" : True }).googletranslatestate, "open")
+            self.assertEquals(Config({ "fallbackongoogletranslate" : True }).googletranslatestate, "open")
+            self.assertEquals(probes, [])
+        finally:
+            pinyin.dictionaryonline.breaker = oldbreaker
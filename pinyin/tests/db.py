@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import unittest
+
+import sqlalchemy
+
+from pinyin.db import *
+import pinyin.utils
+
+
+class ReadOnlyTest(unittest.TestCase):
+    def testAuthorizerAllowsReading(self):
+        connection = self.connection()
+        self.assertEquals(connection.execute("SELECT upper(word) FROM words").fetchall(), [(u"HAO",)])
+        self.assertEquals(len(connection.execute("PRAGMA table_info(words)").fetchall()), 1)
+    
+    def testAuthorizerRefusesChanges(self):
+        connection = self.connection()
+        for statement in ["INSERT INTO words VALUES ('ni')", "UPDATE words SET word = 'ni'", "DELETE FROM words",
+                          "CREATE TABLE others (word TEXT)", "DROP TABLE words", "PRAGMA user_version = 1"]:
+            self.assertRaises(sqlite3.DatabaseError, lambda: connection.execute(statement))
+        
+        self.assertEquals(connection.execute("SELECT word FROM words").fetchall(), [(u"hao",)])
+    
+    def testListenerMakesPoolConnectionsReadOnly(self):
+        def do(tempdir):
+            path = os.path.join(tempdir, "test.db")
+            connection = sqlite3.connect(path)
+            connection.execute("CREATE TABLE words (word TEXT)")
+            connection.execute("INSERT INTO words VALUES ('hao')")
+            connection.commit()
+            connection.close()
+            
+            engine = sqlalchemy.create_engine("sqlite:///" + path, listeners=[ReadOnlyListener()])
+            connection = engine.connect()
+            try:
+                self.assertEquals(connection.execute("SELECT word FROM words").fetchall(), [(u"hao",)])
+                self.assertRaises(sqlalchemy.exc.DBAPIError, lambda: connection.execute("INSERT INTO words VALUES ('ni')"))
+            finally:
+                connection.close()
+                engine.dispose()
+        
+        pinyin.utils.withtempdir(do)
+    
+    # Test helpers
+    def connection(self):
+        connection = sqlite3.connect(":memory:")
+        connection.execute("CREATE TABLE words (word TEXT)")
+        connection.execute("INSERT INTO words VALUES ('hao')")
+        connection.set_authorizer(readonlyauthorizer)
+        return connection
@@ -1,8 +1,14 @@
 # -*- coding: utf-8 -*-
 
+import random
+import time
 import unittest
 
+from pinyin.circuitbreaker import CircuitBreaker
 from pinyin.dictionaryonline import *
+import pinyin.dictionaryonline
+from pinyin.tests.fakegoogle import FakeGoogleServer
+from pinyin.translationcache import TranslationCache
 
 
 class ParseGoogleResponseTest(unittest.TestCase):
@@ -58,8 +64,165 @@ class ParseGoogleResponseTest(unittest.TestCase):
     
     def testParseErrorIfEmpty(self):
         self.assertRaises(ValueError, lambda: parsegoogleresponse(''))
+    
+    def testParseFloat(self):
+        self.assertEquals(parsegoogleresponse('[0.5, -1e3, 2.5E-1]'), [0.5, -1000.0, 0.25])
+    
+    def testParseKeywords(self):
+        self.assertEquals(parsegoogleresponse('[true, false, null]'), [True, False, None])
+    
+    def testParseEmptyContainers(self):
+        self.assertEquals(parsegoogleresponse('[[], {}, [ ], { }]'), [[], {}, [], {}])
+    
+    def testParseSparseList(self):
+        self.assertEquals(parsegoogleresponse('[1,,2]'), [1, None, 2])
+        self.assertEquals(parsegoogleresponse('[,,"a"]'), [None, None, "a"])
+        self.assertEquals(parsegoogleresponse('[ , ]'), [None])
+    
+    def testParseTrailingCommas(self):
+        self.assertEquals(parsegoogleresponse('[1, 2, ]'), [1, 2])
+        self.assertEquals(parsegoogleresponse('{"a" : 1, }'), {"a" : 1})
+    
+    def testParseStringEscapes(self):
+        self.assertEquals(parsegoogleresponse(ur'"好 \x26 \/ \\ \n\r\b\f"'), u'好 & / \\ \n\r\b\f')
+    
+    def testParseErrorIfUnknownEscape(self):
+        self.assertRaises(ValueError, lambda: parsegoogleresponse(r'"\q"'))
+        self.assertRaises(ValueError, lambda: parsegoogleresponse(r'"\u12"'))
+    
+    def testParseErrorIfStringNotClosed(self):
+        self.assertRaises(ValueError, lambda: parsegoogleresponse('["hello]'))
+    
+    def testParseErrorQuicklyIfLongStringNotClosed(self):
+        # A truncated response shouldn't make the regular expressions backtrack for ages
+        started = time.time()
+        self.assertRaises(ValueError, lambda: parsegoogleresponse('["' + 'ab\\"c d' * 100))
+        self.assertRaises(ValueError, lambda: parsegoogleresponse('{"sentences":[{"trans":"' + u'好' * 500))
+        self.assertTrue(time.time() - started < 1.0)
+    
+    def testParseErrorIfMismatchedBrackets(self):
+        self.assertRaises(ValueError, lambda: parsegoogleresponse('[1}'))
+        self.assertRaises(ValueError, lambda: parsegoogleresponse('{"a" : 1]'))
+        self.assertRaises(ValueError, lambda: parsegoogleresponse(']'))
+    
+    def testParseErrorIfUnhashableKey(self):
+        self.assertRaises(ValueError, lambda: parsegoogleresponse('{[1] : 2}'))
+    
+    def testParseErrorIfMissingDictValue(self):
+        self.assertRaises(ValueError, lambda: parsegoogleresponse('{"a" : , "b" : 1}'))
+        self.assertRaises(ValueError, lambda: parsegoogleresponse('{"a" : 1,, "b" : 1}'))
+    
+    # Responses in each of the formats we have seen from Google
+    def testParseStringResponse(self):
+        self.assertEquals(parsegoogleresponse(u'"Hello, you are my friend?"'), u"Hello, you are my friend?")
+    
+    def testParseListResponse(self):
+        self.assertEquals(parsegoogleresponse(u'["Well",[["verb","like","love"],["adjective","good"],["interjection","OK!","okay!","okey!"]]]'),
+                          [u"Well", [[u"verb", u"like", u"love"], [u"adjective", u"good"], [u"interjection", u"OK!", u"okay!", u"okey!"]]])
+    
+    def testParseDictResponse(self):
+        self.assertEquals(parsegoogleresponse(u'{"sentences":[{"trans":"Well","orig":"好","translit":"Hǎo"}],"dict":[{"pos":"verb","terms":["like","love"]}],"src":"zh-CN"}'),
+                          { "sentences" : [{ "trans" : u"Well", "orig" : u"好", "translit" : u"Hǎo" }], "dict" : [{ "pos" : u"verb", "terms" : [u"like", u"love"] }], "src" : u"zh-CN" })
+    
+    def testParseSparseResponse(self):
+        self.assertEquals(parsegoogleresponse(u'[[["Hello","\\u4f60\\u597d","","Nǐ hǎo"]],,"zh-CN",,[["Hello",[5],1,0,1000,0,1,0]],0.84,,[["zh-CN"],,[0.84]]]'),
+                          [[[u"Hello", u"你好", u"", u"Nǐ hǎo"]], None, u"zh-CN", None, [[u"Hello", [5], 1, 0, 1000, 0, 1, 0]], 0.84, None, [[u"zh-CN"], None, [0.84]]])
+    
+    def testParseBatchedResponse(self):
+        self.assertEquals(parsegoogleresponse(u'[{"sentences":[{"trans":"Hello"}]},\n {"sentences":[{"trans":"Well"}]}]'),
+                          [{ "sentences" : [{ "trans" : u"Hello" }] }, { "sentences" : [{ "trans" : u"Well" }] }])
+    
+    def testParseRandomValues(self):
+        generator = random.Random(1337)
+        for i in range(0, 300):
+            value = randomvalue(generator, 4)
+            response = serialize(generator, value)
+            self.assertEquals(parsegoogleresponse(response), value, "Parsing %r" % response)
+    
+    def testParseCorruptedValues(self):
+        # Whatever we are sent, we should either parse it or raise a ValueError: nothing else
+        generator = random.Random(42)
+        for i in range(0, 300):
+            response = list(serialize(generator, randomvalue(generator, 3)))
+            for j in range(0, generator.randint(1, 3)):
+                position = generator.randrange(0, len(response) + 1)
+                if position < len(response) and generator.random() < 0.5:
+                    del response[position]
+                else:
+                    response.insert(position, generator.choice(u'[]{},:"\\ 1-.ex'))
+            
+            try:
+                parsegoogleresponse(u"".join(response))
+            except ValueError:
+                pass
+
+class ParseGoogleResponseWithoutJsonTest(ParseGoogleResponseTest):
+    # Python 2.5 and earlier don't have the json module, so make sure we get the same answers without it
+    def setUp(self):
+        self.oldjson = pinyin.dictionaryonline.json
+        pinyin.dictionaryonline.json = None
+    
+    def tearDown(self):
+        pinyin.dictionaryonline.json = self.oldjson
+    
+    def testParseRandomJsonLikeJson(self):
+        # Where we do have the json module, check we read what it writes in just the same way
+        if self.oldjson is None:
+            return
+        
+        generator = random.Random(2009)
+        for i in range(0, 300):
+            response = self.oldjson.dumps(randomvalue(generator, 4), indent=generator.choice([None, 1]))
+            self.assertEquals(parsegoogleresponse(response), self.oldjson.loads(response), "Parsing %r" % response)
+
+def randomvalue(generator, depth):
+    kind = generator.randint(0, depth > 0 and 5 or 3)
+    if kind == 0:
+        return u"".join([generator.choice(u'ab "\\/\t\n好ǎ\u001f') for i in range(0, generator.randint(0, 6))])
+    elif kind == 1:
+        return long(generator.randint(-1000, 1000))
+    elif kind == 2:
+        return generator.randint(-100, 100) / 4.0
+    elif kind == 3:
+        return generator.choice([True, False, None])
+    elif kind == 4:
+        return [randomvalue(generator, depth - 1) for i in range(0, generator.randint(0, 4))]
+    else:
+        # Numeric keys are allowed by Google, if not by JSON
+        return dict([(generator.choice([randomvalue(generator, 0), long(i)]), randomvalue(generator, depth - 1)) for i in range(0, generator.randint(0, 4))])
+
+# Writes out the value in the same way as Google might, quirks and all
+def serialize(generator, value):
+    space = lambda: generator.choice([u"", u"", u" ", u"\n "])
+    trailingcomma = lambda: generator.random() < 0.2 and u"," or u""
+    if isinstance(value, basestring):
+        escapes = { u'"' : u'\\"', u"\\" : u"\\\\", u"/" : u"\\/", u"\t" : u"\\t", u"\n" : u"\\n" }
+        escape = lambda char: generator.random() < 0.3 and u"\\u%04x" % ord(char) or escapes.get(char, char)
+        return u'"%s"' % u"".join([escape(char) for char in value])
+    elif isinstance(value, list):
+        # Google leaves out nulls in lists rather than writing them. As in Javascript, a trailing comma
+        # doesn't count as an item, so we need one if we left out the last item
+        items = [(item is None and generator.random() < 0.5) and space() or space() + serialize(generator, item) + space() for item in value]
+        return u"[%s%s]" % (u",".join(items), len(items) > 0 and (items[-1].strip() == u"" and u"," or trailingcomma()) or u"")
+    elif isinstance(value, dict):
+        items = [space() + serialize(generator, key) + space() + u":" + space() + serialize(generator, item) + space() for key, item in value.items()]
+        return u"{%s%s}" % (u",".join(items), len(items) > 0 and trailingcomma() or u"")
+    elif value is None:
+        return u"null"
+    elif isinstance(value, bool):
+        return value and u"true" or u"false"
+    else:
+        return repr(value).rstrip(u"L")
 
 class GoogleTranslateTest(unittest.TestCase):
+    # These talk to the real Google, so don't let failures stop the other tests using it
+    def setUp(self):
+        self.oldbreaker = pinyin.dictionaryonline.breaker
+        pinyin.dictionaryonline.breaker = CircuitBreaker("Google Translate", gCheck)
+    
+    def tearDown(self):
+        pinyin.dictionaryonline.breaker = self.oldbreaker
+    
     def testTranslateNothing(self):
         self.assertEquals(gTrans(""), None)
     
@@ -90,3 +253,147 @@ class GoogleTranslateTest(unittest.TestCase):
     
     def testCheck(self):
         self.assertEquals(gCheck(), True)
+
+class FakeGoogleTranslateTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGoogleServer({ (u"你好", "en") : u"Hello", (u"好", "en") : u"Well" }).start()
+        self.oldtranslateurl = pinyin.dictionaryonline.translateurl
+        pinyin.dictionaryonline.translateurl = self.server.url
+        self.oldcache = pinyin.dictionaryonline.cache
+        pinyin.dictionaryonline.cache = TranslationCache(":memory:")
+        self.oldbreaker = pinyin.dictionaryonline.breaker
+        self.probes = []
+        pinyin.dictionaryonline.breaker = CircuitBreaker("Fake Google", gCheck, runinbackground=self.probes.append)
+    
+    def tearDown(self):
+        pinyin.dictionaryonline.breaker = self.oldbreaker
+        pinyin.dictionaryonline.cache.close()
+        pinyin.dictionaryonline.cache = self.oldcache
+        pinyin.dictionaryonline.translateurl = self.oldtranslateurl
+        pinyin.dictionaryonline.client.close()
+        self.server.stop()
+    
+    def testLookup(self):
+        self.assertEquals(lookup(u"你好", "en"), [[Word(Text(u"Hello"))]])
+        self.assertEquals(self.server.requests, [(u"你好", "en")])
+    
+    def testLookupIdentity(self):
+        self.assertEquals(lookup(u"canttranslatemefromchinese", "en"), None)
+    
+    def testCheck(self):
+        self.assertEquals(gCheck(), True)
+        self.assertEquals(self.server.requests, [(u"好", "en")])
+    
+    def testCheckOffline(self):
+        self.server.stop()
+        self.server = FakeGoogleServer().start()
+        pinyin.dictionaryonline.translateurl = self.server.url.replace("translate_a", "missing")
+        self.assertEquals(gCheck(), False)
+    
+    def testStopsAskingWhenGoogleFails(self):
+        gTrans(u"你好")
+        failed = []
+        self.server.respond = lambda path: failed.append(path) or (503, u"")
+        
+        interneterror = [[Word(Text('<span style="color:gray">[Internet Error]</span>'))]]
+        for i in range(0, 4):
+            self.assertEquals(gTrans(u"好"), interneterror)
+            self.assertTrue(iserrormeanings(gTrans(u"好")))
+        
+        # Only the first few requests go out, but we can still use what we have already translated
+        self.assertEquals(len(failed), 3)
+        self.assertEquals(pinyin.dictionaryonline.breaker.state, "open")
+        self.assertEquals(gTrans(u"你好"), [[Word(Text(u"Hello"))]])
+        self.assertFalse(iserrormeanings(gTrans(u"你好")))
+    
+    def testProbesWithCheckWhenHalfOpen(self):
+        breaker = pinyin.dictionaryonline.breaker
+        breaker.opentime = 0
+        for i in range(0, breaker.failurethreshold):
+            breaker.failure()
+        
+        self.assertEquals(gTrans(u"你好"), [[Word(Text('<span style="color:gray">[Internet Error]</span>'))]])
+        self.assertEquals(self.server.requests, [])
+        
+        self.probes[0]()
+        self.assertEquals(self.server.requests, [(u"好", "en")])
+        self.assertEquals(gTrans(u"你好"), [[Word(Text(u"Hello"))]])
+    
+    def testFailedProbeCountsOnce(self):
+        breaker = pinyin.dictionaryonline.breaker
+        breaker.opentime = 0
+        for i in range(0, breaker.failurethreshold):
+            breaker.failure()
+        
+        failed = []
+        self.server.respond = lambda path: failed.append(path) or (503, u"")
+        self.assertFalse(breaker.allowrequest())
+        self.probes[0]()
+        self.assertEquals(len(failed), 1)
+        self.assertEquals(breaker.failures, breaker.failurethreshold + 1)
+        self.assertEquals(breaker.state, "open")
+    
+    def testQueueStopsWhenGoogleFails(self):
+        breaker = pinyin.dictionaryonline.breaker
+        for i in range(0, breaker.failurethreshold):
+            breaker.failure()
+        
+        queue = TranslationQueue()
+        queue.request(u"你好", "en")
+        queue.flush()
+        self.assertEquals(self.server.requests, [])
+    
+    def testLookupMany(self):
+        self.assertEquals(lookupmany([u"你好", u"好", u"canttranslatemefromchinese"], "en"), [[[Word(Text(u"Hello"))]], [[Word(Text(u"Well"))]], None])
+        self.assertEquals(self.server.requests, [((u"你好", u"好", u"canttranslatemefromchinese"), "en")])
+    
+    def testLookupManyWrongNumberOfResults(self):
+        self.server.respond = lambda path: (200, u'[{"sentences":[{"trans":"Hello","orig":"你好","translit":""}],"src":"zh-CN"}]')
+        self.assertRaises(ValueError, lambda: lookupmany([u"你好", u"好"], "en"))
+    
+    def testQueueCoalescesRequests(self):
+        queue = TranslationQueue()
+        for query in [u"你好", u"好", u"<b>你好</b>", u" "]:
+            queue.request(query, "en")
+        queue.request(u"你好", "fr")
+        queue.flush()
+        
+        self.assertEquals(self.server.requests, [((u"你好", u"好"), "en"), (u"你好", "fr")])
+        self.assertEquals(gTrans(u"你好"), [[Word(Text(u"Hello"))]])
+        self.assertEquals(gTrans(u"好"), [[Word(Text(u"Well"))]])
+        self.assertEquals(len(self.server.requests), 2)
+    
+    def testQueueSkipsCachedTranslations(self):
+        gTrans(u"你好")
+        
+        queue = TranslationQueue()
+        queue.request(u"你好", "en")
+        queue.request(u"好", "en")
+        queue.flush()
+        
+        self.assertEquals(self.server.requests, [(u"你好", "en"), (u"好", "en")])
+    
+    def testQueueSplitsBatches(self):
+        queue = TranslationQueue(maxbatchsize=2)
+        for query in [u"一", u"二", u"三", u"四"]:
+            queue.request(query, "en")
+        queue.flush()
+        
+        self.assertEquals(self.server.requests, [((u"一", u"二"), "en"), ((u"三", u"四"), "en")])
+        
+        # Each character escapes to 9 characters of the URL
+        queue = TranslationQueue(maxbatchlength=30)
+        for query in [u"七", u"八九十"]:
+            queue.request(query, "en")
+        queue.flush()
+        
+        self.assertEquals(self.server.requests[2:], [(u"七", "en"), (u"八九十", "en")])
+    
+    def testQueueLeavesBadBatchesForLater(self):
+        self.server.respond = lambda path: (200, u'"garbage"')
+        queue = TranslationQueue()
+        queue.request(u"你好", "en")
+        queue.request(u"好", "en")
+        queue.flush()
+        
+        self.assertEquals(pinyin.dictionaryonline.cache.get(u"你好", "en"), (False, None))
@@ -56,5 +56,19 @@ class MarkingTest(unittest.TestCase):
     def testMarkingUnmarkingIsIdentity(self):
         self.assertEquals(unmarkgeneratedfield(markgeneratedfield("foo")), "foo")
     
+    def testStampedFieldGenerated(self):
+        self.assertTrue(isgeneratedfield("expression", markgeneratedfield("foo", "1a2b3c4d")))
+    
+    def testStampRoundTrip(self):
+        self.assertEquals(generatedfieldstamp(markgeneratedfield("foo", "1a2b3c4d")), "1a2b3c4d")
+        self.assertEquals(unmarkgeneratedfield(markgeneratedfield("foo", "1a2b3c4d")), "foo")
+    
+    def testNoStamp(self):
+        self.assertEquals(generatedfieldstamp(markgeneratedfield("foo")), None)
+        self.assertEquals(generatedfieldstamp("foo"), None)
+    
+    def testUnmarkHtmlStamped(self):
+        self.assertEquals(unmarkhtmlgeneratedfields(u"<b>" + markgeneratedfield("foo", "1a2b3c4d") + u"</b>" + markgeneratedfield("bar")), u"<b>foo</b>bar")
+    
     def testUnmarkingUnmarkedIdempotent(self):
         self.assertEquals(unmarkgeneratedfield("foo"), "foo")
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+A stand-in for the Google Translate endpoint that runs on the local machine, so that the online
+lookups can be tested (and benchmarked) without the network.
+"""
+
+import BaseHTTPServer
+import cgi
+import socket
+import SocketServer
+import threading
+import urlparse
+
+
+class FakeGoogleServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    
+    # Translations from (text, destination language) to the translated text. Anything
+    # else is "translated" to itself, which is what Google does with things it doesn't know.
+    # The requests are recorded as (text, destination language), where the text is a tuple
+    # of the queries for a batched request.
+    def __init__(self, translations={}):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), FakeGoogleHandler)
+        self.translations = translations
+        self.connections = 0
+        self.requests = []
+        self.sockets = []
+        self.thread = None
+    
+    url = property(lambda self: "http://127.0.0.1:%d/translate_a/t" % self.server_address[1])
+    
+    def start(self):
+        self.thread = threading.Thread(target=lambda: self.serve_forever(poll_interval=0.01))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+    
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        
+        # Hang up on any clients keeping their connections alive, so the handler threads finish
+        for request in self.sockets:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+    
+    def process_request(self, request, client_address):
+        self.connections += 1
+        self.sockets.append(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+    
+    def respond(self, path):
+        _, _, urlpath, query, _ = urlparse.urlsplit(path)
+        if urlpath != "/translate_a/t":
+            return 404, ""
+        
+        parameters = cgi.parse_qs(query)
+        destlanguage = parameters["tl"][0]
+        if "q" in parameters:
+            # A batch of queries: the results come back as a list, in the same order
+            texts = [text.decode("utf-8") for text in parameters["q"]]
+            self.requests.append((tuple(texts), destlanguage))
+            return 200, u"[%s]" % u",".join([self.translate(text, destlanguage) for text in texts])
+        
+        text = parameters["text"][0].decode("utf-8")
+        self.requests.append((text, destlanguage))
+        return 200, self.translate(text, destlanguage)
+    
+    def translate(self, text, destlanguage):
+        translation = self.translations.get((text, destlanguage), text)
+        return u'{"sentences":[{"trans":"%s","orig":"%s","translit":""}],"src":"zh-CN"}' % (translation, text)
+
+class FakeGoogleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Needed for the connection to be kept alive between requests
+    protocol_version = "HTTP/1.1"
+    
+    # Send each response in one go, as a real server would, rather than a packet for each header
+    wbufsize = -1
+    
+    def do_GET(self):
+        status, body = self.server.respond(self.path)
+        body = body.encode("utf-8")
+        
+        self.send_response(status)
+        self.send_header("Content-Type", "text/javascript; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        # Keep quiet during the tests
+        pass
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import socket
+import unittest
+import urllib2
+
+from pinyin.httpclient import *
+from pinyin.tests.fakegoogle import FakeGoogleServer
+
+
+class HTTPClientTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.server = FakeGoogleServer({ (u"你好", "en") : u"Hello" }).start()
+        self.client = HTTPClient(clock=lambda: self.now)
+    
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+    
+    def testGet(self):
+        self.assertEquals(self.get(u"你好"), '{"sentences":[{"trans":"Hello","orig":"你好","translit":""}],"src":"zh-CN"}')
+        self.assertEquals(self.server.requests, [(u"你好", "en")])
+    
+    def testKeepsConnectionAlive(self):
+        for i in range(0, 5):
+            self.get(u"你好")
+        
+        self.assertEquals(self.client.connectionsopened, 1)
+        self.assertEquals(self.server.connections, 1)
+    
+    def testReconnectsIfKeptAliveConnectionFails(self):
+        self.get(u"你好")
+        for connection, _ in self.client.idle.values()[0]:
+            connection.sock.close()
+        
+        self.get(u"你好")
+        self.assertEquals(self.client.connectionsopened, 2)
+    
+    def testDoesntReuseConnectionsIdleForTooLong(self):
+        self.get(u"你好")
+        self.now += self.client.maxidle + 1
+        self.get(u"你好")
+        self.assertEquals(self.client.connectionsopened, 2)
+    
+    def testResponseSizeLimit(self):
+        self.client.maxresponsesize = 20
+        self.assertRaises(ValueError, lambda: self.get(u"你好"))
+        
+        # We shouldn't get confused by the rest of that response next time
+        self.client.maxresponsesize = 1024
+        self.assertEquals(self.get(u"好"), '{"sentences":[{"trans":"好","orig":"好","translit":""}],"src":"zh-CN"}')
+    
+    def testUnsuccessfulStatus(self):
+        self.assertRaises(urllib2.HTTPError, lambda: self.client.get(self.server.url.replace("translate_a", "missing")))
+    
+    def testNetworkErrors(self):
+        # Find a port that nothing is listening on
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        port = listener.getsockname()[1]
+        listener.close()
+        
+        self.assertRaises(urllib2.URLError, lambda: self.client.get("http://127.0.0.1:%d/translate_a/t" % port))
+    
+    # Test helpers
+    def get(self, text):
+        return self.client.get(self.server.url + "?client=t&text=%s&sl=zh-CN&tl=en" % urllib.quote(text.encode("utf-8")))
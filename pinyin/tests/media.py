@@ -140,6 +140,25 @@ class MediaPackTest(unittest.TestCase):
     def testMediaForMissing(self):
         self.assertEquals(MediaPack("Example", {}).mediafor("hi", [".mp3"]), None)
     
+    def testMediaForSyllable(self):
+        pack = MediaPack("Example", {"ma3.mp3" : "MA3", "Ma3.ogg" : "MA3OGG", "ma.ogg" : "MA", "ma4.mp3" : "MA4", "nv3.mp3" : "NV3", "nu:3.ogg" : "NU3"})
+        self.assertEquals(pack.mediaforsyllable(u"ma", 3, [".mp3", ".ogg"]), "MA3")
+        self.assertEquals(pack.mediaforsyllable(u"ma", 3, [".ogg", ".mp3"]), "MA3OGG")
+        self.assertEquals(pack.mediaforsyllable(u"Ma", 5, [".mp3", ".ogg"]), "MA")
+        self.assertEquals(pack.mediaforsyllable(u"ma", 5, [".mp3"]), "MA4")
+        self.assertEquals(pack.mediaforsyllable(u"nü", 3, [".mp3", ".ogg"]), "NV3")
+        self.assertEquals(pack.mediaforsyllable(u"nü", 3, [".ogg"]), "NU3")
+        self.assertEquals(pack.mediaforsyllable(u"ma", 1, [".mp3", ".ogg"]), None)
+    
+    def testMediaForSyllableMatchesCandidateSearch(self):
+        names = [u"ma1.mp3", u"ma4.ogg", u"ma.mp3", u"ma5.ogg", u"nv3.mp3", u"nu:3.mp3", u"nü3.ogg", u"lü4.mp3", u"lv4.ogg", u"lu:5.mp3",
+                 u"lv.mp3", u"lü.ogg", u"Nv4.MP3", u"r5.mp3", u"er2.ogg", u"junk", u"ma2.wav", "nü2.mp3"]
+        pack = MediaPack("Example", dict([(name, name) for name in names]))
+        for audioextensions in [[".mp3"], [".ogg", ".mp3"], [".mp3", ".ogg", ".wav"]]:
+            for word in [u"ma", u"Ma", u"nü", u"lü", u"Lü", u"nu", u"r", u"er"]:
+                for spoken in range(1, 6):
+                    self.assertEquals(pack.mediaforsyllable(word, spoken, audioextensions), self.searchcandidates(pack, word, spoken, audioextensions))
+    
     def testFromPath(self):
         def do(path):
             # Create enclosing directory
@@ -161,6 +180,105 @@ class MediaPackTest(unittest.TestCase):
         # Create a temporary directory with which to do our test
         utils.withtempdir(do)
     
+    
+    # The way media used to be found for each syllable: build a list of candidate names and search for each in turn
+    def searchcandidates(self, pack, word, spoken, audioextensions):
+        from pinyin.model import waysToSubstituteAwayUUmlaut
+        
+        possiblebases = [word + str(spoken)]
+        substitutions = waysToSubstituteAwayUUmlaut(word)
+        if spoken == 5:
+            possiblebases.extend([word, word + '4'])
+        elif substitutions is not None:
+            possiblebases.extend([substitution + str(spoken) for substitution in substitutions])
+        
+        for possiblebase in possiblebases:
+            media = pack.mediafor(possiblebase, audioextensions)
+            if media:
+                return media
+        
+        return None
+
+
+class MediaPackRegistryTest(unittest.TestCase):
+    def testDiscover(self):
+        def do(path):
+            self.createpack(path, "My Pack", ["ma1.mp3"])
+            utils.touch(os.path.join(path, "not a pack"))
+            os.mkdir(os.path.join(path, "Downloads"))
+            
+            packs = MediaPackRegistry(path).discovermediapacks()
+            self.assertEquals([pack.name for pack in packs], ["My Pack"])
+            self.assertEquals(packs[0].mediafor("ma1", [".mp3"]), os.path.join(path, "My Pack", "ma1.mp3"))
+        
+        utils.withtempdir(do)
+    
+    def testReusesUnchangedPacks(self):
+        def do(path):
+            self.createpack(path, "My Pack", ["ma1.mp3"])
+            
+            registry = MediaPackRegistry(path)
+            self.assertTrue(registry.discovermediapacks()[0] is registry.discovermediapacks()[0])
+        
+        utils.withtempdir(do)
+    
+    def testRescansChangedPack(self):
+        def do(path):
+            packpath = self.createpack(path, "My Pack", ["ma1.mp3"])
+            
+            registry = MediaPackRegistry(path)
+            self.assertEquals(registry.discovermediapacks()[0].mediafor("ma2", [".mp3"]), None)
+            
+            # Bump the modification time explicitly, as the file system might only have a resolution of seconds
+            utils.touch(os.path.join(packpath, "ma2.mp3"))
+            os.utime(packpath, (0, os.path.getmtime(packpath) + 10))
+            self.assertEquals(registry.discovermediapacks()[0].mediafor("ma2", [".mp3"]), os.path.join(packpath, "ma2.mp3"))
+        
+        utils.withtempdir(do)
+    
+    def testForgetsRemovedPack(self):
+        def do(path):
+            packpath = self.createpack(path, "My Pack", ["ma1.mp3"])
+            
+            registry = MediaPackRegistry(path)
+            self.assertEquals(len(registry.discovermediapacks()), 1)
+            
+            shutil.rmtree(packpath)
+            os.utime(path, (0, os.path.getmtime(path) + 10))
+            self.assertEquals(registry.discovermediapacks(), [])
+            self.assertEquals(registry.packs, {})
+        
+        utils.withtempdir(do)
+    
+    def testRefresh(self):
+        def do(path):
+            self.createpack(path, "My Pack", ["ma1.mp3"])
+            os.utime(path, (0, 1000))
+            
+            registry = MediaPackRegistry(path)
+            pack = registry.discovermediapacks()[0]
+            
+            # Without a change to the modification time we only see the new pack after a refresh
+            self.createpack(path, "Other Pack", [])
+            os.utime(path, (0, 1000))
+            self.assertEquals(len(registry.discovermediapacks()), 1)
+            
+            registry.refresh()
+            packs = registry.discovermediapacks()
+            self.assertEquals(sorted([otherpack.name for otherpack in packs]), ["My Pack", "Other Pack"])
+            self.assertFalse([otherpack for otherpack in packs if otherpack.name == "My Pack"][0] is pack)
+        
+        utils.withtempdir(do)
+    
+    # Test helpers
+    def createpack(self, path, name, files):
+        packpath = os.path.join(path, name)
+        os.mkdir(packpath)
+        for file in files:
+            utils.touch(os.path.join(packpath, file))
+        
+        return packpath
+
 class LegacyMediaTest(unittest.TestCase):
     def testDiscoverNothing(self):
         self.assertEquals(discoverlegacymedia(None, []), None)
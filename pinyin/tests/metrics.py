@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+
+from pinyin.metrics import *
+
+
+class MetricTest(unittest.TestCase):
+    def testCounts(self):
+        metric = Metric()
+        metric.record(0.5)
+        metric.record(1.5, failed=True)
+        
+        self.assertEquals(metric.calls, 2)
+        self.assertEquals(metric.failures, 1)
+        self.assertEquals(metric.totaltime, 2.0)
+        self.assertEquals(metric.maxtime, 1.5)
+    
+    def testPercentiles(self):
+        metric = Metric()
+        for i in range(1, 101):
+            metric.record(float(i))
+        
+        self.assertEquals(metric.percentile(50), 50.0)
+        self.assertEquals(metric.percentile(90), 90.0)
+        self.assertEquals(metric.percentile(100), 100.0)
+        self.assertEquals(metric.percentile(0), 1.0)
+    
+    def testPercentileEmpty(self):
+        self.assertEquals(Metric().percentile(50), None)
+    
+    def testSamplesBounded(self):
+        metric = Metric(maxsamples=3)
+        for i in range(1, 6):
+            metric.record(float(i))
+        
+        self.assertEquals(sorted(metric.samples), [3.0, 4.0, 5.0])
+        self.assertEquals(metric.calls, 5)
+
+class MetricsRegistryTest(unittest.TestCase):
+    def testTimed(self):
+        registry = MetricsRegistry()
+        halve = registry.timed(["a", "b"], lambda x: (x % 2 == 0 and [x / 2] or [None])[0])
+        
+        self.assertEquals(halve(4), 2)
+        self.assertEquals(halve(3), None)
+        for name in ["a", "b"]:
+            self.assertEquals(registry.metric(name).calls, 2)
+            self.assertEquals(registry.metric(name).failures, 0)
+    
+    def testTimedRecordsExceptions(self):
+        registry = MetricsRegistry()
+        def explode():
+            raise ValueError("Boom")
+        
+        self.assertRaises(ValueError, registry.timed(["explode"], explode))
+        self.assertEquals(registry.metric("explode").failures, 1)
+        self.assertEquals(registry.timed(["explode"], explode).__name__, "explode")
+    
+    def testTimedFromManyThreads(self):
+        registry = MetricsRegistry()
+        identity = registry.timed(["identity"], lambda x: x)
+        def work():
+            for i in range(0, 1000):
+                identity(i)
+                registry.metric("thread %d" % (i % 10))
+        
+        threads = [threading.Thread(target=work) for i in range(0, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.assertEquals(registry.metric("identity").calls, 4000)
+        self.assertEquals(registry.metric("identity").failures, 0)
+        self.assertEquals(len(registry.metrics), 11)
+    
+    def testClearKeepsTimedFunctionsWorking(self):
+        registry = MetricsRegistry()
+        identity = registry.timed(["identity"], lambda x: x)
+        identity(1)
+        
+        registry.clear()
+        self.assertEquals(registry.metric("identity").calls, 0)
+        identity(1)
+        self.assertEquals(registry.metric("identity").calls, 1)
+    
+    def testReport(self):
+        registry = MetricsRegistry()
+        registry.timed(["updater: identity"], lambda x: x)(1)
+        registry.metric("never called")
+        
+        report = registry.report()
+        self.assertTrue("updater: identity" in report)
+        self.assertFalse("never called" in report)
+    
+    def testReportGauges(self):
+        registry = MetricsRegistry()
+        state = ["closed"]
+        registry.gauge("google translate", lambda: state[0])
+        
+        self.assertTrue("google translate" in registry.report() and "closed" in registry.report())
+        state[0] = "open"
+        self.assertTrue("open" in registry.report())
@@ -148,6 +148,16 @@ class PinyinTest(unittest.TestCase):
     
     def testRejectsPinyinlikeEnglish(self):
         self.assertRaises(ValueError, lambda: Pinyin.parse("USB"))
+    
+    def testTryParse(self):
+        self.assertEquals(Pinyin.parse(u"xiǎo"), Pinyin.tryparse(u"xiǎo"))
+        self.assertEquals(Pinyin("chi", 1), Pinyin.tryparse("chi1", forcenumeric=True))
+    
+    def testTryParseReturnsNoneForNonPinyin(self):
+        self.assertEquals(None, Pinyin.tryparse("USB"))
+        self.assertEquals(None, Pinyin.tryparse(u"xíǎo"))
+        self.assertEquals(None, Pinyin.tryparse(u"1"))
+        self.assertEquals(None, Pinyin.tryparse("chi", forcenumeric=True))
 
 class TextTest(unittest.TestCase):
     def testNonEmpty(self):
@@ -297,6 +307,38 @@ class TokenizeTest(unittest.TestCase):
         self.assertEquals([Pinyin.parse(u"wan4"), Pinyin(u"r", 5)], tokenize(u"wan4r"))
         self.assertEquals([Text(u"color")], tokenize(u"color"))
     
+    def testTokenizeRunOnPinyin(self):
+        self.assertEquals([Pinyin(u"ni", 5), Pinyin(u"hao", 3)], tokenize(u"nihao3"))
+        self.assertEquals([Pinyin(u"xie", 4), Pinyin(u"xie", 5)], tokenize(u"xie4xie"))
+    
+    def testTokenizeRunOnToneMarkedPinyin(self):
+        self.assertEquals([Pinyin(u"ni", 3), Pinyin(u"hao", 3)], tokenize(u"nǐhǎo"))
+    
+    def testTokenizeRunOnPinyinCapitalised(self):
+        self.assertEquals([Pinyin(u"Xi", 1), Pinyin(u"an", 1)], tokenize(u"Xi1an1"))
+    
+    def testTokenizeRunOnPinyinPrefersFewerSyllables(self):
+        self.assertEquals([Pinyin(u"xian", 1)], tokenize(u"xian1"))
+    
+    def testTokenizeRunOnPinyinWithErhua(self):
+        self.assertEquals([Pinyin(u"yi", 1), Pinyin(u"dian", 3), Pinyin(u"r", 5)], tokenize(u"yi1dian3r"))
+    
+    def testTokenizeRunOnEnglishIsText(self):
+        self.assertEquals([Text(u"one")], tokenize(u"one"))
+        self.assertEquals([Text(u"shenanigans")], tokenize(u"shenanigans"))
+    
+    def testTokenizeRunOnToneless(self):
+        for word in [u"time", u"like", u"make", u"sure", u"china", u"banana", u"machine", u"xiexie"]:
+            self.assertEquals([Text(word)], tokenize(word))
+    
+    def testTokenizeErhuaNeedsStem(self):
+        self.assertEquals([Text(u"Mr"), Text(u" "), Text(u"Smith")], tokenize(u"Mr Smith"))
+        self.assertEquals([Pinyin(u"wan", 5), Pinyin(u"r", 5)], tokenize(u"wanr"))
+    
+    def testTokenizeRunOnPinyinForceNumeric(self):
+        self.assertEquals([Pinyin(u"ni", 3), Pinyin(u"hao", 3)], tokenize(u"ni3hao3", forcenumeric=True))
+        self.assertEquals([Text(u"nihao3")], tokenize(u"nihao3", forcenumeric=True))
+    
     def testTokenizeForceNumeric(self):
         self.assertEquals([Pinyin.parse(u"hen3"), Text(" "), Pinyin.parse(u"hao3")], tokenize(u"hen3 hao3"))
         self.assertEquals([Pinyin.parse(u"hen3"), Text(" "), Pinyin.parse(u"hao3"), Text(", "), Text("my"), Text(" "), Text(u"xiǎo"), Text(" "), Text("one"), Text("!")],
@@ -401,6 +443,21 @@ class PinyinTonifierTest(unittest.TestCase):
     def testGreeting(self):
         self.assertEquals(PinyinTonifier().tonify(u"ni3 hao3, wo3 xi3 huan xue2 xi2 Han4 yu3. wo3 de Han4 yu3 shui3 ping2 hen3 di1."),
                           u"nǐ hǎo, wǒ xǐ huan xué xí Hàn yǔ. wǒ de Hàn yǔ shuǐ píng hěn dī.")
+    
+    def testSyllable(self):
+        self.assertEquals(PinyinTonifier().tonifysyllable(u"xiao", 3), u"xiǎo")
+        self.assertEquals(PinyinTonifier().tonifysyllable(u"nü", 3), u"nǚ")
+        self.assertEquals(PinyinTonifier().tonifysyllable(u"ma", 5), u"ma")
+    
+    def testSyllableUpperCase(self):
+        self.assertEquals(PinyinTonifier().tonifysyllable(u"An", 1), u"Ān")
+    
+    def testSyllableUnknownFallsBackOnRules(self):
+        self.assertEquals(PinyinTonifier().tonifysyllable(u"HUAI", 4), u"HUÀI")
+    
+    def testMany(self):
+        self.assertEquals(PinyinTonifier().tonify_many([(u"Zhong", 1), (u"guo", 2), (u"ren", 5)]), [u"Zhōng", u"guó", u"ren"])
+        self.assertEquals(PinyinTonifier().tonify_many([]), [])
 
 class FlattenTest(unittest.TestCase):
     def testFlatten(self):
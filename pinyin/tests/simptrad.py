@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from pinyin.simptrad import *
+
+
+# A few rows in the style of the CharacterVariant table
+variants = [
+    (u"书", u"書", "T"), (u"書", u"书", "S"),
+    (u"头", u"頭", "T"), (u"頭", u"头", "S"),
+    (u"现", u"現", "T"), (u"現", u"现", "S"),
+    (u"发", u"發", "T"), (u"发", u"髮", "T"), (u"發", u"发", "S"), (u"髮", u"发", "S"),
+    (u"干", u"乾", "T"), (u"干", u"幹", "T"), (u"干", u"干", "T"), (u"乾", u"干", "S"), (u"幹", u"干", "S"),
+    (u"净", u"淨", "T"), (u"淨", u"净", "S"),
+    (u"台", u"台", "T"), (u"台", u"臺", "T"), (u"台", u"颱", "T"), (u"臺", u"台", "S"), (u"颱", u"台", "S"),
+    (u"风", u"風", "T"), (u"風", u"风", "S"), (u"湾", u"灣", "T"), (u"灣", u"湾", "S")
+  ]
+
+phrases = [(u"发现", u"發現"), (u"出发", u"出發"), (u"头发", u"頭髮"), (u"干净", u"乾淨"), (u"干部", u"幹部"), (u"干杯", u"乾杯"),
+           (u"台风", u"颱風"), (u"台湾", u"臺灣"), (u"台湾", u"台灣")]
+
+class SimpTradConverterTest(unittest.TestCase):
+    def setUp(self):
+        self.converter = SimpTradConverter(variants, phrases)
+    
+    def testCharacters(self):
+        self.assertEquals(self.converter.convert(u"书", "trad"), u"書")
+        self.assertEquals(self.converter.convert(u"書", "simp"), u"书")
+    
+    def testAlreadyConverted(self):
+        self.assertEquals(self.converter.convert(u"書", "trad"), u"書")
+        self.assertEquals(self.converter.convert(u"书", "simp"), u"书")
+    
+    def testLeavesOtherThingsAlone(self):
+        self.assertEquals(self.converter.convert(u"你好, T恤衫！", "trad"), u"你好, T恤衫！")
+        self.assertEquals(self.converter.convert(u"", "simp"), u"")
+    
+    def testSimpTrad(self):
+        self.assertEquals(self.converter.simptrad(u"头發"), { "simp" : u"头发", "trad" : u"頭發" })
+    
+    def testAmbiguousCharacterUsesCommonestVariant(self):
+        self.assertEquals(self.converter.convert(u"发", "trad"), u"發")
+        self.assertEquals(self.converter.convert(u"干", "trad"), u"乾")
+    
+    def testAmbiguousCharacterPrefersItself(self):
+        self.assertEquals(self.converter.convert(u"台", "trad"), u"台")
+    
+    def testPhraseOverrides(self):
+        self.assertEquals(self.converter.convert(u"头发", "trad"), u"頭髮")
+        self.assertEquals(self.converter.convert(u"干部", "trad"), u"幹部")
+        self.assertEquals(self.converter.convert(u"台风", "trad"), u"颱風")
+        self.assertEquals(self.converter.convert(u"干净的干部和干杯", "trad"), u"乾淨的幹部和乾杯")
+    
+    def testOnlyRemembersPhrasesThatNeedOverriding(self):
+        self.assertEquals(sorted(self.converter.phrases["trad"].keys()), [u"台风", u"头发", u"干部"])
+        self.assertEquals(self.converter.phrases["simp"], {})
+    
+    def testIgnoresConflictingPhrases(self):
+        self.assertEquals(self.converter.convert(u"台湾", "trad"), u"台灣")
+    
+    def testLongestPhraseWins(self):
+        converter = SimpTradConverter(variants, phrases + [(u"干发", u"乾髮"), (u"干发头", u"幹發頭")])
+        self.assertEquals(converter.convert(u"干发", "trad"), u"乾髮")
+        self.assertEquals(converter.convert(u"干发头", "trad"), u"幹發頭")
+        self.assertEquals(converter.convert(u"干发干发头", "trad"), u"乾髮幹發頭")
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from pinyin.model import *
+from pinyin.tokenbuffer import *
+import pinyin.transformations
+
+
+colorlist = [
+    u"#ff0000",
+    u"#ffaa00",
+    u"#00aa00",
+    u"#0000ff",
+    u"#545454"
+  ]
+
+# A reading with a bit of everything in it to check the buffer against the Word model
+mixedreading = [
+    Word(Pinyin.parse(u"ni3"), Pinyin.parse(u"hao3")),
+    Word(Text(u", ")),
+    Word(Text(u"Mr"), Text(u" "), Pinyin(u"Wang", 2, { "color" : u"#123456" })),
+    Word(Pinyin.parse(u"yi1"), Pinyin.parse(u"dian3"), Pinyin.parse(u"r5")),
+    Word(TonedCharacter(u"好", 3), TonedCharacter(u"儿", 5)),
+    Word(Text(u"!"))
+  ]
+
+class TokenBufferTest(unittest.TestCase):
+    def testRoundTrip(self):
+        self.assertEquals(TokenBuffer.fromwords(mixedreading).towords(), mixedreading)
+    
+    def testRoundTripEmpty(self):
+        self.assertEquals(TokenBuffer.fromwords([]).towords(), [])
+        self.assertEquals(TokenBuffer.fromwords([Word()]).towords(), [Word()])
+    
+    def testArrays(self):
+        buffer = TokenBuffer.fromwords([Word(Pinyin.parse(u"ni3"), Text(u" ")), Word(Pinyin.parse(u"ni3"))])
+        self.assertEquals(list(buffer.kinds), [PINYIN, TEXT, PINYIN])
+        self.assertEquals(list(buffer.written), [3, 0, 3])
+        self.assertEquals(list(buffer.wordoffsets), [0, 2, 3])
+        self.assertEquals(buffer.ids[0], buffer.ids[2])
+        self.assertEquals(len(buffer), 3)
+        self.assertEquals(buffer.wordcount, 2)
+    
+    def testAttrsSideTable(self):
+        buffer = TokenBuffer.fromwords(mixedreading)
+        self.assertEquals(buffer.attrs, { 5 : { "color" : u"#123456" } })
+    
+    def testToneSandhi(self):
+        self.assertTransformation(pinyin.transformations.tonesandhi, lambda buffer: buffer.tonesandhi(),
+                                  [Word(Pinyin.parse("bao3"), Pinyin.parse("guan3")), Word(Text(u" ")), Word(Pinyin.parse("hao3"))])
+    
+    def testToneSandhiMixed(self):
+        self.assertTransformation(pinyin.transformations.tonesandhi, lambda buffer: buffer.tonesandhi(), mixedreading)
+    
+    def testToneSandhiKeepsAttributes(self):
+        self.assertTransformation(pinyin.transformations.tonesandhi, lambda buffer: buffer.tonesandhi(),
+                                  [Word(Pinyin(u"hen", 3, { "color" : u"#123456" }), TonedCharacter(u"好", 3, { "color" : u"#654321" }))])
+    
+    def testTrimErhua(self):
+        self.assertTransformation(pinyin.transformations.trimerhua, lambda buffer: buffer.trimerhua(), mixedreading)
+    
+    def testColorize(self):
+        sandhied = pinyin.transformations.tonesandhi(mixedreading)
+        self.assertTransformation(lambda words: pinyin.transformations.colorize(colorlist, words), lambda buffer: buffer.colorize(colorlist), sandhied)
+    
+    def testColorizeKeepsExistingColors(self):
+        buffer = TokenBuffer.fromwords(mixedreading)
+        buffer.colorize(colorlist)
+        self.assertEquals(buffer.attrs[5], { "color" : u"#123456" })
+    
+    def testMaskHanzi(self):
+        self.assertTransformation(lambda words: pinyin.transformations.maskhanzi(u"好", "mask", words), lambda buffer: buffer.maskhanzi(u"好", "mask"),
+                                  [Word(Text(u"World")), Word(Text(u"H好!")), Word(Text(u" "), Text(u"J好")), Word(TonedCharacter(u"好", 3), Pinyin.parse(u"hao3"))])
+    
+    def testFormatReadingForDisplay(self):
+        self.assertTransformation(formatreadingfordisplay, lambda buffer: buffer.formatreadingfordisplay(), mixedreading)
+    
+    def testFlatten(self):
+        buffer = TokenBuffer.fromwords(mixedreading)
+        buffer.colorize(colorlist)
+        self.assertEquals(buffer.flatten(), flatten(buffer.towords()))
+        self.assertEquals(buffer.flatten(tonify=True), flatten(buffer.towords(), tonify=True))
+    
+    def testTransformationsCompose(self):
+        buffer = TokenBuffer.fromwords(mixedreading)
+        buffer.tonesandhi()
+        buffer.trimerhua()
+        buffer.formatreadingfordisplay()
+        buffer.colorize(colorlist)
+        
+        expected = pinyin.transformations.colorize(colorlist, formatreadingfordisplay(pinyin.transformations.trimerhua(pinyin.transformations.tonesandhi(mixedreading))))
+        self.assertEquals(buffer.flatten(), flatten(expected))
+    
+    # Test helpers
+    def assertTransformation(self, wordstransformation, buffertransformation, words):
+        buffer = TokenBuffer.fromwords(words)
+        buffertransformation(buffer)
+        self.assertEquals(buffer.towords(), wordstransformation(words))
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import itertools
+import re
 import unittest
 
 from pinyin.db import database
@@ -47,6 +49,21 @@ class PinyinColorizerTest(unittest.TestCase):
     def colorize(self, what):
         return flatten(colorize(colorlist, englishdict.reading(what)))
 
+class ColorPaletteTest(unittest.TestCase):
+    def testColor(self):
+        palette = ColorPalette(colorlist)
+        self.assertEquals(palette.color(2), u"#00aa00")
+        self.assertEquals(palette.color(2, sandhify=True), u"#66cc66")
+    
+    def testToneColor(self):
+        palette = ColorPalette(colorlist)
+        self.assertEquals(palette.tonecolor(ToneInfo(written=3)), u"#00aa00")
+        self.assertEquals(palette.tonecolor(ToneInfo(written=3, spoken=2)), u"#66cc66")
+    
+    def testColorizeWithPalette(self):
+        words = [Word(Pinyin("xiao", ToneInfo(written=3, spoken=2)), Text(" "), Pinyin.parse("ma1"))]
+        self.assertEquals(colorize(ColorPalette(colorlist), words), colorize(colorlist, words))
+
 class CharacterColorizerTest(unittest.TestCase):
     def testColorize(self):
         self.assertEqual(self.colorize(u"妈麻马骂吗"),
@@ -70,6 +87,43 @@ class CharacterColorizerTest(unittest.TestCase):
     def colorize(self, what):
         return flatten(colorize(colorlist, englishdict.tonedchars(what)))
 
+class ReadingRendererTest(unittest.TestCase):
+    def testMatchesPipeline(self):
+        for tonify in [False, True]:
+            for words in self.readings:
+                self.assertEquals(ReadingRenderer(colorlist, tonify).render(words), self.pipeline(colorlist, tonify, words))
+    
+    def testWithoutColors(self):
+        for words in self.readings:
+            self.assertEquals(ReadingRenderer(None, False).render(words), self.pipeline(None, False, words))
+    
+    def testSandhiColor(self):
+        self.assertEquals(ReadingRenderer(colorlist, False).render([Word(Pinyin("xiao", ToneInfo(written=3, spoken=2)))]),
+                          '<span style="color:#66cc66">xiao3</span>')
+    
+    def testKeepsUserColors(self):
+        self.assertEquals(ReadingRenderer(colorlist, True).render([Word(Pinyin("xiao", 3, { "color" : "#123456" }), Text(u"!", { "color" : "red" }))]),
+                          u'<span style="color:#123456">xiǎo</span><span style="color:red">!</span>')
+    
+    def testLowercase(self):
+        self.assertEquals(ReadingRenderer([color.upper() for color in colorlist], False, lowercase=True).render([Word(Pinyin("Ni", 3)), Word(Text("Foo"))]),
+                          '<span style="color:#00aa00">ni3</span> foo')
+    
+    # Test helpers
+    readings = [
+        [Word(Pinyin.parse(u"ni3"), Pinyin.parse(u"hao3")), Word(Text(u", ")), Word(Text(u"Mr")), Word(Pinyin(u"Wang", 2))],
+        [Word(Pinyin.parse(u"yi1"), Pinyin.parse(u"dian3"), Pinyin.parse(u"r5")), Word(Text(u"\"hello\""))],
+        [Word(TonedCharacter(u"好", ToneInfo(written=3, spoken=2)), TonedCharacter(u"儿", 5)), Word(Pinyin.parse(u"ma5")), Word(Text(u"?"))],
+        []
+      ]
+    
+    def pipeline(self, colorlist, tonify, words):
+        words = formatreadingfordisplay(words)
+        if colorlist is not None:
+            words = colorize(colorlist, words)
+        
+        return flatten(words, tonify=tonify)
+
 class PinyinAudioReadingsTest(unittest.TestCase):
     default_raw_available_media = ["na3.mp3", "ma4.mp3", "xiao3.mp3", "ma3.mp3", "ci2.mp3", "dian3.mp3",
                                    "wu3.mp3", "nin2.mp3", "ni3.ogg", "hao3.ogg", "gen1.ogg", "gen1.mp3"]
@@ -207,6 +261,28 @@ class ToneSandhiTest(unittest.TestCase):
         # compound 饮料 - modified to take the new information into account:
         self.assertSandhi(*(englishdict.reading(u"酒水饮料") + ["jiu2shui2yin3liao4"]))
     
+    def testPreservesHtmlAttributes(self):
+        self.assertEquals(tonesandhi([Word(Pinyin(u"hen", 3, { "color" : "red" }), TonedCharacter(u"好", 3, { "color" : "blue" }))]),
+                          [Word(Pinyin(u"hen", ToneInfo(written=3, spoken=2), { "color" : "red" }), TonedCharacter(u"好", 3, { "color" : "blue" }))])
+    
+    def testManyReadingsAreIndependent(self):
+        readings = [[Word(Pinyin.parse("hen3"))], [Word(Pinyin.parse("hao3"))], [Word(Pinyin.parse("ni3"), Pinyin.parse("hao3"))], []]
+        self.assertEquals([flatten(self.copySpokenToWritten(reading)) for reading in tonesandhimany(readings)], ["hen3", "hao3", "ni2hao3", ""])
+        self.assertEquals(tonesandhimany(readings), [tonesandhi(reading) for reading in readings])
+    
+    def testContourGolden(self):
+        # Outputs recorded from the original regex-based implementation
+        for contour, expected in [("", ""), ("3", "3"), ("33", "23"), ("333", "223"), ("3~3", "2~3"), ("33~3", "22~3"), ("3~33", "3~23"),
+                                  ("3~3~3", "2~3~3"), ("3~~3", "2~~3"), ("3_3", "3_3"), ("3~_~3", "3~_~3"), ("13~3", "12~3"), ("33~4~3", "23~4~3"),
+                                  ("3~33~3", "3~22~3"), ("333~33~3~3", "222~22~2~3"), ("3~3~3~3", "2~3~2~3"), ("34~43", "34~43"), ("3~", "3~")]:
+            self.assertEquals(self.sandhicontourstring(contour), expected)
+    
+    def testContourMatchesRegexImplementation(self):
+        for length in range(0, 7):
+            for contour in itertools.product("13_~", repeat=length):
+                contour = "".join(contour)
+                self.assertEquals(self.sandhicontourstring(contour), self.regexsandhicontour(contour))
+    
     # TODO: improve tone sandhi such that the following tests pass:
     #
     # def testYiFollowedByFour(self):
@@ -233,6 +309,22 @@ class ToneSandhiTest(unittest.TestCase):
     def assertSandhi(self, *args):
         self.assertEquals(flatten(self.copySpokenToWritten(tonesandhi(args[:-1]))), args[-1])
     
+    def sandhicontourstring(self, contour):
+        symbols = dict([(str(tone), tone) for tone in range(1, 6)] + [("_", CONTOURTEXT), ("~", CONTOURWORDEND)])
+        chars = dict([(symbol, char) for char, symbol in symbols.items()])
+        return "".join([chars[tone] for tone in sandhitones([symbols[char] for char in contour])])
+    
+    # The original implementation of tone sandhi, which rewrote a string version of the contour using regular expressions
+    def regexsandhicontour(self, tonecontour):
+        def dealWithThrees(match):
+            wordcontours = (match.group(1) or "").split("~")[:-1] + [match.group(2)]
+            maketwosifpoly = lambda what: len(what) == 1 and what or '2' * len(what)
+            makeprefixtwos = lambda what: '2' * (len(what) - 1) + '3'
+            return "~".join([maketwosifpoly(wordcontour) for wordcontour in wordcontours[:-1]] + [makeprefixtwos(wordcontours[-1])])
+        
+        tonecontour = re.sub(r"((?:3+\~+)*)(3+)", dealWithThrees, tonecontour)
+        return re.sub(r"3(\~*)3", r"2\g<1>3", tonecontour)
+    
     def copySpokenToWritten(self, words):
         class CopySpokenToWrittenVisitor(TokenVisitor):
             def visitText(self, text):
@@ -282,4 +374,17 @@ class MaskHanziTest(unittest.TestCase):
                           [Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX")), Word(Text("XXX le he said XXX to me! XXX!"))])
 
     def testDontMaskWesternForms(self):
-        self.assertEquals(maskhanzi("1000AD", "XXX", [Word(Text(u"In 1000AD..."))]), [Word(Text(u"In 1000AD..."))])
\ No newline at end of file
+        self.assertEquals(maskhanzi("1000AD", "XXX", [Word(Text(u"In 1000AD..."))]), [Word(Text(u"In 1000AD..."))])
+    
+    def testMaskLongestFirst(self):
+        self.assertEquals(HanziMasker(u"你好吗", "X").masktext(u"你好吗? 你好! 好吗 吗你"), u"X? X! X XX")
+    
+    def testMaskIgnoresNonHanziInExpression(self):
+        self.assertEquals(HanziMasker(u"T恤衫 A好", "X").masktext(u"T恤衫 A好 恤好"), u"TX AX XX")
+    
+    def testMaskPreservesAttributes(self):
+        self.assertEquals(maskhanzi(u"爱", "mask", [Word(Text(u"H爱!", { "color" : "red" }))]), [Word(Text(u"Hmask!", { "color" : "red" }))])
+    
+    def testMaskLongExpression(self):
+        expression = u"我们" * 200
+        self.assertEquals(HanziMasker(expression, "X").masktext(u"他说" + expression + u"了"), u"他说X了")
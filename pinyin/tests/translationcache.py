@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from pinyin.translationcache import *
+from pinyin.circuitbreaker import CircuitBreaker
+import pinyin.dictionaryonline
+from pinyin.model import *
+import pinyin.utils
+
+
+class TranslationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+    
+    def testMiss(self):
+        self.withcache(lambda cache: self.assertEquals(cache.get(u"好", "en"), (False, None)))
+    
+    def testHit(self):
+        def do(cache):
+            cache.put(u"好", "en", [u"Well", u"Adjective: good"])
+            cache.put(u"好", "fr", None)
+            self.assertEquals(cache.get(u"好", "en"), (True, [u"Well", u"Adjective: good"]))
+            self.assertEquals(cache.get(u"好", "fr"), (True, None))
+        
+        self.withcache(do)
+    
+    def testSharedAcrossSessions(self):
+        def do(path):
+            cache = self.cache(path)
+            cache.put(u"好", "en", [u"Well", u"Adjective: good"])
+            cache.put(u"坏", "en", None)
+            cache.close()
+            
+            cache = self.cache(path)
+            self.assertEquals(cache.get(u"好", "en"), (True, [u"Well", u"Adjective: good"]))
+            self.assertEquals(cache.get(u"坏", "en"), (True, None))
+            cache.close()
+        
+        self.withpath(do)
+    
+    def testExpires(self):
+        def do(path):
+            cache = self.cache(path, ttl=60)
+            cache.put(u"好", "en", [u"Well"])
+            self.now += 61
+            self.assertEquals(cache.get(u"好", "en"), (False, None))
+            cache.close()
+            
+            # Expired entries are removed from the database when it is next opened
+            cache = self.cache(path, ttl=60)
+            self.assertEquals(cache.connect().execute("SELECT COUNT(*) FROM translations").fetchone()[0], 0)
+            cache.close()
+        
+        self.withpath(do)
+    
+    def testEvictsOldest(self):
+        def do(path):
+            cache = self.cache(path, maxentries=3)
+            for i in range(0, 150):
+                cache.put(unicode(i), "en", [unicode(i)])
+                self.now += 1
+            
+            # We prune every hundred translations
+            self.assertEquals(cache.connect().execute("SELECT query FROM translations ORDER BY created").fetchall(), [(u"97",), (u"98",), (u"99",)] + [(unicode(i),) for i in range(100, 150)])
+            cache.close()
+            
+            cache = self.cache(path, maxentries=3)
+            self.assertEquals(cache.connect().execute("SELECT query FROM translations ORDER BY created").fetchall(), [(u"147",), (u"148",), (u"149",)])
+            self.assertEquals(cache.get(u"1", "en"), (False, None))
+            self.assertEquals(cache.get(u"149", "en"), (True, [u"149"]))
+            cache.close()
+        
+        self.withpath(do)
+    
+    def testWorksWithoutDatabase(self):
+        cache = self.cache(os.path.join("does", "not", "exist", "translations.db"))
+        cache.put(u"好", "en", [u"Well"])
+        self.assertEquals(cache.get(u"好", "en"), (True, [u"Well"]))
+    
+    def testGoogleTranslateUsesCache(self):
+        lookups = []
+        def lookup(query, destlanguage):
+            lookups.append(query)
+            return [[Word(Text(u"Well"))], [Word(Text(u"Adjective: good"))]]
+        
+        def do(cache):
+            oldcache, oldlookup, oldbreaker = pinyin.dictionaryonline.cache, pinyin.dictionaryonline.lookup, pinyin.dictionaryonline.breaker
+            try:
+                pinyin.dictionaryonline.cache, pinyin.dictionaryonline.lookup = cache, lookup
+                pinyin.dictionaryonline.breaker = CircuitBreaker("Fake Google", lambda: True)
+                for i in range(0, 2):
+                    self.assertEquals(pinyin.dictionaryonline.gTrans(u"好"), [[Word(Text(u"Well"))], [Word(Text(u"Adjective: good"))]])
+            finally:
+                pinyin.dictionaryonline.cache, pinyin.dictionaryonline.lookup, pinyin.dictionaryonline.breaker = oldcache, oldlookup, oldbreaker
+            
+            self.assertEquals(lookups, [u"好"])
+        
+        self.withcache(do)
+    
+    # Test helpers
+    def cache(self, path, **kwargs):
+        return TranslationCache(path, clock=lambda: self.now, **kwargs)
+    
+    def withpath(self, do):
+        pinyin.utils.withtempdir(lambda tempdir: do(os.path.join(tempdir, "translations.db")))
+    
+    def withcache(self, do):
+        def inner(path):
+            cache = self.cache(path)
+            try:
+                do(cache)
+            finally:
+                cache.close()
+        
+        self.withpath(inner)
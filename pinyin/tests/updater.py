@@ -7,7 +7,8 @@ from testutils import *
 
 import pinyin.config
 from pinyin.db import database
-from pinyin.factproxy import markgeneratedfield, isgeneratedfield
+import pinyin.dictionary
+from pinyin.factproxy import generatedfieldstamp, markgeneratedfield, isgeneratedfield, unmarkgeneratedfield
 from pinyin.updater import *
 from pinyin.utils import Thunk
 from pinyin.mocks import *
@@ -16,7 +17,11 @@ from pinyin.mocks import *
 def assertUpdatesTo(updater, expression, theconfig, incomingfact, expectedfact, mediapacks=[], **kwargs):
     actualfact = copy.deepcopy(incomingfact)
     updater(MockNotifier(), MockMediaManager(mediapacks), config.Config(utils.updated({ "dictlanguage" : "en" }, theconfig))).updatefact(actualfact, expression, **kwargs)
-    assert_dict_equal(actualfact, expectedfact, values_as_assertions=True)
+    assert_dict_equal(dict([(key, unstamped(value)) for key, value in actualfact.items()]), expectedfact, values_as_assertions=True)
+
+# The stamps depend on the exact configuration, so most tests don't want to know about them
+def unstamped(value):
+    return (generatedfieldstamp(value) is not None and [markgeneratedfield(unmarkgeneratedfield(value))] or [value])[0]
 
 class TestFieldUpdaterFromAudio(object):
     def testDoesntReformatWhenDisabled(self):
@@ -97,6 +102,78 @@ class TestFieldUpdaterFromReading(object):
                 { "reading" : old, "expression" : u"很", "color" : u"" },
                 { "reading" : new, "expression" : u"很", "color" : markgeneratedfield(u'<span style="color:#333333">很</span>') })
 
+    def testStampsGeneratedFields(self):
+        fact = { "reading" : u"", "expression" : u"很", "color" : u"" }
+        self.updatefact(fact, u"hen3")
+        assert_not_equal(generatedfieldstamp(fact["color"]), None)
+        assert_equal(generatedfieldstamp(fact["reading"]), None)
+    
+    def testSkipsFieldsWithMatchingStamp(self):
+        fact = { "reading" : u"", "expression" : u"很", "color" : u"" }
+        self.updatefact(fact, u"hen3")
+        
+        # Doctor the generated field, keeping its stamp: if it is recomputed we'll notice
+        stamp = generatedfieldstamp(fact["color"])
+        fact["color"] = markgeneratedfield(u"Up to date", stamp)
+        self.updatefact(fact, u"hen3")
+        assert_equal(fact["color"], markgeneratedfield(u"Up to date", stamp))
+    
+    def testRecomputesFieldsWithStaleStamp(self):
+        fact = { "reading" : u"", "expression" : u"很", "color" : u"" }
+        self.updatefact(fact, u"hen3")
+        fact["color"] = markgeneratedfield(u"Out of date", generatedfieldstamp(fact["color"]))
+        
+        # Both the inputs and the configuration are part of the stamp
+        self.updatefact(fact, u"hen2")
+        assert_equal(unmarkgeneratedfield(fact["color"]), u'<span style="color:#222222">很</span>')
+        
+        fact["color"] = markgeneratedfield(u"Out of date", generatedfieldstamp(fact["color"]))
+        self.updatefact(fact, u"hen2", tonecolors = [u"#111111", u"#999999", u"#333333", u"#444444", u"#555555"])
+        assert_equal(unmarkgeneratedfield(fact["color"]), u'<span style="color:#999999">很</span>')
+    
+    def testRecomputesFieldsWhenDictionariesChange(self):
+        fact = { "reading" : u"", "expression" : u"很", "color" : u"" }
+        self.updatefact(fact, u"hen3")
+        fact["color"] = markgeneratedfield(u"Out of date", generatedfieldstamp(fact["color"]))
+        
+        oldversion = pinyin.dictionary.PinyinDictionary.version
+        pinyin.dictionary.PinyinDictionary.version = classmethod(lambda cls: "newer")
+        try:
+            self.updatefact(fact, u"hen3")
+        finally:
+            pinyin.dictionary.PinyinDictionary.version = oldversion
+        
+        assert_equal(unmarkgeneratedfield(fact["color"]), u'<span style="color:#333333">很</span>')
+    
+    def testDoesntStampAudioWithMissingMedia(self):
+        mediapacks = [media.MediaPack("Test", { "hao3.mp3" : "hao3.mp3" })]
+        mediamanager = MockMediaManager(mediapacks)
+        theconfig = config.Config(dict(dictlanguage = "en", forcereadingtobeformatted = False, colorizedpinyingeneration = False, audioextensions = [".mp3"]))
+        fact = { "reading" : u"", "audio" : u"" }
+        FieldUpdater("reading", MockNotifier(), mediamanager, theconfig).updatefact(fact, u"hen3")
+        assert_equal(generatedfieldstamp(fact["audio"]), None)
+        
+        # Once the user installs the missing sound we should pick it up
+        mediapacks[0] = media.MediaPack("Test", { "hen3.mp3" : "hen3.mp3" })
+        FieldUpdater("reading", MockNotifier(), mediamanager, theconfig).updatefact(fact, u"hen3")
+        assert_equal(unmarkgeneratedfield(fact["audio"]), u"[sound:" + os.path.join("Test", "hen3.mp3") + "]")
+    
+    def testDoesntReimportAudioWithMatchingStamp(self):
+        imported = []
+        class RecordingMediaManager(MockMediaManager):
+            def importmany(self, filenames):
+                imported.extend(filenames)
+                return MockMediaManager.importmany(self, filenames)
+        
+        mediamanager = RecordingMediaManager([media.MediaPack("Test", { "hen3.mp3" : "hen3.mp3" })])
+        theconfig = config.Config(dict(dictlanguage = "en", forcereadingtobeformatted = False, colorizedpinyingeneration = False, audioextensions = [".mp3"]))
+        fact = { "reading" : u"", "audio" : u"" }
+        for i in range(0, 2):
+            FieldUpdater("reading", MockNotifier(), mediamanager, theconfig).updatefact(fact, u"hen3")
+        
+        assert_equal(unmarkgeneratedfield(fact["audio"]), u"[sound:" + os.path.join("Test", "hen3.mp3") + "]")
+        assert_equal(imported, [os.path.join("Test", "hen3.mp3")])
+    
     def testUpdatingGeneratedVersion(self):
         config = dict(forcereadingtobeformatted = True, tonedisplay = "numeric")
         self.assertUpdatesTo(None, config,
@@ -120,6 +197,11 @@ class TestFieldUpdaterFromReading(object):
     # Test helpers
     def assertUpdatesTo(self, *args, **kwargs):
         assertUpdatesTo(partial(FieldUpdater, "reading"), *args, **kwargs)
+    
+    def updatefact(self, fact, reading, **settings):
+        theconfig = config.Config(utils.updated(dict(dictlanguage = "en", forcereadingtobeformatted = False, colorizedpinyingeneration = False, colorizedcharactergeneration = True,
+                                                     tonecolors = [u"#111111", u"#222222", u"#333333", u"#444444", u"#555555"]), settings))
+        FieldUpdater("reading", MockNotifier(), MockMediaManager([]), theconfig).updatefact(fact, reading)
 
 class TestFieldUpdaterFromExpression(object):
     def testReusesOldValueIfNoDelta(self):
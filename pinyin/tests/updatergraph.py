@@ -4,12 +4,16 @@ import copy
 import unittest
 from testutils import *
 
+from pinyin.circuitbreaker import CircuitBreaker
 import pinyin.config
 from pinyin.db import database
+import pinyin.dictionaryonline
 from pinyin.factproxy import markgeneratedfield
 from pinyin.updatergraph import *
 import pinyin.utils
 from pinyin.mocks import *
+from pinyin.model import Text, Word
+from pinyin.translationcache import TranslationCache
 
 
 class TestUpdaterGraphGeneralFunctionality(object):
@@ -61,6 +65,175 @@ class TestUpdaterGraphGeneralFunctionality(object):
                 graph = filledgraphforupdaters(updaters, { field : "", other_field : "present!", "output" : "" }, { field : "go" })
                 yield assert_equal, graph["output"][1](), "from " + field
 
+    def testReusesUpdatePlan(self):
+        updaters = [
+            ("intermediate", lambda x: x + " intermediate", ("input",)),
+            ("output", lambda x: x + " output", ("intermediate",))
+          ]
+        
+        # Same shape of fact and delta, different values: the plan is shared but the values aren't
+        graph = filledgraphforupdaters(updaters, { "input" : "hello", "output" : "" }, {})
+        plan = updateplanfor(updaters, set(["input"]), [], ["output"])
+        assert_equal(graph["output"][1](), "hello intermediate output")
+        
+        graph = filledgraphforupdaters(updaters, { "input" : "goodbye", "output" : "" }, {})
+        assert_true(plan is updateplanfor(updaters, set(["input"]), [], ["output"]))
+        assert_equal(graph["output"][1](), "goodbye intermediate output")
+    
+    def testDoesntStampTransientFields(self):
+        updaters = [
+            ("intermediate", lambda x: updatermemo.transient() or x + " error", ("input",)),
+            ("output", lambda x: x + " output", ("intermediate",)),
+            ("other output", lambda x: x + " output", ("intermediate",)),
+            ("unrelated", lambda x: x + " unrelated", ("input",))
+          ]
+        
+        stamps = {}
+        graph = filledgraphforupdaters(updaters, { "input" : "hello", "output" : "", "other output" : "", "unrelated" : "" }, {}, stamps)
+        assert_equal(graph["output"][1](), "hello error output")
+        assert_equal(graph["other output"][1](), "hello error output")
+        assert_equal(graph["unrelated"][1](), "hello unrelated")
+        assert_equal(stamps.keys(), ["unrelated"])
+    
+    def testRecomputesUnstampedFieldsIfWantStamps(self):
+        updaters = [
+            ("intermediate", lambda x: x, ("input",)),
+            ("output", lambda x: x + " output", ("intermediate",))
+          ]
+        
+        # The intermediate field doesn't change, so the output would normally be kept
+        fact = { "input" : "hello", "intermediate" : markgeneratedfield("hello"), "output" : markgeneratedfield("hello error output") }
+        assert_equal(filledgraphforupdaters(updaters, fact, { "input" : "hello" })["output"][1](), "hello error output")
+        assert_equal(filledgraphforupdaters(updaters, fact, { "input" : "hello" }, {})["output"][1](), "hello output")
+
+    def testUpdatePlanFillers(self):
+        updaters = [
+            ("intermediate", lambda x: x, ("input",)),
+            ("output", lambda x: x, ("intermediate",)),
+            ("output", lambda x: x, ("input",)),
+            ("unrelated", lambda x: x, ("other",))
+          ]
+        
+        plan = UpdatePlan(updaters, set(["input"]), ["input"], [])
+        assert_equal(sorted(plan.fillers), [("intermediate", [(0, ("input",))]), ("output", [(2, ("input",))])])
+
+    def testReadingRendererFollowsConfig(self):
+        config = pinyin.config.Config({ "colorizedpinyingeneration" : True })
+        gbu = GraphBasedUpdater(MockNotifier(), MockMediaManager([]), config)
+        
+        renderer = gbu.readingrenderer()
+        assert_true(renderer is gbu.readingrenderer())
+        
+        config.colorizedpinyingeneration = False
+        assert_false(renderer is gbu.readingrenderer())
+        assert_true(gbu.readingrenderer().palette is None)
+        
+        # Only the renderer for the current settings is kept
+        config.colorizedpinyingeneration = True
+        assert_false(renderer is gbu.readingrenderer())
+        assert_true(gbu.readingrenderer().palette is config.palette)
+
+    def testUsesCachedTranslationsWhileGoogleIsDown(self):
+        oldcache, oldbreaker = pinyin.dictionaryonline.cache, pinyin.dictionaryonline.breaker
+        pinyin.dictionaryonline.cache = TranslationCache(":memory:")
+        pinyin.dictionaryonline.breaker = CircuitBreaker("Google Translate", lambda: False, failurethreshold=1, runinbackground=lambda probe: None)
+        try:
+            pinyin.dictionaryonline.cache.put(u"一二三四五六七八九十", "en", [u"Counting"])
+            pinyin.dictionaryonline.breaker.failure()
+            
+            config = pinyin.config.Config({ "dictlanguage" : "en", "fallbackongoogletranslate" : True })
+            gbu = GraphBasedUpdater(MockNotifier(), MockMediaManager([]), config)
+            assert_equal(gbu.expression2dictmeaningssource(u"一二三四五六七八九十")[0], [[Word(Text(u"Counting"))]])
+            assert_equal(pinyin.dictionaryonline.breaker.state, "open")
+        finally:
+            pinyin.dictionaryonline.cache.close()
+            pinyin.dictionaryonline.cache, pinyin.dictionaryonline.breaker = oldcache, oldbreaker
+
+class TestUpdaterMemo(object):
+    def testRemembersResults(self):
+        calls = []
+        memo = UpdaterMemo()
+        double = memo.memoize("double", lambda x: calls.append(x) or x * 2, lambda: ())
+        
+        assert_equal(double(2), 4)
+        assert_equal(double(2), 4)
+        assert_equal(double(3), 6)
+        assert_equal(calls, [2, 3])
+    
+    def testDoesntRememberFailures(self):
+        calls = []
+        memo = UpdaterMemo()
+        fail = memo.memoize("fail", lambda x: calls.append(x), lambda: ())
+        
+        assert_equal(fail(1), None)
+        assert_equal(fail(1), None)
+        assert_equal(calls, [1, 1])
+    
+    def testDoesntRememberTransientResults(self):
+        calls = []
+        memo = UpdaterMemo()
+        error = memo.memoize("error", lambda x: calls.append(x) or memo.transient() or "[Internet Error]", lambda: ())
+        
+        assert_equal(error(1), "[Internet Error]")
+        assert_equal(error(1), "[Internet Error]")
+        assert_equal(calls, [1, 1])
+    
+    def testDoesntRememberResultsUsingTransientResults(self):
+        calls = []
+        memo = UpdaterMemo()
+        error = memo.memoize("error", lambda x: memo.transient() or x, lambda: ())
+        double = memo.memoize("double", lambda x: calls.append(x) or error(x) * 2, lambda: ())
+        
+        assert_equal(double(2), 4)
+        assert_equal(double(2), 4)
+        assert_equal(calls, [2, 2])
+    
+    def testForgetsWhenDictionariesChange(self):
+        memo = UpdaterMemo()
+        memo.usedictionaryversion((1, 2))
+        identity = memo.memoize("identity", lambda x: x, lambda: ())
+        identity(1)
+        
+        memo.usedictionaryversion((1, 2))
+        assert_equal(len(memo), 1)
+        memo.usedictionaryversion((1, 3))
+        assert_equal(len(memo), 0)
+    
+    def testFingerprint(self):
+        settings = { "language" : "en" }
+        memo = UpdaterMemo()
+        lookup = memo.memoize("lookup", lambda x: x + settings["language"], lambda: (settings["language"],))
+        
+        assert_equal(lookup(u"hello "), u"hello en")
+        settings["language"] = "fr"
+        assert_equal(lookup(u"hello "), u"hello fr")
+    
+    def testReadingArguments(self):
+        memo = UpdaterMemo()
+        flattener = memo.memoize("flatten", lambda reading: model.flatten(reading), lambda: ())
+        
+        assert_equal(flattener([model.Word(model.Pinyin.parse(u"ni3"))]), u"ni3")
+        assert_equal(flattener([model.Word(model.Pinyin.parse(u"hao3"))]), u"hao3")
+    
+    def testBounded(self):
+        memo = UpdaterMemo(maxsize=2)
+        identity = memo.memoize("identity", lambda x: x, lambda: ())
+        for i in range(1, 5):
+            identity(i)
+        
+        assert_equal(len(memo), 2)
+        assert_equal(sorted([key[-1] for key in memo.results.keys()]), [3, 4])
+    
+    def testPureUpdatersShareMemo(self):
+        updatermemo.clear()
+        config = pinyin.config.Config({ "dictlanguage" : "en" })
+        for gbu in [GraphBasedUpdater(MockNotifier(), MockMediaManager([]), config) for _ in range(0, 2)]:
+            graph = gbu.filledgraph({ "expression" : u"书", "reading" : u"", "audio" : u"" }, {})
+            assert_equal(graph["reading"][1](), u"shū")
+            graph["audio"][1]()
+        
+        assert_equal(sorted(set([key[0] for key in updatermemo.results.keys()])), ["dictreading"])
+
 class TestUpdaterGraphUpdaters(object):
     def testEverythingEnglish(self):
         config = dict(prefersimptrad = "simp", forceexpressiontobesimptrad = False, tonedisplay = "tonified", hanzimasking = False,
@@ -295,7 +468,8 @@ class TestUpdaterGraphUpdaters(object):
             'trad': markgeneratedfield(u'\u66f8'),
             'audio': markgeneratedfield(u'[sound:b4df1258ec41a790e745a934a1aa9cdf.ogg]'),
             'color': markgeneratedfield(u'<span style="color:#ff0000;">\u4e66</span>'),
-            'mw': markgeneratedfield(u'<span style="color:#00aa00;">\u672c</span> - <span style="color:#00aa00;">b\u011bn</span>, <span style="color:#0000ff;">\u518c</span> - <span style="color:#0000ff;">c\xe8</span>, <span style="color:#0000ff;">\u90e8</span> - <span style="color:#0000ff;">b\xf9</span>', 'meaning': u'<a name="pinyin-toolkit"></a>book<br /><span style="font-size:small; color:#a4a4a4;">\u3281</span><span style="font-size:small;"> letter<br /></span><span style="font-size:small; color:#a4a4a4;">\u3282</span><span style="font-size:small;"> see also </span><span style="font-size:small; color:#a4a4a4;">\u32a5</span><span style="font-size:small; color:#ff0000;">\u7ecf</span><span style="font-size:small;"> Book of History</span>'),
+            'mw': markgeneratedfield(u'<span style="color:#00aa00;">\u672c</span> - <span style="color:#00aa00;">b\u011bn</span>, <span style="color:#0000ff;">\u518c</span> - <span style="color:#0000ff;">c\xe8</span>, <span style="color:#0000ff;">\u90e8</span> - <span style="color:#0000ff;">b\xf9</span>'),
+            'meaning': u'<a name="pinyin-toolkit"></a>book<br /><span style="font-size:small; color:#a4a4a4;">\u3281</span><span style="font-size:small;"> letter<br /></span><span style="font-size:small; color:#a4a4a4;">\u3282</span><span style="font-size:small;"> see also </span><span style="font-size:small; color:#a4a4a4;">\u32a5</span><span style="font-size:small; color:#ff0000;">\u7ecf</span><span style="font-size:small;"> Book of History</span>',
             'simp': u'',
             'reading': u'<a name="pinyin-toolkit"></a><span style="color:#ff0000;">s</span><span style="color:#ff0000;">h\u016b</span>',
             'expression': u'\u4e66'
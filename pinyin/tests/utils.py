@@ -138,6 +138,89 @@ class ThunkTest(unittest.TestCase):
         delay = []
         delay.append(Thunk(lambda: delay[0].attribute))
         self.assertRaises(ValueError, lambda: delay[0]())
+    
+    def testBlackHoleWithoutStack(self):
+        capturestacks = Thunk.capturestacks
+        try:
+            Thunk.capturestacks = False
+            delay = []
+            delay.append(Thunk(lambda: delay[0]()))
+            self.assertRaises(ValueError, lambda: delay[0]())
+        finally:
+            Thunk.capturestacks = capturestacks
+    
+    def testForcedOnAnotherThread(self):
+        import threading
+        started, finish, calls, results = threading.Event(), threading.Event(), [], []
+        def slow():
+            calls.append(1)
+            started.set()
+            finish.wait(5)
+            return 5
+        
+        thunk = Thunk(slow)
+        other = threading.Thread(target=lambda: results.append(thunk()))
+        other.start()
+        started.wait(5)
+        
+        # We should wait for the other thread to finish, rather than seeing a black hole
+        threading.Timer(0.05, finish.set).start()
+        self.assertEquals(thunk(), 5)
+        other.join(5)
+        self.assertEquals(results, [5])
+        self.assertEquals(calls, [1])
+    
+    def testForcedOnAnotherThreadWhileStartingToWait(self):
+        import linecache, sys, threading, time
+        started, finish, results = threading.Event(), threading.Event(), []
+        def slow():
+            started.set()
+            finish.wait(5)
+            return 5
+        
+        # Let the forcing thread finish just as we have decided to wait for it, but before we actually do
+        def trace(frame, event, arg):
+            if event == "line" and linecache.getline(frame.f_code.co_filename, frame.f_lineno).strip() == "self.__waiting = True":
+                finish.set()
+                time.sleep(0.1)
+            return trace
+        
+        def wait():
+            sys.settrace(trace)
+            try:
+                results.append(thunk())
+            finally:
+                sys.settrace(None)
+        
+        thunk = Thunk(slow)
+        other = threading.Thread(target=thunk)
+        other.start()
+        started.wait(5)
+        
+        waiter = threading.Thread(target=wait)
+        waiter.setDaemon(True)
+        waiter.start()
+        waiter.join(5)
+        other.join(5)
+        self.assertEquals(results, [5])
+    
+    def testForcingFailsOnAnotherThread(self):
+        import threading
+        started, finish = threading.Event(), threading.Event()
+        def slow():
+            started.set()
+            finish.wait(5)
+            raise IOError("Oops")
+        
+        thunk = Thunk(slow)
+        other = threading.Thread(target=lambda: self.assertRaises(IOError, thunk))
+        other.start()
+        started.wait(5)
+        
+        # Once the other thread gives up we should stop waiting for it, and see the black hole it left behind
+        threading.Timer(0.05, finish.set).start()
+        self.assertRaises(ValueError, thunk)
+        other.join(5)
 
 class RegexParseTest(unittest.TestCase):
     def testParseSimple(self):
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import array
+
+import model
+import transformations
+from utils import *
+
+
+# Token kinds, as stored in TokenBuffer.kinds
+TEXT = 0
+PINYIN = 1
+TONEDCHARACTER = 2
+
+"""
+A compact representation of a reading (a list of Words) as parallel arrays, one entry per token:
+ * kinds:   the kind of each token (TEXT, PINYIN or TONEDCHARACTER)
+ * ids:     index into the strings table of the text, pinyin syllable or character
+ * written: the written tone of each token, or 0 for text
+ * spoken:  the spoken tone of each token, or 0 for text
+Words are recorded as offsets into those arrays: word n spans the tokens from wordoffsets[n] up
+to wordoffsets[n + 1]. Since HTML attributes are rare, they are kept in a side table keyed by
+token index.
+
+The transformations operate in place, rather than rebuilding a graph of token objects at each
+stage. Use fromwords and towords to convert to and from the Word model at the edges.
+"""
+class TokenBuffer(object):
+    def __init__(self):
+        self.kinds = array.array('B')
+        self.ids = array.array('i')
+        self.written = array.array('B')
+        self.spoken = array.array('B')
+        self.wordoffsets = array.array('i', [0])
+        self.attrs = {}
+        
+        self.strings = []
+        self.stringids = {}
+    
+    def __len__(self):
+        return len(self.kinds)
+    
+    def __repr__(self):
+        return u"TokenBuffer(%s)" % repr(self.towords())
+    
+    wordcount = property(lambda self: len(self.wordoffsets) - 1)
+    
+    @classmethod
+    def fromwords(cls, words):
+        buffer = cls()
+        for word in words:
+            for token in word:
+                if isinstance(token, model.Pinyin):
+                    buffer.append(PINYIN, token.word, token.toneinfo.written, token.toneinfo.spoken, token.htmlattrs)
+                elif isinstance(token, model.TonedCharacter):
+                    buffer.append(TONEDCHARACTER, unicode(token), token.toneinfo.written, token.toneinfo.spoken, token.htmlattrs)
+                else:
+                    buffer.append(TEXT, unicode(token), 0, 0, token.htmlattrs)
+            
+            buffer.endword()
+        
+        return buffer
+    
+    def towords(self):
+        words = []
+        for n in range(0, self.wordcount):
+            words.append(model.Word(*[self.token(i) for i in range(self.wordoffsets[n], self.wordoffsets[n + 1])]))
+        
+        return words
+    
+    def token(self, i):
+        string, htmlattrs = self.strings[self.ids[i]], self.attrs.get(i)
+        if htmlattrs is not None:
+            htmlattrs = htmlattrs.copy()
+        
+        if self.kinds[i] == PINYIN:
+            return model.Pinyin(string, model.ToneInfo(written=self.written[i], spoken=self.spoken[i]), htmlattrs)
+        elif self.kinds[i] == TONEDCHARACTER:
+            return model.TonedCharacter(string, model.ToneInfo(written=self.written[i], spoken=self.spoken[i]), htmlattrs)
+        else:
+            return model.Text(string, htmlattrs)
+    
+    def append(self, kind, string, written, spoken, htmlattrs=None):
+        stringid = self.stringids.get(string)
+        if stringid is None:
+            stringid = self.stringids[string] = len(self.strings)
+            self.strings.append(string)
+        
+        if htmlattrs:
+            self.attrs[len(self.kinds)] = htmlattrs
+        
+        self.kinds.append(kind)
+        self.ids.append(stringid)
+        self.written.append(written)
+        self.spoken.append(spoken)
+    
+    def endword(self):
+        self.wordoffsets.append(len(self.kinds))
+    
+    def string(self, i):
+        return self.strings[self.ids[i]]
+    
+    def iser(self, i):
+        if self.written[i] != 5:
+            return False
+        elif self.kinds[i] == PINYIN:
+            return self.string(i).lower() == u"r"
+        elif self.kinds[i] == TONEDCHARACTER:
+            return self.string(i) in [u"儿", u"兒"]
+        else:
+            return False
+    
+    # Rebuilds the arrays, replacing each token by the list of tokens returned by the supplied
+    # function. Tokens are given either as the index of an existing token, or as a tuple of the
+    # arguments to append. This is used by the transformations that change the number of tokens.
+    def rewrite(self, replacements):
+        result = TokenBuffer()
+        result.strings, result.stringids = self.strings, self.stringids
+        for n in range(0, self.wordcount):
+            for i in range(self.wordoffsets[n], self.wordoffsets[n + 1]):
+                for replacement in replacements(i):
+                    if isinstance(replacement, tuple):
+                        result.append(*replacement)
+                    else:
+                        result.append(self.kinds[replacement], self.string(replacement), self.written[replacement], self.spoken[replacement], self.attrs.get(replacement))
+            
+            result.endword()
+        
+        self.kinds, self.ids, self.written, self.spoken = result.kinds, result.ids, result.written, result.spoken
+        self.wordoffsets, self.attrs = result.wordoffsets, result.attrs
+    
+    """
+    Apply tone sandhi rules to rewrite the spoken tones. See transformations.tonesandhi.
+    """
+    def tonesandhi(self):
+        # 1) Gather the tone contour
+        contour = array.array('b')
+        for n in range(0, self.wordcount):
+            for i in range(self.wordoffsets[n], self.wordoffsets[n + 1]):
+                if self.kinds[i] != TEXT:
+                    contour.append(self.written[i])
+                elif len(self.string(i).strip()) != 0:
+                    contour.append(transformations.CONTOURTEXT)
+            
+            contour.append(transformations.CONTOURWORDEND)
+        
+        # 2) Rewrite it, and 3) apply the new contour to the spoken tones
+        transformations.sandhitones(contour)
+        position = 0
+        for n in range(0, self.wordcount):
+            for i in range(self.wordoffsets[n], self.wordoffsets[n + 1]):
+                if self.kinds[i] != TEXT:
+                    self.spoken[i] = contour[position]
+                    position += 1
+                elif len(self.string(i).strip()) != 0:
+                    position += 1
+            
+            position += 1
+    
+    """
+    Remove all r5 tokens. See transformations.trimerhua.
+    """
+    def trimerhua(self):
+        self.rewrite(lambda i: (not self.iser(i) and [i]) or [])
+    
+    """
+    Colorize tokens according to their tones, keeping any colors that are already present.
+    See transformations.colorize.
+    """
+    def colorize(self, colors):
+        palette = transformations.palettefor(colors)
+        for i in range(0, len(self.kinds)):
+            if self.kinds[i] == TEXT:
+                continue
+            
+            htmlattrs = self.attrs.get(i, {})
+            if "color" in htmlattrs:
+                continue
+            
+            htmlattrs = htmlattrs.copy()
+            htmlattrs["color"] = palette.color(self.written[i] - 1, self.spoken[i] != self.written[i])
+            self.attrs[i] = htmlattrs
+    
+    """
+    Replace occurences of the expression with the masking character. See transformations.maskhanzi.
+    """
+    def maskhanzi(self, expression, maskingcharacter):
+        masker = transformations.HanziMasker(expression, maskingcharacter)
+        
+        def mask(i):
+            string = self.string(i)
+            if self.kinds[i] == TEXT:
+                masked = masker.masktext(string)
+                return (masked == string and [i]) or [(TEXT, masked, 0, 0, self.attrs.get(i))]
+            elif self.kinds[i] == TONEDCHARACTER and string in expression:
+                return [(TEXT, maskingcharacter, 0, 0)]
+            else:
+                return [i]
+        
+        self.rewrite(mask)
+    
+    """
+    Insert spaces between pinyin while being smart about punctuation. See model.formatreadingfordisplay.
+    """
+    def formatreadingfordisplay(self):
+        visitor = model.FormatReadingForDisplayVisitor()
+        
+        def space(i):
+            if self.kinds[i] == PINYIN:
+                needsspace = visitor.needsspacebeforepinyin(self.iser(i))
+            else:
+                needsspace = visitor.needsspacebeforetext(self.string(i))
+            
+            return (needsspace and [(TEXT, u" ", 0, 0), i]) or [i]
+        
+        self.rewrite(space)
+    
+    """
+    Flattens the tokens down into a single string. See model.flatten.
+    """
+    def flatten(self, tonify=False):
+        output = []
+        for i in range(0, len(self.kinds)):
+            string = self.string(i)
+            if self.kinds[i] == PINYIN:
+                if tonify:
+                    string = model.tonifier.tonifysyllable(string, self.written[i])
+                elif self.written[i] != 5:
+                    string = string + str(self.written[i])
+            
+            color = self.attrs.get(i, {}).get("color")
+            if color is not None:
+                output.append('<span style="color:%s">%s</span>' % (color, string))
+            else:
+                output.append(string)
+        
+        return u"".join(output)
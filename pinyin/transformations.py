@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import copy
-import cStringIO
 import random
 import re
 import itertools
@@ -15,6 +14,10 @@ from utils import *
 # TODO: apply tone sandhi at the dictionary stage, to save having to do it in 3 places in the updater?
 # Only thing to worry about is loss of accuracy due to the decreased amount of context...
 
+# Markers used in tone contours alongside the tones themselves
+CONTOURTEXT = 0
+CONTOURWORDEND = -1
+
 """
 Apply tone sandhi rules to rewrite the tones in the given string. For the rules
 see: <http://en.wikipedia.org/wiki/Standard_Mandarin#Tone_sandhi>
@@ -22,86 +25,134 @@ see: <http://en.wikipedia.org/wiki/Standard_Mandarin#Tone_sandhi>
 NB: we don't implement this very well yet. Give it time..
 """
 def tonesandhi(words):
-    # 1) Gather the tone contour into a string
-    tonecontourio = cStringIO.StringIO()
-    gathervisitor = GatherToneContourVisitor(tonecontourio)
-    for word in words:
-        word.accept(gathervisitor)
-        tonecontourio.write("~")
-    tonecontour = tonecontourio.getvalue()
-    tonecontourio.close()
-    
-    
-    # 2) Rewrite it (ewww!)
-    
-    log.info("Rewriting tone sandhi for contour %s", tonecontour)
-    
-    # NB: must match strings of ~ in the following in order to ignore words
-    # which consist entirely of blank space. Tian'a, this is unbelievably horrible!
-    
-    # Top priority:
-    #  33~3 -> 22~3
-    #  3~33 -> 3~23
-    # (and the more general sandhi effect with strings of length > 3)
-    def dealWithThrees(match):
-        # a) Split the match into a list of strings of 3 per word
-        wordcontours = (match.group(1) or "").split("~")[:-1] + [match.group(2)]
-        
-        # b) Build the result
-        #   i) For everything but the last word, turn the tone into 2 if it is monosyllabic
-        maketwosifpoly = lambda what: len(what) == 1 and what or '2' * len(what)
-        #   ii) For the last word, always end with a sequence of 2s followed by a 3
-        makeprefixtwos = lambda what: '2' * (len(what) - 1) + '3'
-        replacement = "~".join([maketwosifpoly(wordcontour) for wordcontour in wordcontours[:-1]] + [makeprefixtwos(wordcontours[-1])])
+    return tonesandhimany([words])[0]
+
+"""
+Apply tone sandhi to each of several readings, such as all the meanings of a word, at once.
+The readings are independent: sandhi never crosses from one to the next.
+"""
+def tonesandhimany(readings):
+    # 1) Gather the tone contour of all the readings. We seperate the readings with some text,
+    # which no sandhi rule can see past.
+    contour = []
+    for words in readings:
+        for word in words:
+            for token in word:
+                if isinstance(token, Text):
+                    if len(token.strip()) != 0:
+                        contour.append(CONTOURTEXT)
+                else:
+                    contour.append(token.toneinfo.written)
+            
+            contour.append(CONTOURWORDEND)
         
-        log.debug("Rewrote complex tone sandhi %s into %s", match.group(0), replacement)
-        return replacement
-    tonecontour = re.sub(r"((?:3+\~+)*)(3+)", dealWithThrees, tonecontour)
+        contour.append(CONTOURTEXT)
     
-    # Low priority (let others take effect first):
-    #  33  -> 23 (though this is already caught by the code above, actually)
-    #  3~3 -> 2~3
-    tonecontour = re.sub(r"3(\~*)3", r"2\g<1>3", tonecontour)
+    # 2) Rewrite it
+    sandhitones(contour)
     
-    log.info("Final contour computed as %s", tonecontour)
+    # 3) Apply the new contour to the words, only building new tokens where the spoken tone changed
+    finalreadings = []
+    position = 0
+    for words in readings:
+        finalwords = []
+        for word in words:
+            finalword = Word()
+            for token in word:
+                if isinstance(token, Text):
+                    if len(token.strip()) != 0:
+                        position += 1
+                else:
+                    spoken = contour[position]
+                    position += 1
+                    
+                    if spoken != token.toneinfo.spoken:
+                        if isinstance(token, Pinyin):
+                            token = Pinyin(token.word, ToneInfo(written=token.toneinfo.written, spoken=spoken), token.htmlattrs)
+                        else:
+                            token = TonedCharacter(unicode(token), ToneInfo(written=token.toneinfo.written, spoken=spoken), token.htmlattrs)
+                
+                finalword.append(token)
+            
+            finalwords.append(finalword)
+            position += 1
+        
+        finalreadings.append(finalwords)
+        position += 1
     
-    # 3) Apply the new contour to the words
-    finalwords = []
-    tonecontourqueue = list(tonecontour[::-1])
-    applyvisitor = ApplyToneContourVisitor(tonecontourqueue)
-    for word in words:
-        finalwords.append(word.map(applyvisitor))
-        assert tonecontourqueue.pop() == "~"
-    return finalwords
-
-class GatherToneContourVisitor(TokenVisitor):
-    def __init__(self, tonecontourio):
-        self.tonecontourio = tonecontourio
+    return finalreadings
 
-    def visitText(self, text):
-        if len(text.strip()) != 0:
-            self.tonecontourio.write("_")
+"""
+Rewrites a tone contour in place to reflect the tones that are actually spoken. The contour holds the
+written tone of each token, CONTOURTEXT for non-blank text and CONTOURWORDEND after each word.
 
-    def visitPinyin(self, pinyin):
-        self.tonecontourio.write(str(pinyin.toneinfo.written))
+This is a single left-to-right pass with two rules, the second applying to the output of the first:
+ 1) In a chain of runs of 3rd tones where the runs are seperated only by word boundaries, every run
+    but the last turns into 2nd tones if it is polysyllabic, and the last run becomes 2s followed
+    by a final 3. So 33~3 -> 22~3 and 3~33 -> 3~23.
+ 2) Then, a 3rd tone followed by another 3rd tone (possibly across word boundaries) becomes a 2nd
+    tone, with the second of the pair not eligible to start another pair. So 3~3 -> 2~3.
+"""
+def sandhitones(contour):
+    # State for rule 1: the start of the run of 3s we are in (if any), and a run we have finished
+    # but can't rewrite until we know whether another run follows it in the same chain
+    runstart, pendingrun = None, None
+    # State for rule 2: the position of a 3 in the output of rule 1 which might pair with a later one
+    pendingthree = [None]
+    
+    def emit(position, tone):
+        # Feed the output of rule 1 to rule 2. Word ends never affect rule 2, so the caller need
+        # not feed them in order with the rest of the contour.
+        contour[position] = tone
+        if tone == 3:
+            if pendingthree[0] is None:
+                pendingthree[0] = position
+            else:
+                contour[pendingthree[0]] = 2
+                pendingthree[0] = None
+        elif tone != CONTOURWORDEND:
+            pendingthree[0] = None
+    
+    def emitrun((start, end), islast):
+        if islast:
+            for position in range(start, end - 1):
+                emit(position, 2)
+            emit(end - 1, 3)
+        else:
+            # Monosyllabic words keep their 3rd tone at this stage
+            monosyllabic = (end - start) == 1
+            for position in range(start, end):
+                if monosyllabic:
+                    emit(position, 3)
+                else:
+                    emit(position, 2)
+    
+    for position, tone in enumerate(contour):
+        if tone == 3:
+            if runstart is None:
+                # A new run: if it follows another run across word boundaries, that one wasn't the last
+                if pendingrun is not None:
+                    emitrun(pendingrun, False)
+                    pendingrun = None
+                runstart = position
+            continue
         
-    def visitTonedCharacter(self, tonedcharacter):
-        self.tonecontourio.write(str(tonedcharacter.toneinfo.written))
-
-class ApplyToneContourVisitor(TokenVisitor):
-    def __init__(self, tonecontourqueue):
-        self.tonecontourqueue = tonecontourqueue
+        if runstart is not None:
+            pendingrun, runstart = (runstart, position), None
+        
+        if tone != CONTOURWORDEND:
+            # Anything but a word boundary breaks the chain of runs
+            if pendingrun is not None:
+                emitrun(pendingrun, True)
+                pendingrun = None
+            emit(position, tone)
     
-    def visitText(self, text):
-        if len(text.strip()) != 0:
-            assert self.tonecontourqueue.pop() in "_"
-        return text
-
-    def visitPinyin(self, pinyin):
-        return Pinyin(pinyin.word, ToneInfo(written=pinyin.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
+    if runstart is not None:
+        pendingrun = (runstart, len(contour))
+    if pendingrun is not None:
+        emitrun(pendingrun, True)
     
-    def visitTonedCharacter(self, tonedcharacter):
-        return TonedCharacter(unicode(tonedcharacter), ToneInfo(written=tonedcharacter.toneinfo.written, spoken=int(self.tonecontourqueue.pop())))
+    return contour
 
 """
 Remove all r5 characters from the supplied words.
@@ -131,13 +182,13 @@ Colorize readings according to the reading in the Pinyin.
 * 2009 rewrites by Max Bolingbroke <batterseapower@hotmail.com>
 * 2009 original version by Nick Cook <nick@n-line.co.uk> (http://www.n-line.co.uk)
 """
-def colorize(colorlist, words):
-    return [word.map(ColorizerVisitor(colorlist)) for word in words]
+def colorize(colors, words):
+    visitor = ColorizerVisitor(palettefor(colors))
+    return [word.map(visitor) for word in words]
 
 class ColorizerVisitor(TokenVisitor):
-    def __init__(self, colorlist):
-        self.colorlist = colorlist
-        log.info("Using color list %s", self.colorlist)
+    def __init__(self, palette):
+        self.palette = palette
         
     def visitText(self, text):
         return text
@@ -149,23 +200,45 @@ class ColorizerVisitor(TokenVisitor):
         return self.colorize(tonedcharacter, lambda htmlattrs: TonedCharacter(unicode(tonedcharacter), tonedcharacter.toneinfo, htmlattrs))
     
     def colorize(self, token, rebuild):
-        # Colors should always be based on the written tone, but they will be
-        # made lighter if a sandhi applies
-        color = self.colorlist[token.toneinfo.written - 1]
-        if token.toneinfo.spoken != token.toneinfo.written:
-            color = sandhifycolor(color)
-        
         # Make sure we don't overwrite any colors that the user set up.
         # Perhaps this is suboptimal, but it is the only sane thing to do -
         # in particular since it means we don't screw up sandhi coloring
         # when coloring a "Reading" field which was set up by the PyTK.
         if "color" not in token.htmlattrs:
             htmlattrs = token.htmlattrs.copy()
-            htmlattrs["color"] = color
+            htmlattrs["color"] = self.palette.tonecolor(token.toneinfo)
             return rebuild(htmlattrs)
         else:
             return token
 
+"""
+A list of colors (the tone colors followed by any others, such as the quick access colors)
+together with the lightened versions we use when a sandhi applies. Building one of these is
+relatively expensive, so Config.palette keeps one around for the current settings.
+"""
+class ColorPalette(object):
+    def __init__(self, colors):
+        self.colors = tuple(colors)
+        self.sandhicolors = tuple([sandhifycolor(color) for color in colors])
+    
+    def color(self, index, sandhify=False):
+        if sandhify:
+            return self.sandhicolors[index]
+        else:
+            return self.colors[index]
+    
+    def tonecolor(self, toneinfo):
+        # Colors should always be based on the written tone, but they will be
+        # made lighter if a sandhi applies
+        return self.color(toneinfo.written - 1, toneinfo.spoken != toneinfo.written)
+
+# Lets the transformations accept either a palette or a plain list of tone colors
+def palettefor(colors):
+    if isinstance(colors, ColorPalette):
+        return colors
+    else:
+        return ColorPalette(colors)
+
 def sandhifycolor(color):
     # Lighten up the color by halving saturation and increasing value
     # by 20%. This was chosen to match Nicks choice of how to change green
@@ -175,10 +248,48 @@ def sandhifycolor(color):
     r, g, b = parseHtmlColor(color)
     h, s, v = rgbToHSV(r, g, b)
     r, g, b = hsvToRGB(h, s * 0.5, min(v * 1.2, 1.0))
-    finalcolor = toHtmlColor(r, g, b)
+    return toHtmlColor(r, g, b)
+
+"""
+Renders readings into their final HTML in a single pass, fusing formatreadingfordisplay, colorize
+and flatten. Everything that depends only on the settings is worked out up front, so build one
+of these per configuration and reuse it.
+"""
+class ReadingRenderer(object):
+    def __init__(self, colors, tonify, lowercase=False):
+        self.palette = colors is not None and palettefor(colors) or None
+        self.tonify = tonify
+        self.lowercase = lowercase
     
-    log.info("Sandhified %s to %s", color, finalcolor)
-    return finalcolor
+    def render(self, words):
+        output = []
+        spacer = FormatReadingForDisplayVisitor()
+        for word in words:
+            for token in word:
+                if isinstance(token, Pinyin):
+                    needsspace = spacer.needsspacebeforepinyin(token.iser)
+                    text = (self.tonify and token.tonifiedformat()) or unicode(token)
+                    toneinfo = token.toneinfo
+                else:
+                    needsspace = spacer.needsspacebeforetext(token)
+                    text = unicode(token)
+                    toneinfo = getattr(token, "toneinfo", None)
+                
+                if needsspace:
+                    output.append(u" ")
+                
+                # Colors that the user set up take priority over the ones we generate
+                color = token.htmlattrs.get("color")
+                if color is None and toneinfo is not None and self.palette is not None:
+                    color = self.palette.tonecolor(toneinfo)
+                
+                if color is not None:
+                    output.append(u'<span style="color:%s">%s</span>' % (color, text))
+                else:
+                    output.append(text)
+        
+        output = u"".join(output)
+        return (self.lowercase and output.lower()) or output
 
 """
 Output audio reading corresponding to a textual reading.
@@ -219,22 +330,8 @@ class PinyinAudioReadingsVisitor(TokenVisitor):
         pass
 
     def visitPinyin(self, pinyin):
-        # Find possible base sounds we could accept
-        possiblebases = [pinyin.numericformat(hideneutraltone=False, tone="spoken")]
-        substitutions = waysToSubstituteAwayUUmlaut(pinyin.word)
-        if pinyin.toneinfo.spoken == 5:
-            # Sometimes we can replace tone 5 with 4 in order to deal with lack of '[xx]5.ogg's
-            possiblebases.extend([pinyin.word, pinyin.word + '4'])
-        elif substitutions is not None:
-            # Typically u: is written as v in filenames
-            possiblebases.extend([substitution + str(pinyin.toneinfo.spoken) for substitution in substitutions])
-    
-        # Find path to first suitable media in the possibilty list
-        for possiblebase in possiblebases:
-            media = self.mediapack.mediafor(possiblebase, self.audioextensions)
-            if media:
-                break
-    
+        # The pack knows which of its files best suits each syllable
+        media = self.mediapack.mediaforsyllable(pinyin.word, pinyin.toneinfo.spoken, self.audioextensions)
         if media:
             # If we've managed to find some media, we can put it into the output:
             self.output.append(media)
@@ -250,25 +347,106 @@ class PinyinAudioReadingsVisitor(TokenVisitor):
 Replace occurences of the expression in the words with the masking character.
 """
 def maskhanzi(expression, maskingcharacter, words):
-    return [word.map(MaskHanziVisitor(expression, maskingcharacter)) for word in words]
+    return HanziMasker(expression, maskingcharacter).mask(words)
 
-class MaskHanziVisitor(TokenVisitor):
+"""
+Masks the Hanzi of an expression wherever they occur in some text. Any run of characters that
+occurs in the expression is masked, preferring the longest such run at each position, so build
+one of these per expression and use it on all the meanings.
+"""
+class HanziMasker(object):
     def __init__(self, expression, maskingcharacter):
         self.expression = expression
         self.maskingcharacter = maskingcharacter
+        
+        # Build a suffix automaton recognising every substring of the runs of Hanzi in the expression.
+        # The runs are joined with a character that can't be Hanzi so no match can span two runs.
+        # This takes linear time and space, unlike enumerating the substrings themselves.
+        self.transitions, self.links, self.lengths = [{}], [-1], [0]
+        last = 0
+        for c in self.seperator.join(self.hanziruns(expression)):
+            last = self.extend(last, c)
     
-    def visitText(self, text):
-        for substring in substrings(self.expression):
-            if all([isHanzi(c) for c in substring]):
-                text = text.replace(substring, self.maskingcharacter)
+    seperator = u"\uffff"
+    
+    def hanziruns(self, expression):
+        runs, run = [], u""
+        for c in expression + u" ":
+            if isHanzi(c):
+                run += c
+            elif run:
+                runs.append(run)
+                run = u""
+        
+        return runs
+    
+    def newstate(self, length, transitions, link):
+        self.transitions.append(transitions)
+        self.lengths.append(length)
+        self.links.append(link)
+        return len(self.transitions) - 1
+    
+    # The standard online suffix automaton construction
+    def extend(self, last, c):
+        current = self.newstate(self.lengths[last] + 1, {}, 0)
+        state = last
+        while state != -1 and c not in self.transitions[state]:
+            self.transitions[state][c] = current
+            state = self.links[state]
+        
+        if state != -1:
+            target = self.transitions[state][c]
+            if self.lengths[state] + 1 == self.lengths[target]:
+                self.links[current] = target
+            else:
+                clone = self.newstate(self.lengths[state] + 1, self.transitions[target].copy(), self.links[target])
+                while state != -1 and self.transitions[state].get(c) == target:
+                    self.transitions[state][c] = clone
+                    state = self.links[state]
+                
+                self.links[target] = self.links[current] = clone
+        
+        return current
+    
+    def mask(self, words):
+        visitor = MaskHanziVisitor(self)
+        return [word.map(visitor) for word in words]
+    
+    def masktext(self, text):
+        # Scan through the text, masking the longest match starting at each position. On a mismatch
+        # we only ever need to back up one character, so this is linear in the length of the text.
+        output, i = [], 0
+        while i < len(text):
+            state, j = 0, i
+            while j < len(text) and text[j] != self.seperator and text[j] in self.transitions[state]:
+                state = self.transitions[state][text[j]]
+                j += 1
+            
+            if j > i:
+                output.append(self.maskingcharacter)
+                i = j
+            else:
+                output.append(text[i])
+                i += 1
+        
+        return u"".join(output)
 
-        return Text(text)
+class MaskHanziVisitor(TokenVisitor):
+    def __init__(self, masker):
+        self.masker = masker
+    
+    def visitText(self, text):
+        masked = self.masker.masktext(text)
+        if masked == text:
+            return text
+        else:
+            return Text(masked, text.htmlattrs)
 
     def visitPinyin(self, pinyin):
         return pinyin
 
     def visitTonedCharacter(self, tonedcharacter):
-        if unicode(tonedcharacter) in self.expression:
-            return Text(self.maskingcharacter)
+        if unicode(tonedcharacter) in self.masker.expression:
+            return Text(self.masker.maskingcharacter)
         else:
             return tonedcharacter
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    try:
+        # Python 2.4 doesn't come with sqlite3, but Anki ships the library it grew out of
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        # We can still cache translations for the session, we just won't remember them afterwards
+        sqlite3 = None
+
+from logger import log
+
+
+# Separates the meanings of a translation in the database: we never see it in a real one
+meaningseparator = u"\u001f"
+
+"""
+Remembers the results of online translations across sessions, so that translating something
+again doesn't need the network. The results are the meanings as a list of strings, or None if
+there was no translation. Entries older than the time to live are ignored, and the oldest
+entries are evicted once there are more than maxentries of them.
+
+Recently used translations are also kept in memory, so looking them up again is quick. If the
+database can't be opened or used then we just make do with the memory.
+"""
+class TranslationCache(object):
+    def __init__(self, path, ttl=30 * 24 * 60 * 60, maxentries=20000, maxmemory=1000, clock=time.time):
+        self.path = path
+        self.ttl = ttl
+        self.maxentries = maxentries
+        self.maxmemory = maxmemory
+        self.clock = clock
+        
+        self.memory = {}
+        self.lock = threading.Lock()
+        self.connection = None
+        self.connectionfailed = sqlite3 is None
+        self.puts = 0
+    
+    def get(self, query, destlanguage):
+        self.lock.acquire()
+        try:
+            key = (query, destlanguage)
+            entry = self.memory.get(key)
+            if entry is None:
+                entry = self.load(key)
+                if entry is not None:
+                    self.remember(key, entry)
+            
+            if entry is None or self.clock() - entry[0] > self.ttl:
+                return False, None
+            else:
+                return True, entry[1]
+        finally:
+            self.lock.release()
+    
+    def put(self, query, destlanguage, meanings):
+        self.lock.acquire()
+        try:
+            key, entry = (query, destlanguage), (self.clock(), meanings)
+            self.remember(key, entry)
+            self.store(key, entry)
+        finally:
+            self.lock.release()
+    
+    def remember(self, key, entry):
+        # Like the update plans, there is no point being clever about which entries we forget
+        if len(self.memory) >= self.maxmemory:
+            self.memory.clear()
+        
+        self.memory[key] = entry
+    
+    def connect(self):
+        if self.connection is None and not self.connectionfailed:
+            try:
+                # NB: updates happen on a background thread as well as the UI thread, but we hold the lock
+                connection = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+                connection.execute("CREATE TABLE IF NOT EXISTS translations (query TEXT NOT NULL, destlanguage TEXT NOT NULL, meanings TEXT, created REAL NOT NULL, PRIMARY KEY (query, destlanguage))")
+                connection.execute("CREATE INDEX IF NOT EXISTS translationscreated ON translations (created)")
+                connection.commit()
+                self.connection = connection
+            except sqlite3.Error, e:
+                log.exception("Couldn't open the translation cache %s, so translations will only be cached for this session", self.path)
+                self.connectionfailed = True
+                return None
+            
+            # Trim anything left over from previous sessions
+            self.prune()
+        
+        return self.connection
+    
+    def load(self, key):
+        connection = self.connect()
+        if connection is None:
+            return None
+        
+        try:
+            row = connection.execute("SELECT created, meanings FROM translations WHERE query = ? AND destlanguage = ?", key).fetchone()
+        except sqlite3.Error, e:
+            log.exception("Error while reading from the translation cache")
+            return None
+        
+        if row is None:
+            return None
+        
+        created, meanings = row
+        return created, (meanings is not None and [meanings.split(meaningseparator)] or [None])[0]
+    
+    def store(self, key, entry):
+        connection = self.connect()
+        if connection is None:
+            return
+        
+        created, meanings = entry
+        try:
+            connection.execute("INSERT OR REPLACE INTO translations (query, destlanguage, meanings, created) VALUES (?, ?, ?, ?)",
+                               key + ((meanings is not None and [meaningseparator.join(meanings)] or [None])[0], created))
+            connection.commit()
+        except sqlite3.Error, e:
+            log.exception("Error while writing to the translation cache")
+            return
+        
+        # Don't count the entries after every single translation
+        self.puts += 1
+        if self.puts % 100 == 0:
+            self.prune()
+    
+    def prune(self):
+        try:
+            self.connection.execute("DELETE FROM translations WHERE created < ?", (self.clock() - self.ttl,))
+            
+            excess = self.connection.execute("SELECT COUNT(*) FROM translations").fetchone()[0] - self.maxentries
+            if excess > 0:
+                log.info("Evicting the %d oldest translations from the cache", excess)
+                self.connection.execute("DELETE FROM translations WHERE rowid IN (SELECT rowid FROM translations ORDER BY created LIMIT ?)", (excess,))
+            
+            self.connection.commit()
+        except sqlite3.Error, e:
+            log.exception("Error while pruning the translation cache")
+    
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+        finally:
+            self.lock.release()
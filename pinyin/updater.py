@@ -22,7 +22,6 @@ from logger import log
 
 # TODO:
 #  * Only update fields that could have been changed by the update (quite important for audio!)
-#  * (Perhaps) record hash in generated tag, so we can avoid recomputing more generally
 
 class FieldUpdater(object):
     def __init__(self, field, *args):
@@ -38,7 +37,8 @@ class FieldUpdater(object):
         # NB: this is not quite right. The user might have changed whether there is a mw field independently of whether the
         # contents of the field we are considering has changed. However, this bug should be very hard to hit (TODO: fix it).
         delta = value is not None and { self.field : value, "mwfieldinfact" : "mw" in fact } or {}
-        graph = self.graphbasedupdater.filledgraph(fact, delta)
+        stamps = {}
+        graph = self.graphbasedupdater.filledgraph(fact, delta, stamps)
 
         # For the same reason that fields may be missing from the graph but present in the fact,
         # even the field we are updating can be missing. For example, this happens when tabbing
@@ -66,7 +66,13 @@ class FieldUpdater(object):
                 # This can happen e.g. with the "meaning" field if there is no definition in the dictionary.
                 if value is not None:
                     # Last-ditch attempt to convert to unicode to intercept any ASCII that slipped though the net
-                    fact[field] = (graph[field][0] and factproxy.markgeneratedfield or (lambda x: x))(unicode(value))
+                    value = unicode(value)
+                    if graph[field][0]:
+                        value = factproxy.markgeneratedfield(value, stamps.get(field))
+                    
+                    # Leave fields that are already up to date alone, so refreshing a fact is mostly a no-op
+                    if fact[field] != value:
+                        fact[field] = value
 
 class FieldUpdaterFromExpression(FieldUpdater):
     def __init__(self, *args):
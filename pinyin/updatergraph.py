@@ -1,29 +1,37 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import os
 
 import config
 from db import database
 import dictionary
 import dictionaryonline
-from factproxy import isblankfield, isgeneratedfield, unmarkgeneratedfield
+from factproxy import generatedfieldstamp, isblankfield, isgeneratedfield, unmarkgeneratedfield
 import media
 import meanings
+import metrics
 import numbers
 import model
+import simptrad
+import tokenbuffer
 import transformations
 from utils import * # NB: we get "all" from here on Python 2.4
 import random
 import re
+import threading
+import zlib
 
 from logger import log
 
 
 def preparetokens(config, tokens):
+    # Colorize in place on the compact representation, since all we want at the end is the flattened string
+    buffer = tokenbuffer.TokenBuffer.fromwords(tokens)
     if config.colorizedpinyingeneration:
-        tokens = transformations.colorize(config.tonecolors, tokens)
+        buffer.colorize(config.palette)
 
-    return model.flatten(tokens, tonify=config.shouldtonify)
+    return buffer.flatten(tonify=config.shouldtonify)
 
 def unpreparetokens(flat):
     return [model.Word(*model.tokenize(striphtml(flat)))]
@@ -44,18 +52,22 @@ def generateaudio(notifier, mediamanager, config, dictreading):
     random.shuffle(possibilities)
     
     if not possibilities:
+        # The user might install an audio pack later on, so try again next time
+        updatermemo.transient()
         return u""
     else:
-        # Minimize the number of new sounds we have to import, to reduce the bloat in the audio count
-        mediapack, output, _mediamissingcount = maximumby(using(lambda (mediapack, output, _): count(output, lambda outputfile: mediamanager.alreadyimported(os.path.join(mediapack.packpath, outputfile)))), possibilities)
+        # Minimize the number of new sounds we have to import, to reduce the bloat in the audio count.
+        # NB: only look at what the deck has once, rather than for every sound of every possibility
+        alreadyimported = mediamanager.alreadyimportedsnapshot()
+        mediapack, output, mediamissingcount = maximumby(using(lambda (mediapack, output, _): count(output, lambda outputfile: alreadyimported(os.path.join(mediapack.packpath, outputfile)))), possibilities)
+        if mediamissingcount > 0:
+            # As above, the user may yet install the missing sounds
+            updatermemo.transient()
     
-        # Construct the string of audio tags from the optimal choice of sounds
-        output_tags = u""
-        for outputfile in output:
-            # Install required media in the deck as we go, getting the canonical string to insert into the sound field upon installation
-            output_tags += u"[sound:%s]" % mediamanager.importtocurrentdeck(os.path.join(mediapack.packpath, outputfile))
-    
-        return output_tags
+        # Install the required media in the deck in one go, getting the canonical strings to insert into the sound field,
+        # and construct the string of audio tags from the optimal choice of sounds
+        imported = mediamanager.importmany([os.path.join(mediapack.packpath, outputfile) for outputfile in output])
+        return u"".join([u"[sound:%s]" % filename for filename in imported])
 
 class Reformatter(object):
     def __init__(self, notifier, mediamanager, config):
@@ -109,24 +121,123 @@ class Reformatter(object):
         
         return graph[field][1]()
 
+"""
+A bounded table of the results of the pure updater functions. It is shared between all the
+GraphBasedUpdaters, so that facts with the same expression don't repeat the same lookups.
+
+Results are keyed on the arguments together with a fingerprint of the settings the function
+depends on, so a change to the configuration (including the dictionary language) means the
+old results are simply no longer found. When the table is full the oldest results are dropped.
+Everything is forgotten if the dictionaries change, and a function can ask for the result it
+is about to return to be forgotten straight away by calling transient (e.g. if it is an error).
+"""
+class UpdaterMemo(object):
+    def __init__(self, maxsize=5000):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.dictionaryversion = None
+        self.clear()
+    
+    def __len__(self):
+        return len(self.results)
+    
+    def clear(self):
+        self.results = {}
+        self.order = collections.deque()
+    
+    def usedictionaryversion(self, dictionaryversion):
+        self.lock.acquire()
+        try:
+            if dictionaryversion != self.dictionaryversion:
+                log.info("The dictionaries have changed, so forgetting %d memoized results", len(self.results))
+                self.dictionaryversion = dictionaryversion
+                self.clear()
+        finally:
+            self.lock.release()
+    
+    def transient(self):
+        self.local.transient = True
+    
+    # Returns the result of the function along with whether it (or anything it used) was transient
+    def calltransient(self, function, *args):
+        outertransient = getattr(self.local, "transient", False)
+        self.local.transient = False
+        try:
+            result = function(*args)
+            transient = self.local.transient
+        finally:
+            # If a memoized function used this result then its own result can't be remembered either
+            self.local.transient = outertransient or self.local.transient
+        
+        return result, transient
+    
+    def memoize(self, name, function, fingerprint):
+        def go(*args):
+            key = (name, memokey(fingerprint())) + tuple([memokey(arg) for arg in args])
+            if key in self.results:
+                return self.results[key]
+            
+            # NB: we don't remember failures, as they might be transient (e.g. no internet connection)
+            result, transient = self.calltransient(function, *args)
+            if result is not None and not transient:
+                self.remember(key, result)
+            
+            return result
+        
+        go.__name__ = function.__name__
+        return go
+    
+    def remember(self, key, result):
+        # NB: updates can happen on a background thread at the same time as on the UI thread
+        self.lock.acquire()
+        try:
+            if key not in self.results and len(self.order) >= self.maxsize:
+                del self.results[self.order.popleft()]
+            
+            if key not in self.results:
+                self.order.append(key)
+            
+            self.results[key] = result
+        finally:
+            self.lock.release()
+
+# Readings are lists of Words, which aren't hashable: use their representation instead
+def memokey(thing):
+    if isinstance(thing, list):
+        return repr(thing)
+    elif isinstance(thing, tuple):
+        return tuple([memokey(item) for item in thing])
+    else:
+        return thing
+
+updatermemo = UpdaterMemo()
+
+# The memoized dictionary lookups that are worth doing for a whole batch of expressions at once
+prefetchablefields = ["dictreading", "dictmeaningsandsource", "dictmws"]
+
 class GraphBasedUpdater(object):
     def __init__(self, notifier, mediamanager, config):
         self.notifier = notifier
         self.mediamanager = mediamanager
         self.config = config
         self.dictionaries = dictionary.PinyinDictionary.loadall()
+        self.readingrendererforkey = (None, None)
+        
+        # Anything we remember from older dictionaries might be out of date now
+        updatermemo.usedictionaryversion(dictionary.PinyinDictionary.version())
         
         self.updaters = [
-                ("simptrad", self.expression2simptrad, ("expression",)),
+                ("simptrad", self.memoized("simptrad", self.expression2simptrad, "fallbackongoogletranslate", "googletranslatestate"), ("expression",)),
                 ("trad", liftm_none(lambda x: x["simp"] != x["trad"] and x["trad"] or ""), ("simptrad",)),
                 ("simp", liftm_none(lambda x: x["simp"] != x["trad"] and x["simp"] or ""), ("simptrad",)),
                 ("expression", lambda x: x, ("simp",)),
                 ("expression", lambda x: x, ("trad",)),
         
-                ("dictmeaningsandsource", self.expression2dictmeaningssource, ("expression",)),
+                ("dictmeaningsandsource", self.memoized("dictmeaningsandsource", self.expression2dictmeaningssource, "dictlanguage", "prefersimptrad", "fallbackongoogletranslate", "googletranslatestate"), ("expression",)),
                 ("dictmeanings", liftm_none(fst), ("dictmeaningsandsource",)),
                 ("dictmeaningssource", liftm_none(snd), ("dictmeaningsandsource",)),
-                ("dictmws", self.expression2dictmws, ("expression",)),
+                ("dictmws", self.memoized("dictmws", self.expression2dictmws, "prefersimptrad"), ("expression",)),
                 
                 ("mergeddictmeaningsmws", self.dictmeaningsmws2mergeddictmeaningsmws, ("dictmeanings", "dictmws", "mwfieldinfact")),
                 ("mergeddictmeanings", liftm_none(fst), ("mergeddictmeaningsmws",)),
@@ -139,20 +250,70 @@ class GraphBasedUpdater(object):
                 ("mw", self.mergeddictmws2mw, ("mergeddictmws",)),
                 ("mwaudio", self.mergeddictmwdictreading2mwaudio, ("dictmws", "dictreading")), # Need dictreading for the noun
         
-                ("dictreading", self.expression2dictreading, ("expression",)),
+                ("dictreading", self.memoized("dictreading", self.expression2dictreading, "dictlanguage"), ("expression",)),
                 ("reading", self.dictreading2reading, ("dictreading",)),
                 ("dictreading", self.reading2dictreading, ("reading",)),
-                ("color", self.expressiondictreading2color, ("expression", "dictreading")),
+                ("color", self.memoized("color", self.expressiondictreading2color, "tonecolors"), ("expression", "dictreading")),
                 ("audio", self.dictreading2audio, ("dictreading",)),
                 
                 ("weblinks", self.expression2weblinks, ("expression",))
             ]
-
+        
+        # Record how long each updater takes, both by function and by the field it fills
+        self.updaters = [(field, self.timed(field, function, usings), usings) for field, function, usings in self.updaters]
+
+    def timed(self, field, function, usings):
+        name = function.__name__
+        if name == "<lambda>":
+            # Anonymous glue: describe it by what it does instead
+            name = "%s from %s" % (field, ", ".join(usings))
+        
+        return metrics.registry.timed(["updater: " + name, "field: " + field], function)
+    
+    # Only the pure updaters should be memoized: the audio updaters have the side effect of importing media into the deck.
+    # NB: the settings are read for every call, so they mustn't have side effects (unlike shouldusegoogletranslate)
+    def memoized(self, name, function, *settings):
+        return updatermemo.memoize(name, function, lambda: tuple([getattr(self.config, setting) for setting in settings]))
+
+    """
+    Looks up the given expressions in the dictionary up front, so that a batch of facts can be
+    updated without going back to the dictionary for each one. We only bother with the lookups
+    that the given fields (the ones that might be updated) could depend on.
+    """
+    def prefetch(self, expressions, fields):
+        lookups = [(field, function) for field, function, usings in dependedonby(self.updaters, fields) if usings == ("expression",) and field in prefetchablefields]
+        log.info("Prefetching %r for %d expressions", [field for field, _ in lookups], len(expressions))
+        
+        if "dictmeaningsandsource" in [field for field, _ in lookups] and self.config.fallbackongoogletranslate:
+            # Translate whatever the local dictionary can't deal with in as few requests to Google as possible.
+            # NB: the queue skips anything in the cache, and only goes online if the circuit breaker allows it
+            for expression in expressions:
+                if self.localdictmeanings(expression) is None:
+                    dictionaryonline.queue.request(expression, self.config.dictlanguage)
+            
+            dictionaryonline.queue.flush()
+        
+        for expression in expressions:
+            for _, function in lookups:
+                function(expression)
+    
     updateablefields = property(lambda self: set([field for field, _, _ in self.updaters]))
     dictionary = property(lambda self: self.dictionaries(self.config.dictlanguage))
 
     @liftm_none
     def expression2simptrad(self, expression):
+        # Convert using the variant data in the database if we have it
+        converter = simptrad.converter()
+        if converter is not None:
+            return converter.simptrad(expression)
+        
+        # Otherwise fall back on Google, if we can. Whatever we come up with without it shouldn't be
+        # remembered, as Google may be available again later (e.g. the circuit breaker closes).
+        # NB: gTrans looks in the cache first, and only asks the circuit breaker if it has to go online
+        if not self.config.fallbackongoogletranslate:
+            updatermemo.transient()
+            return { "simp" : expression, "trad" : expression }
+        
         result = {}
         for charmode, glangcode in [("simp", "zh-CN"), ("trad", "zh-TW")]:
             # Query Google for the conversion, returned in the format: ["社會",[["noun","社會","社會","社會"]]]
@@ -161,6 +322,7 @@ class GraphBasedUpdater(object):
 
             if meanings is None or len(meanings) == 0:
                 # No conversion, so give up and return the input expression
+                updatermemo.transient()
                 result[charmode] = expression
             else:
                 # Conversion is stored in the first 'meaning'
@@ -171,18 +333,15 @@ class GraphBasedUpdater(object):
     @liftm_none
     def expression2dictmeaningssource(self, expression):
         dictmeaningssources = [
-                # Use CEDICT to get meanings
-                (u"",
-                 lambda: self.dictionary.meanings(expression, self.config.prefersimptrad)[0]),
-                # Interpret Hanzi as numbers. NB: only consult after CEDICT so that we
-                # handle curious numbers such as 'liang' using the dictionary
+                # Use the local dictionary to get meanings
                 (u"",
-                 lambda: numbers.meaningfromnumberlike(expression, self.dictionary))
-            ] + (self.config.shouldusegoogletranslate and [
+                 lambda: self.localdictmeanings(expression))
+            ] + (self.config.fallbackongoogletranslate and [
                 # If the dictionary can't answer our question, ask Google Translate.
                 # If there is a long word followed by another word then this will be treated as a phrase.
                 # Phrases are also queried using googletranslate rather than the local dictionary.
-                # This helps deal with small dictionaries (for example French)
+                # This helps deal with small dictionaries (for example French). We can use translations
+                # we did earlier even if Google isn't working right now, as gTrans checks the cache first.
                 (u'<br /><span style="color:gray"><small>[Google Translate]</small></span><span> </span>',
                  lambda: dictionaryonline.gTrans(expression, self.config.dictlanguage))
             ] or [])
@@ -191,11 +350,25 @@ class GraphBasedUpdater(object):
         for dictmeaningssource, lookup in dictmeaningssources:
             dictmeanings = lookup()
             if dictmeanings != None:
+                if dictionaryonline.iserrormeanings(dictmeanings):
+                    # Show the user the error, but try again next time
+                    updatermemo.transient()
+                
                 return dictmeanings, dictmeaningssource
         
         # No information available
         return None
 
+    def localdictmeanings(self, expression):
+        # Use CEDICT to get meanings
+        dictmeanings = self.dictionary.meanings(expression, self.config.prefersimptrad)[0]
+        if dictmeanings != None:
+            return dictmeanings
+        
+        # Interpret Hanzi as numbers. NB: only consult after CEDICT so that we
+        # handle curious numbers such as 'liang' using the dictionary
+        return numbers.meaningfromnumberlike(expression, self.dictionary)
+
     @liftm_none
     def expression2dictmws(self, expression):
         # Currently, we only use CEDICT to discover the measure words. Note that we *always*
@@ -213,11 +386,12 @@ class GraphBasedUpdater(object):
     @liftm_none
     def dictmeaningsmws2meaning(self, expression, dictmeanings, dictmeaningssource):
         # Consider sandhi in meanings - you never know, there might be some!
-        dictmeanings = [transformations.tonesandhi(dictmeaning) for dictmeaning in dictmeanings]
+        dictmeanings = transformations.tonesandhimany(dictmeanings)
         
         if self.config.hanzimasking:
             # Hanzi masking is on: scan through the meanings and remove the expression itself
-            dictmeanings = [transformations.maskhanzi(expression, self.config.formathanzimaskingcharacter(), dictmeaning) for dictmeaning in dictmeanings]
+            masker = transformations.HanziMasker(expression, self.config.formathanzimaskingcharacter())
+            dictmeanings = [masker.mask(dictmeaning) for dictmeaning in dictmeanings]
 
         # Prepare all the meanings by flattening them and removing empty entries
         meanings = [meaning for meaning in [preparetokens(self.config, dictmeaning) for dictmeaning in dictmeanings] if meaning.strip != '']
@@ -286,7 +460,17 @@ class GraphBasedUpdater(object):
     def dictreading2reading(self, dictreading):
         # Put pinyin into lowercase before anything else is done to it
         # TODO: do we really want lower case here? If so, we should do it for colorized pinyin as well.
-        return preparetokens(self.config, model.formatreadingfordisplay(dictreading)).lower()
+        return self.readingrenderer().render(dictreading)
+
+    def readingrenderer(self):
+        # The configuration can change underneath us, so key the renderer on the settings it depends on.
+        # NB: only keep the one for the current settings, as each change to the colors makes a new palette
+        palette = self.config.colorizedpinyingeneration and self.config.palette or None
+        key = (palette, self.config.shouldtonify)
+        if self.readingrendererforkey[0] != key:
+            self.readingrendererforkey = (key, transformations.ReadingRenderer(palette, self.config.shouldtonify, lowercase=True))
+        
+        return self.readingrendererforkey[1]
 
     @liftm_none
     def reading2dictreading(self, reading):
@@ -294,7 +478,9 @@ class GraphBasedUpdater(object):
 
     @liftm_none
     def expressiondictreading2color(self, expression, dictreading):
-        return model.flatten(transformations.colorize(self.config.tonecolors, model.tonedcharactersfromreading(expression, dictreading)))
+        buffer = tokenbuffer.TokenBuffer.fromwords(model.tonedcharactersfromreading(expression, dictreading))
+        buffer.colorize(self.config.palette)
+        return buffer.flatten()
 
     @liftm_none
     def dictreading2audio(self, dictreading):
@@ -306,13 +492,40 @@ class GraphBasedUpdater(object):
         return u" ".join([u'[<a href="' + urltemplate.replace(u"{searchTerms}", urlescape(expression)) + u'" title="' + tooltip + u'">' + text + u'</a>]' for text, tooltip, urltemplate in self.config.weblinks])
 
 
-    def filledgraph(self, fact, delta):
+    # If a stamps dictionary is supplied, it is filled with the stamp for each generated field as it is
+    # forced, for recording in the marker of that field. See filledgraphforupdaters.
+    def filledgraph(self, fact, delta, stamps=None):
         log.info("GraphBasedUpdater.filledgraph(self, %r, %r)", fact, delta)
-        return filledgraphforupdaters(self.updaters, fact, delta)
-
-def filledgraphforupdaters(all_updaters, fact, delta):
+        settings = Thunk(lambda: md5(repr((sorted(self.config.settings.items()), dictionary.PinyinDictionary.version()))))
+        return filledgraphforupdaters(self.updaters, fact, delta, stamps, settings)
+
+"""
+Builds the graph of thunks for filling out the fact. Generated fields are stamped with a hash of the
+fields they were ultimately computed from (the non-generated ones and those in the delta) and of the
+settings. If a generated field in the fact still has the stamp we would give it, it is up to date and
+we keep it without forcing any of its inputs, even if they are dirty. If not, it is recomputed.
+
+Fields computed from a transient result (see UpdaterMemo.transient) such as an error from Google
+aren't stamped, so that we try again next time rather than keeping the bad value.
+"""
+def filledgraphforupdaters(all_updaters, fact, delta, stamps=None, settings=None):
     graph = {}
     dirty = {}
+    transients = set()
+    wantstamps = stamps is not None
+    stamps = (wantstamps and [stamps] or [{}])[0]
+    settings = settings or (lambda: "")
+    
+    # Many fields are computed from the same roots, so only hash their values once for each combination
+    rootdigests = {}
+    def stampfor(field):
+        key = plan.roots[field]
+        digest = rootdigests.get(key)
+        if digest is None:
+            digest = rootdigests[key] = md5(repr(([(root, graph[root][1]()) for root in key], settings())))
+        
+        # Only has to tell apart the values one field of one fact takes over time, so this is plenty
+        return "%08x" % (zlib.crc32(field + digest) & 0xffffffff)
     
     finddirties = lambda usings: [using for using in usings if dirty[using]]
     
@@ -325,86 +538,143 @@ def filledgraphforupdaters(all_updaters, fact, delta):
     
     log.info("Initially filled graph fields: %r", dirty)
     
-    # Remove useless updaters, and updaters that might confound a delta by updating a field from an
-    # old field. For example, if we change the reading we want to regenerate the color field -- but this is no
-    # good if we just use the updater that gets the reading from the expression!
-    all_updaters = [updater for updater in all_updaters if updater[0] not in initiallyfilledfields]
-    delta_updaters = maydependon(all_updaters, delta.keys())
-    
-    # A complication is the presence of non-generated blank fields. We want to try and update these even if the
-    # delta is empty (for example). To this end we need to make sure that the cut doesn't exclude updaters that
-    # might potentially be depended on by an updater for a blank field.
-    #
-    # We also exclude updaters for any field that is going to get filled out by any delta_updater, because those
-    # updaters should take priority.
-    all_updaters = [updater for updater in all_updaters if all([updater[0] not in delta_field for delta_field, _, _ in delta_updaters])]
-    blank_updaters = dependedonby(all_updaters, [field for field in fact if isblankfield(fact[field])])
-    
-    # Yes, this really works! This is because Python has reference comparison semantics on functions.
-    # However, this is the reason we need to use tuples of fields we depend on, rather than lists
-    updaters = set(delta_updaters + blank_updaters)
-    
-    def shell(alreadyfilled):
-        # Gather all the fields we are newly able to fill given the most recent changes
-        # to the list of already filled things
-        cannowfill = FactoryDict(lambda _: [])
-        for updatewhat, updatefunction, updateusings in updaters:
-            if updatewhat not in alreadyfilled and all([updateusing in alreadyfilled for updateusing in updateusings]):
-                # We have to delay the computation of whether something is dirty or not until we are inside
-                # the actual thunk for this particular field, hence all the thunking and lambdas here
-                inputs = Thunk(lambda updateusings=updateusings: [graph[updateusing][1]() for updateusing in updateusings])
-                cannowfill[updatewhat].append((lambda inputs=inputs, updatefunction=updatefunction: updatefunction(*(inputs())),
-                                               lambda inputs=inputs, updateusings=updateusings: seq(inputs(), lambda: finddirties(updateusings))))
-        
-        # Check for quiescence
-        if len(cannowfill) == 0:
-            # NB: could do something with the unfilled set (self.updateablefields.difference(alreadyfilled)) here
-            return
-        
-        # Set up each fillable graph field with a thunk computing the value
-        for field, possiblefillers in cannowfill.items():
-            def fillme(field=field, possiblefillers=possiblefillers):
-                # For preference, use a filler that will certainly return clean information (i.e. sort by the number of dirty inputs and prefer the first - i.e. the one with fewer dirty inputs)
-                for fillerfunction, dirtyinputs, anyinputsdirty in sorted([(f, dirties(), len(dirties()) > 0) for f, dirties in possiblefillers], using(lambda x: x[2])):
-                    if field not in fact or isblankfield(fact[field]) or anyinputsdirty:
-                        # Don't know what the last value was or it may have changed: recompute.
-                        #
-                        # We also recompute if the incoming field is blank: this can happen if we have
-                        # deleted the contents of a field, and then come back to update the fact by tabbing
-                        # away from a filled field. Now we have enough information to fill it, and musn't
-                        # just reuse the old version, which will be blank.
-                        #
-                        # Note that if the field was *generated* as blank one then it will have a marker
-                        # in it, and so we won't pointlessly recompute its blankness.
-                        log.info("Attempting to fill %s field -- dirty inputs are %s", field, dirtyinputs)
-                        result = fillerfunction()
-                        if result is None:
-                            log.info("Filling %s failed -- falling back on another method", field)
-                            continue
-                        
-                        dirty[field] = cond(field in fact, lambda: result != unmarkgeneratedfield(fact[field]), lambda: anyinputsdirty)
-                        return result
-                    else:
-                        # Last value must not have changed: retain it
-                        assert (field in fact and not anyinputsdirty)
-                        log.info("Retaining old field value for %s (blank: %s)", field, isblankfield(fact[field]))
-                        dirty[field] = False
-                        return unmarkgeneratedfield(fact[field])
+    def fillme(field, possiblefillers):
+        # Don't even look at the inputs if the field is already up to date for them
+        oldstamp = field in fact and generatedfieldstamp(fact[field]) or None
+        if oldstamp is not None and oldstamp == stampfor(field) and not isblankfield(unmarkgeneratedfield(fact[field])):
+            log.info("Retaining old field value for %s, which is up to date", field)
+            dirty[field] = False
+            stamps[field] = oldstamp
+            return unmarkgeneratedfield(fact[field])
+        
+        # For preference, use a filler that will certainly return clean information (i.e. sort by the number of dirty inputs and prefer the first - i.e. the one with fewer dirty inputs)
+        for fillerfunction, dirtyinputs, anyinputsdirty, usings in sorted([(f, dirties(), len(dirties()) > 0, usings) for f, dirties, usings in possiblefillers], using(lambda x: x[2])):
+            # NB: when we want stamps, reaching here means the old one (if any) is out of date
+            if field not in fact or isblankfield(fact[field]) or anyinputsdirty or wantstamps:
+                # Don't know what the last value was or it may have changed: recompute.
+                #
+                # We also recompute if the incoming field is blank: this can happen if we have
+                # deleted the contents of a field, and then come back to update the fact by tabbing
+                # away from a filled field. Now we have enough information to fill it, and musn't
+                # just reuse the old version, which will be blank.
+                #
+                # Note that if the field was *generated* as blank one then it will have a marker
+                # in it, and so we won't pointlessly recompute its blankness.
+                log.info("Attempting to fill %s field -- dirty inputs are %s", field, dirtyinputs)
+                result, transient = updatermemo.calltransient(fillerfunction)
+                if result is None:
+                    log.info("Filling %s failed -- falling back on another method", field)
+                    continue
+                
+                dirty[field] = cond(field in fact, lambda: result != unmarkgeneratedfield(fact[field]), lambda: anyinputsdirty)
                 
-                # What if all of the possible updaters failed? Ideally we would not be in the graph at all, but it's too late for that.
-                # All we can do is return None, and deal with this possibility later on.
-                log.info("All possible updaters failed for the field %s", field)
+                # Inputs that were forced earlier on won't tell us about their transience again, so remember it
+                if transient or [updateusing for updateusing in usings if updateusing in transients]:
+                    log.info("Not stamping %s, as it was filled from a transient result", field)
+                    transients.add(field)
+                elif wantstamps:
+                    stamps[field] = stampfor(field)
+                return result
+            else:
+                # Last value must not have changed: retain it, along with whatever stamp it had
+                assert (field in fact and not anyinputsdirty)
+                log.info("Retaining old field value for %s (blank: %s)", field, isblankfield(fact[field]))
                 dirty[field] = False
-                return None
-            
-            graph[field] = (True, Thunk(fillme))
+                stamps[field] = oldstamp
+                return unmarkgeneratedfield(fact[field])
         
-        shell(alreadyfilled.union(set(cannowfill.keys())))
+        # What if all of the possible updaters failed? Ideally we would not be in the graph at all, but it's too late for that.
+        # All we can do is return None, and deal with this possibility later on.
+        log.info("All possible updaters failed for the field %s", field)
+        dirty[field] = False
+        return None
     
-    shell(initiallyfilledfields)
+    # The dependency analysis is done by the (cached) plan: all that is left is to build the thunks
+    plan = updateplanfor(all_updaters, initiallyfilledfields, delta.keys(), [field for field in fact if isblankfield(fact[field])])
+    for field, fillers in plan.fillers:
+        possiblefillers = []
+        for index, updateusings in fillers:
+            # We have to delay the computation of whether something is dirty or not until we are inside
+            # the actual thunk for this particular field, hence all the thunking and lambdas here
+            inputs = Thunk(lambda updateusings=updateusings: [graph[updateusing][1]() for updateusing in updateusings])
+            possiblefillers.append((lambda inputs=inputs, updatefunction=all_updaters[index][1]: updatefunction(*(inputs())),
+                                    lambda inputs=inputs, updateusings=updateusings: seq(inputs(), lambda: finddirties(updateusings)),
+                                    updateusings))
+        
+        graph[field] = (True, Thunk(lambda field=field, possiblefillers=possiblefillers: fillme(field, possiblefillers)))
     
     return graph
 
+"""
+The result of the dependency analysis for filling out a graph. This only depends on the shape of the
+updaters (the field each one fills and the fields it uses) and on which fields are initially filled,
+in the delta or blank, so it can be reused for every edit with the same combination of those.
+
+The fillers are a list of (field, [(index of updater, fields it uses)]), in the order in which
+the fields can be filled. The roots give the initially filled fields that each field is ultimately
+computed from, for stamping.
+"""
+class UpdatePlan(object):
+    def __init__(self, all_updaters, initiallyfilledfields, deltafields, blankfields):
+        # Work with the indexes of the updaters, so that the plan doesn't refer to any particular functions
+        all_updaters = [(updatewhat, index, updateusings) for index, (updatewhat, _, updateusings) in enumerate(all_updaters)]
+        
+        # Remove useless updaters, and updaters that might confound a delta by updating a field from an
+        # old field. For example, if we change the reading we want to regenerate the color field -- but this is no
+        # good if we just use the updater that gets the reading from the expression!
+        all_updaters = [updater for updater in all_updaters if updater[0] not in initiallyfilledfields]
+        delta_updaters = maydependon(all_updaters, deltafields)
+        
+        # A complication is the presence of non-generated blank fields. We want to try and update these even if the
+        # delta is empty (for example). To this end we need to make sure that the cut doesn't exclude updaters that
+        # might potentially be depended on by an updater for a blank field.
+        #
+        # We also exclude updaters for any field that is going to get filled out by any delta_updater, because those
+        # updaters should take priority.
+        all_updaters = [updater for updater in all_updaters if all([updater[0] not in delta_field for delta_field, _, _ in delta_updaters])]
+        blank_updaters = dependedonby(all_updaters, blankfields)
+        
+        # NB: keep the updaters in their original order, so the preference between equally good fillers is stable
+        updaters = sorted(set(delta_updaters + blank_updaters), using(lambda updater: updater[1]))
+        
+        # Repeatedly gather all the fields we are newly able to fill given the most recent changes
+        # to the list of already filled things, until we reach quiescence
+        self.fillers = []
+        alreadyfilled = set(initiallyfilledfields)
+        while True:
+            cannowfill = FactoryDict(lambda _: [])
+            for updatewhat, index, updateusings in updaters:
+                if updatewhat not in alreadyfilled and all([updateusing in alreadyfilled for updateusing in updateusings]):
+                    cannowfill[updatewhat].append((index, updateusings))
+            
+            if len(cannowfill) == 0:
+                # NB: could do something with the unfilled set (self.updateablefields.difference(alreadyfilled)) here
+                break
+            
+            self.fillers.extend(cannowfill.items())
+            alreadyfilled.update(cannowfill.keys())
+        
+        # NB: we don't know which filler will be used until the thunk is forced, so be conservative
+        self.roots = dict([(field, (field,)) for field in initiallyfilledfields])
+        for field, fillers in self.fillers:
+            self.roots[field] = tuple(sorted(set([root for _, updateusings in fillers for updateusing in updateusings for root in self.roots[updateusing]])))
+
+updateplans = {}
+
+def updateplanfor(all_updaters, initiallyfilledfields, deltafields, blankfields):
+    key = (tuple([(updatewhat, updateusings) for updatewhat, _, updateusings in all_updaters]),
+           frozenset(initiallyfilledfields), frozenset(deltafields), frozenset(blankfields))
+    
+    plan = updateplans.get(key)
+    if plan is None:
+        # There are only so many combinations of fields, but don't let the cache grow without bound
+        if len(updateplans) >= 1000:
+            updateplans.clear()
+        
+        plan = updateplans[key] = UpdatePlan(all_updaters, initiallyfilledfields, deltafields, blankfields)
+    
+    return plan
+
 
 # Given a list of updaters and the fields that have changed, removes any updaters that could not possibly compute a
 # new value (by analysis of the transitive closure of their dependencies)
@@ -6,6 +6,8 @@ import os
 import re
 import sys
 import string
+import thread
+import threading
 import getpass
 import unicodedata
 
@@ -189,36 +191,104 @@ def md5(what):
 Lazy evaluation: defer evaluation of the function, then cache the result.
 """
 class Thunk(object):
+    __slots__ = ["__called", "__result", "__function", "__thunk_stack", "__forcer", "__waiting"]
+    
+    # Whether to record where each thunk was created. This is only used to report black holes, and
+    # formatting the stack is expensive compared to everything else we do here, so only developers
+    # pay for it. Decided when the first thunk is created, as debugmode touches the file system.
+    capturestacks = None
+    
+    # Guards the decision of which thread gets to force a thunk. NB: a plain lock, as the reentrant one
+    # in threading is written in Python and so would cost more than most of the thunks themselves.
+    forcinglock = thread.allocate_lock()
+    
+    # Lets threads wait for another thread to finish forcing a thunk. Waiting is rare, so all the thunks share
+    # it, and it is only notified when a thunk that someone is waiting for is done.
+    forced = threading.Condition(forcinglock)
+    
     def __init__(self, function):
         # Need to initialize all fields or __getattr__ gets a look at them!
         self.__called = False
         self.__result = None
         self.__function = function
+        self.__forcer = None
+        self.__waiting = False
         
         # For error messages only:
-        import traceback
-        self.__thunk_stack = traceback.format_stack()
+        if Thunk.capturestacks is None:
+            Thunk.capturestacks = debugmode()
+        
+        if Thunk.capturestacks:
+            import traceback
+            self.__thunk_stack = traceback.format_stack()
+        else:
+            self.__thunk_stack = None
     
     def __call__(self):
         if self.__called:
             return self.__result
-        elif self.__called is None:
-            raise ValueError("A thunked computation entered a black hole! Created at:\n" +  "".join(self.__thunk_stack))
         
+        Thunk.forcinglock.acquire()
         try:
-            self.__called = None # Indicates that this thunk has become a black hole
-            self.__result = self.__function()
-            self.__called = True
+            called, forcer = self.__called, self.__forcer
+            if called is False:
+                self.__called = None # Indicates that this thunk has become a black hole
+                self.__forcer = thread.get_ident()
+        finally:
+            Thunk.forcinglock.release()
+        
+        if called:
+            # Another thread finished forcing it in the meantime
+            return self.__result
+        elif called is None:
+            if forcer is None or forcer == thread.get_ident():
+                raise ValueError("A thunked computation entered a black hole! Created at:\n" +  "".join(self.__thunk_stack or ["(unknown: only recorded in debug mode)\n"]))
+            
+            # Another thread is busy forcing it: wait for the result rather than computing it twice
+            Thunk.forced.acquire()
+            try:
+                while self.__called is None and self.__forcer is not None:
+                    self.__waiting = True
+                    Thunk.forced.wait()
+            finally:
+                Thunk.forced.release()
+            
+            return self.__call__()
+        
+        try:
+            result = self.__function()
         except:
+            # Stay a black hole, but let anyone waiting for us know that we're done
+            Thunk.forcinglock.acquire()
+            try:
+                self.__forcer = None
+                self.__wakewaiters()
+            finally:
+                Thunk.forcinglock.release()
+            
             from pinyin.logger import log
             # Thunked actions raising an exception is a massively bad idea, because there
             # is no way to know whose exception handler will be on the stack at the time we
             # realise it.  Nonetheless, our only recourse at this point is to let it bubble onwards...
             log.exception("A thunked action raised an exception! Letting it go through and hoping for the best...")
             raise
-            
+        
+        Thunk.forcinglock.acquire()
+        try:
+            self.__result = result
+            self.__called = True
+            self.__wakewaiters()
+        finally:
+            Thunk.forcinglock.release()
+        
         self.__function = None # For garbage collection
         return self.__result
+    
+    def __wakewaiters(self):
+        # NB: must be called with the lock held, having recorded that we're done. A waiter checks whether we
+        # are done and says that it is waiting under the same lock, so it can't slip in between and miss us.
+        if self.__waiting:
+            Thunk.forced.notifyAll()
 
     # Transparent proxying of access onto the thing inside the thunk!
     def __getattr__(self, name):
@@ -585,7 +655,9 @@ def sequence_none(mxs):
         return mxs
 
 def liftm_none(f):
-    return lambda *mxs: bind_none(sequence_none(mxs), lambda xs: f(*xs))
+    lifted = lambda *mxs: bind_none(sequence_none(mxs), lambda xs: f(*xs))
+    lifted.__name__ = f.__name__
+    return lifted
 
 def let(*stuff):
     return stuff[-1](*(stuff[:-1]))